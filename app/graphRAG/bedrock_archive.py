@@ -0,0 +1,261 @@
+import io
+import os
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import logging
+import sqlite3
+import threading
+
+# 記録・再生の切り替え (Bedrock クライアントは引数の解析前に作成されるため環境変数で指定する)
+#   BEDROCK_ARCHIVE_MODE   : record (実際に呼び出して記録) / replay (記録から応答) / 未指定 (通常)
+#   BEDROCK_ARCHIVE        : 記録ファイル (SQLite) のパス
+#   BEDROCK_REPLAY_LATENCY : recorded (記録した応答時間だけ待つ) / none (待たない) / 数値 (記録した応答時間の倍率)
+ARCHIVE_MODE = os.getenv("BEDROCK_ARCHIVE_MODE", "")
+DEFAULT_ARCHIVE_PATH = os.getenv("BEDROCK_ARCHIVE", "./bedrock_archive.db")
+DEFAULT_REPLAY_LATENCY = os.getenv("BEDROCK_REPLAY_LATENCY", "recorded")
+
+ARCHIVE_MODES = ["record", "replay"]
+
+
+def request_key(operation, model_id, body):
+    """同じ要求を識別するキー (JSONの本文はキーの順序を揃えてから比べる)"""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False)
+    except (TypeError, ValueError):
+        pass
+    return hashlib.sha256(f"{operation}\n{model_id}\n{body}".encode("utf-8")).hexdigest()
+
+
+class BedrockArchive:
+    """Bedrock の要求と応答・応答時間を保存するローカルファイル
+
+    SQLite の1ファイルに、要求と応答を zlib 圧縮したBLOBとして保存する。
+    同じ要求が複数回記録された場合、再生時は記録した順に返す (最後まで使ったら先頭に戻る)。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bedrock_calls ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT NOT NULL,"
+            " operation TEXT NOT NULL,"
+            " model_id TEXT NOT NULL,"
+            " request BLOB NOT NULL,"
+            " response BLOB NOT NULL,"
+            " latency REAL NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bedrock_calls_key ON bedrock_calls (key, id)")
+        self._conn.commit()
+
+    def put(self, operation, model_id, body, response, latency):
+        """response は {"body": bytes または events, "headers": dict, "content_type": str} を保存する"""
+        request = body.encode("utf-8") if isinstance(body, str) else body
+        payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO bedrock_calls (key, operation, model_id, request, response, latency, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (request_key(operation, model_id, body), operation, model_id, zlib.compress(request),
+                 zlib.compress(payload), latency, time.time()),
+            )
+            self._conn.commit()
+
+    def next(self, operation, model_id, body):
+        """要求に対応する記録を順に返す (無ければ None)"""
+        key = request_key(operation, model_id, body)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT response, latency FROM bedrock_calls WHERE key = ? ORDER BY id", (key,)
+            ).fetchall()
+            if not rows:
+                return None
+            position = self._cursors.get(key, 0)
+            self._cursors[key] = position + 1
+        response, latency = rows[position % len(rows)]
+        return json.loads(zlib.decompress(response).decode("utf-8")), latency
+
+    def summary(self):
+        """操作・モデルごとの件数と応答時間の分布を返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT operation, model_id, latency FROM bedrock_calls ORDER BY operation, model_id, latency"
+            ).fetchall()
+        groups = {}
+        for operation, model_id, latency in rows:
+            groups.setdefault((operation, model_id), []).append(latency)
+        result = []
+        for (operation, model_id), latencies in groups.items():
+            result.append({
+                "operation": operation,
+                "model_id": model_id,
+                "calls": len(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p90": latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))],
+                "max": latencies[-1],
+            })
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _streaming_body(data):
+    from botocore.response import StreamingBody
+
+    return StreamingBody(io.BytesIO(data), len(data))
+
+
+def _decode(data):
+    return data.decode("utf-8") if isinstance(data, bytes) else data
+
+
+class RecordingBedrockClient:
+    """実際の bedrock-runtime クライアントを呼び出し、要求・応答・応答時間を記録するクライアント
+
+    invoke_model / invoke_model_with_response_stream 以外の属性はそのまま元のクライアントに委ねる。
+    """
+
+    def __init__(self, client, archive):
+        self._client = client
+        self._archive = archive
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def invoke_model(self, **kwargs):
+        started = time.perf_counter()
+        response = self._client.invoke_model(**kwargs)
+        body = response["body"].read()
+        latency = time.perf_counter() - started
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        self._archive.put("invoke_model", kwargs.get("modelId", ""), kwargs.get("body", ""),
+                          {"body": _decode(body), "headers": headers,
+                           "content_type": response.get("contentType", "application/json")}, latency)
+        response["body"] = _streaming_body(body)
+        return response
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        started = time.perf_counter()
+        response = self._client.invoke_model_with_response_stream(**kwargs)
+        # ストリームは最後まで読んでから記録し、読んだイベントを改めて返す
+        events = []
+        for event in response["body"]:
+            if "chunk" in event:
+                events.append({"chunk": {"bytes": _decode(event["chunk"]["bytes"])}})
+        latency = time.perf_counter() - started
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        self._archive.put("invoke_model_with_response_stream", kwargs.get("modelId", ""), kwargs.get("body", ""),
+                          {"body": events, "headers": headers,
+                           "content_type": response.get("contentType", "application/json")}, latency)
+        response["body"] = [{"chunk": {"bytes": event["chunk"]["bytes"].encode("utf-8")}} for event in events]
+        return response
+
+
+class ReplayMissError(KeyError):
+    """記録に無い要求を再生しようとした"""
+
+
+class _ReplayExceptions:
+    """llama_index の再試行判定が参照する client.exceptions の代わり"""
+
+    class ThrottlingException(Exception):
+        pass
+
+
+class ReplayBedrockClient:
+    """記録した応答を返す bedrock-runtime クライアントの代わり (AWSには接続しない)
+
+    latency は "recorded" (記録した応答時間だけ待つ)、"none" (待たない)、または記録した応答時間の倍率。
+    """
+
+    exceptions = _ReplayExceptions
+
+    def __init__(self, archive, latency=DEFAULT_REPLAY_LATENCY):
+        self._archive = archive
+        if latency == "recorded":
+            self._scale = 1.0
+        elif latency == "none":
+            self._scale = 0.0
+        else:
+            self._scale = float(latency)
+        self.stats = {"calls": 0, "misses": 0}
+
+    def _replay(self, operation, kwargs):
+        model_id = kwargs.get("modelId", "")
+        recorded = self._archive.next(operation, model_id, kwargs.get("body", ""))
+        self.stats["calls"] += 1
+        if recorded is None:
+            self.stats["misses"] += 1
+            raise ReplayMissError(f"記録に無い要求です ({operation}, {model_id})。"
+                                  "同じ入力・設定で BEDROCK_ARCHIVE_MODE=record で記録し直してください")
+        response, latency = recorded
+        if self._scale:
+            time.sleep(latency * self._scale)
+        return response
+
+    def invoke_model(self, **kwargs):
+        response = self._replay("invoke_model", kwargs)
+        body = response["body"].encode("utf-8")
+        return {
+            "body": _streaming_body(body),
+            "contentType": response["content_type"],
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": response["headers"]},
+        }
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        response = self._replay("invoke_model_with_response_stream", kwargs)
+        return {
+            "body": [{"chunk": {"bytes": event["chunk"]["bytes"].encode("utf-8")}} for event in response["body"]],
+            "contentType": response["content_type"],
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": response["headers"]},
+        }
+
+
+def create_bedrock_client(session, **client_kwargs):
+    """BEDROCK_ARCHIVE_MODE に応じて bedrock-runtime クライアントを作成する
+
+    record: 実際のクライアントを記録用にラップする / replay: AWSに接続せず記録から応答する
+    """
+    if ARCHIVE_MODE == "replay":
+        logging.info(f"Bedrock の応答を記録から再生します: {DEFAULT_ARCHIVE_PATH} (待ち時間: {DEFAULT_REPLAY_LATENCY})")
+        return ReplayBedrockClient(BedrockArchive(DEFAULT_ARCHIVE_PATH), DEFAULT_REPLAY_LATENCY)
+    client = session.client('bedrock-runtime', **client_kwargs)
+    if ARCHIVE_MODE == "record":
+        logging.info(f"Bedrock の要求と応答を記録します: {DEFAULT_ARCHIVE_PATH}")
+        return RecordingBedrockClient(client, BedrockArchive(DEFAULT_ARCHIVE_PATH))
+    if ARCHIVE_MODE:
+        raise ValueError(f"BEDROCK_ARCHIVE_MODE には {' / '.join(ARCHIVE_MODES)} を指定してください: {ARCHIVE_MODE}")
+    return client
+
+
+if __name__ == "__main__":
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="Bedrock の記録ファイルの内容 (操作・モデルごとの件数と応答時間) を表示します。\n"
+                                                 "記録・再生は各スクリプトの実行時に環境変数で指定します:\n"
+                                                 "  BEDROCK_ARCHIVE_MODE=record|replay BEDROCK_ARCHIVE=ファイル\n"
+                                                 "  BEDROCK_REPLAY_LATENCY=recorded|none|倍率",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("archive", nargs="?", default=DEFAULT_ARCHIVE_PATH,
+                        help=f"記録ファイルのパス (既定: {DEFAULT_ARCHIVE_PATH})")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.archive):
+        print(f"記録ファイルが見つかりません: {args.archive}")
+        exit(1)
+    for row in BedrockArchive(args.archive).summary():
+        print(f"{row['operation']} {row['model_id']}: {row['calls']} 件 "
+              f"(応答時間 中央値 {row['p50']:.2f} 秒, 90% {row['p90']:.2f} 秒, 最大 {row['max']:.2f} 秒)")
@@ -0,0 +1,307 @@
+import os
+import hashlib
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import networkx as nx
+from graph_backend import NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE, bump_graph_version
+from graph_snapshot import BASE_ENTITY_LABEL, create_driver
+
+# コミュニティの要約を保存するラベル
+# エンティティとはリレーションで結ばず、メンバーは members プロパティに持つ
+# (llama_index の get_rel_map がコミュニティノードまで辿らないようにするため)
+COMMUNITY_LABEL = "__Community__"
+
+ALGORITHMS = ["louvain", "label-propagation"]
+
+# エンティティ間のリレーションを (始点, 終点, 本数) に集約して取得する
+ENTITY_EDGES_QUERY = f"""
+MATCH (s:`{BASE_ENTITY_LABEL}`)-[r]->(t:`{BASE_ENTITY_LABEL}`)
+WHERE s <> t
+RETURN s.id AS source, t.id AS target, count(r) AS weight
+"""
+
+COMMUNITY_TRIPLETS_QUERY = f"""
+MATCH (s:`{BASE_ENTITY_LABEL}`)-[r]->(t:`{BASE_ENTITY_LABEL}`)
+WHERE s.id IN $members AND t.id IN $members
+RETURN s.id AS source, type(r) AS type, t.id AS target
+LIMIT $limit
+"""
+
+EXISTING_COMMUNITIES_QUERY = f"""
+MATCH (c:`{COMMUNITY_LABEL}`)
+RETURN c.id AS id, c.title AS title, c.summary AS summary, c.size AS size, c.embedding AS embedding
+"""
+
+UPSERT_COMMUNITIES_QUERY = f"""
+UNWIND $rows AS row
+MERGE (c:`{COMMUNITY_LABEL}` {{id: row.id}})
+SET c.title = row.title, c.summary = row.summary, c.size = row.size, c.members = row.members,
+    c.algorithm = row.algorithm, c.updated_at = datetime()
+WITH c, row
+CALL db.create.setNodeVectorProperty(c, 'embedding', row.embedding)
+RETURN count(*) AS count
+"""
+
+DELETE_STALE_COMMUNITIES_QUERY = f"""
+MATCH (c:`{COMMUNITY_LABEL}`) WHERE NOT c.id IN $ids
+DETACH DELETE c
+"""
+
+SUMMARY_PROMPT = """以下は知識グラフの中で密につながったエンティティのまとまり (コミュニティ) です。
+このコミュニティが何についてのものかを日本語で説明してください。
+1行目にタイトル (30文字以内) を、2行目以降に要約 (300文字以内) を書いてください。
+
+エンティティ: {entities}
+
+関係:
+{triplets}
+"""
+
+MAP_PROMPT = """以下はある知識グラフのコミュニティの要約です。
+質問に答えるのに役立つ要点を日本語の箇条書きで最大5件挙げてください。
+役立つ情報が無い場合は「無関係」とだけ答えてください。
+
+要約のタイトル: {title}
+要約: {summary}
+
+質問: {question}
+"""
+
+REDUCE_PROMPT = """以下は知識グラフの複数のコミュニティから集めた要点です。
+これらを統合して質問に日本語で答えてください。要点に無いことは推測しないでください。
+
+{points}
+
+質問: {question}
+"""
+
+# 要点が無いと判断された回答
+IRRELEVANT_ANSWER = "無関係"
+
+# コミュニティ要約はコレクションを区別せずにグラフ全体から作る
+GLOBAL_COLLECTION_ERROR = ("グローバル検索 (--search-mode global) はグラフ全体のコミュニティ要約を使うため、"
+                           "--collection と同時には指定できません")
+
+
+def load_entity_graph(driver, database):
+    """エンティティ間のリレーションを重み付き無向グラフとして読み込む"""
+    graph = nx.Graph()
+    with driver.session(database=database) as session:
+        for record in session.run(ENTITY_EDGES_QUERY):
+            source, target, weight = record["source"], record["target"], record["weight"]
+            if graph.has_edge(source, target):
+                graph[source][target]["weight"] += weight
+            else:
+                graph.add_edge(source, target, weight=weight)
+    return graph
+
+
+def detect_communities(graph, algorithm="louvain", resolution=1.0, min_size=3, seed=42):
+    """エンティティのグラフをコミュニティに分割し、min_size 未満のものを除いて大きい順に返す"""
+    if graph.number_of_nodes() == 0:
+        return []
+    if algorithm == "louvain":
+        communities = nx.community.louvain_communities(graph, weight="weight", resolution=resolution, seed=seed)
+    elif algorithm == "label-propagation":
+        communities = nx.community.asyn_lpa_communities(graph, weight="weight", seed=seed)
+    else:
+        raise ValueError(f"Unknown algorithm: {algorithm}")
+    communities = [sorted(community) for community in communities if len(community) >= min_size]
+    return sorted(communities, key=len, reverse=True)
+
+
+def community_id(members):
+    """メンバー構成から決まるコミュニティのID (構成が変わらなければ要約を再利用する)"""
+    return hashlib.sha256("\n".join(members).encode("utf-8")).hexdigest()[:16]
+
+
+def summarize_community(driver, database, llm, members, graph, max_entities, max_triplets):
+    """コミュニティ内の主要なエンティティと関係をLLMで要約し、(タイトル, 要約) を返す"""
+    # 次数の大きいエンティティを優先してプロンプトに含める
+    ranked = sorted(members, key=lambda m: graph.degree(m, weight="weight"), reverse=True)[:max_entities]
+    records, _, _ = driver.execute_query(COMMUNITY_TRIPLETS_QUERY, members=ranked, limit=max_triplets,
+                                         database_=database)
+    triplets = "\n".join(f"{r['source']} -[{r['type']}]-> {r['target']}" for r in records)
+    response = llm.complete(SUMMARY_PROMPT.format(entities=", ".join(ranked), triplets=triplets))
+    lines = [line.strip() for line in str(response).strip().splitlines() if line.strip()]
+    if not lines:
+        return ranked[0], ""
+    title = lines[0].lstrip("#").removeprefix("タイトル:").removeprefix("タイトル：").strip()
+    summary = "\n".join(lines[1:]).removeprefix("要約:").removeprefix("要約：").strip()
+    return title, summary
+
+
+def build_communities(driver, database, llm, embedding, algorithm="louvain", resolution=1.0, min_size=3,
+                      max_entities=30, max_triplets=60, num_workers=4, batch_size=100):
+    """コミュニティを検出して要約・埋め込みを作成し、Neo4jに保存する
+
+    メンバー構成が前回と同じコミュニティは保存済みの要約を再利用し、LLMを呼び出さない。
+    """
+    graph = load_entity_graph(driver, database)
+    logging.info(f"エンティティグラフ: ノード {graph.number_of_nodes()}, エッジ {graph.number_of_edges()}")
+    communities = detect_communities(graph, algorithm, resolution, min_size)
+    logging.info(f"コミュニティ数: {len(communities)} ({algorithm})")
+
+    records, _, _ = driver.execute_query(EXISTING_COMMUNITIES_QUERY, database_=database)
+    existing = {record["id"]: record.data() for record in records}
+
+    rows = []
+    pending = []
+    for members in communities:
+        cid = community_id(members)
+        row = {"id": cid, "size": len(members), "members": members, "algorithm": algorithm}
+        if cid in existing and existing[cid]["summary"] and existing[cid]["embedding"]:
+            row.update(title=existing[cid]["title"], summary=existing[cid]["summary"],
+                       embedding=existing[cid]["embedding"])
+        else:
+            pending.append(row)
+        rows.append(row)
+    logging.info(f"要約を作成するコミュニティ: {len(pending)}/{len(rows)} (残りは再利用)")
+
+    def summarize(row):
+        row["title"], row["summary"] = summarize_community(driver, database, llm, row["members"], graph,
+                                                           max_entities, max_triplets)
+        logging.info(f"要約作成: {row['title']} ({row['size']} エンティティ)")
+        return row
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(summarize, pending))
+    if pending:
+        vectors = embedding.get_text_embedding_batch([f"{row['title']}\n{row['summary']}" for row in pending])
+        for row, vector in zip(pending, vectors):
+            row["embedding"] = vector
+
+    for i in range(0, len(rows), batch_size):
+        driver.execute_query(UPSERT_COMMUNITIES_QUERY, rows=rows[i:i + batch_size], database_=database)
+    driver.execute_query(DELETE_STALE_COMMUNITIES_QUERY, ids=[row["id"] for row in rows], database_=database)
+    return {"communities": len(rows), "summarized": len(pending), "reused": len(rows) - len(pending)}
+
+
+def global_search(driver, database, llm, embedding, question, top_k=8, num_workers=4):
+    """保存済みのコミュニティ要約から回答する (map: 要約ごとに要点抽出, reduce: 要点を統合)
+
+    質問に近い上位 top_k 件の要約だけを使うため、LLM呼び出しは最大 top_k + 1 回に収まる。
+    """
+    records, _, _ = driver.execute_query(EXISTING_COMMUNITIES_QUERY, database_=database)
+    communities = [record.data() for record in records if record["summary"] and record["embedding"]]
+    if not communities:
+        raise ValueError("コミュニティの要約がありません。先に community_summary.py build を実行してください")
+
+    query_vector = np.asarray(embedding.get_query_embedding(question), dtype=np.float32)
+    matrix = np.asarray([c["embedding"] for c in communities], dtype=np.float32)
+    scores = matrix @ query_vector / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-12)
+    selected = [communities[i] for i in np.argsort(-scores)[:top_k]]
+
+    def map_community(community):
+        prompt = MAP_PROMPT.format(title=community["title"], summary=community["summary"], question=question)
+        return community, str(llm.complete(prompt)).strip()
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        mapped = list(executor.map(map_community, selected))
+
+    points = [f"## {community['title']}\n{answer}" for community, answer in mapped
+              if answer and IRRELEVANT_ANSWER not in answer[:10]]
+    logging.info(f"グローバル検索: {len(selected)} 件の要約のうち {len(points)} 件から要点を取得")
+    if not points:
+        return "関連するコミュニティが見つかりませんでした。"
+    return str(llm.complete(REDUCE_PROMPT.format(points="\n\n".join(points), question=question))).strip()
+
+
+def answer_globally(args, llm, embedding, question):
+    """質問応答スクリプトの引数 (接続情報・--global-top-k) でグローバル検索を実行する"""
+    if args.graph_store != "neo4j":
+        raise ValueError("グローバル検索は neo4j ストアでのみ使用できます")
+    if args.collection:
+        raise ValueError(GLOBAL_COLLECTION_ERROR)
+    driver = create_driver(args)
+    try:
+        return global_search(driver, args.neo4j_database, llm, embedding, question, top_k=args.global_top_k)
+    finally:
+        driver.close()
+
+
+def check_global_search_arguments(parser, args):
+    """コミュニティ要約はグラフ全体から作るため、コレクションを指定したグローバル検索は受け付けない"""
+    if args.search_mode == "global" and args.collection:
+        parser.error(GLOBAL_COLLECTION_ERROR)
+
+
+def add_global_search_arguments(parser):
+    """質問応答スクリプトにグローバル検索用の引数を追加する"""
+    group = parser.add_argument_group('グローバル検索')
+    group.add_argument("--search-mode", choices=["local", "global"], default="local",
+                       help="質問応答の方式\n"
+                            "  local : エンティティから周辺のトリプレットを辿って回答 (既定)\n"
+                            "  global: 事前に作成したコミュニティ要約から回答 (全体像を問う質問向け)")
+    group.add_argument("--global-top-k", type=int, default=8,
+                       help="global で使用するコミュニティ要約の件数 (既定: 8)")
+    return group
+
+
+if __name__ == "__main__":
+    import boto3
+    from bedrock_archive import create_bedrock_client
+    from model_roles import create_role_llm
+    from llama_index.embeddings.bedrock import BedrockEmbedding
+
+    logging.basicConfig(level=logging.INFO)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="知識グラフをコミュニティに分割し、各コミュニティの要約をNeo4jに保存します。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--neo4j-url", default=NEO4J_URL, help="Neo4jの接続URL")
+    parser.add_argument("--neo4j-username", default=NEO4J_USERNAME, help="Neo4jのユーザー名")
+    parser.add_argument("--neo4j-password", default=NEO4J_PASSWORD, help="Neo4jのパスワード")
+    parser.add_argument("--neo4j-database", default=NEO4J_DATABASE, help="Neo4jのデータベース名")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="コミュニティを検出して要約を作成・保存する")
+    build_parser.add_argument("--algorithm", choices=ALGORITHMS, default="louvain",
+                              help="コミュニティ検出のアルゴリズム (既定: louvain)")
+    build_parser.add_argument("--resolution", type=float, default=1.0,
+                              help="louvain の解像度 (大きいほど小さなコミュニティに分かれる, 既定: 1.0)")
+    build_parser.add_argument("--min-size", type=int, default=3,
+                              help="要約を作成するコミュニティの最小エンティティ数 (既定: 3)")
+    build_parser.add_argument("--max-entities", type=int, default=30,
+                              help="1コミュニティの要約に含めるエンティティ数の上限 (既定: 30)")
+    build_parser.add_argument("--max-triplets", type=int, default=60,
+                              help="1コミュニティの要約に含める関係数の上限 (既定: 60)")
+    build_parser.add_argument("--num-workers", type=int, default=4,
+                              help="要約作成の並列数 (既定: 4)")
+    subparsers.add_parser("list", help="保存済みのコミュニティ要約を表示する")
+
+    args = parser.parse_args()
+
+    driver = create_driver(args)
+    try:
+        if args.command == "build":
+            session = boto3.Session(
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                region_name=os.getenv('AWS_DEFAULT_REGION')
+            )
+            bedrock_client = create_bedrock_client(session)
+            # 要約の作成は投入と同じくまとめて流す処理のため、extraction の役割 (モデル・同時呼び出し数) を使う
+            llm = create_role_llm(session, "extraction")
+            embedding = BedrockEmbedding(model_name="amazon.titan-embed-text-v2:0", client=bedrock_client)
+            result = build_communities(driver, args.neo4j_database, llm, embedding,
+                                       algorithm=args.algorithm,
+                                       resolution=args.resolution,
+                                       min_size=args.min_size,
+                                       max_entities=args.max_entities,
+                                       max_triplets=args.max_triplets,
+                                       num_workers=args.num_workers)
+            bump_graph_version(driver, args.neo4j_database)
+            print(f"コミュニティ要約の作成完了: {result}")
+        elif args.command == "list":
+            records, _, _ = driver.execute_query(EXISTING_COMMUNITIES_QUERY, database_=args.neo4j_database)
+            for record in sorted(records, key=lambda r: r["size"] or 0, reverse=True):
+                print(f"[{record['id']}] {record['title']} ({record['size']} エンティティ)")
+                print(f"    {record['summary']}")
+    except Exception as e:
+        print(f"コミュニティ要約の処理中にエラーが発生しました: {e}")
+        exit(1)
+    finally:
+        driver.close()
@@ -0,0 +1,122 @@
+import re
+import logging
+from typing import List, Optional
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from ingest_estimate import ASCII_CHARS_PER_TOKEN, NON_ASCII_TOKENS_PER_CHAR, estimate_tokens
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 4000
+
+# 検索結果のトリプレット行 (例: "ラオウ -> 兄 -> ケンシロウ")
+TRIPLET_LINE_PATTERN = re.compile(r"^\S.* -> .+ -> .+$")
+
+# 予算の残りがこのトークン数未満になったら、切り詰めずに打ち切る
+MIN_PARTIAL_TOKENS = 50
+
+
+def _normalize(text):
+    return " ".join(text.split())
+
+
+def _truncate_to_tokens(text, max_tokens):
+    """先頭から max_tokens (見積もり値) に収まるところまで切り詰める (収まらない行は文字単位で切る)"""
+    lines = []
+    used = 0
+    for line in text.splitlines():
+        tokens = estimate_tokens(line)
+        if used + tokens <= max_tokens:
+            lines.append(line)
+            used += tokens
+            continue
+        budget = max_tokens - used
+        cost = 0.0
+        for end, c in enumerate(line):
+            cost += 1 / ASCII_CHARS_PER_TOKEN if ord(c) < 128 else NON_ASCII_TOKENS_PER_CHAR
+            if cost >= budget:
+                lines.append(line[:end])
+                break
+        break
+    return "\n".join(lines)
+
+
+class ContextBudgetPostprocessor(BaseNodePostprocessor):
+    """検索結果を回答生成の前に整理し、トークン予算に収める
+
+    1. 同じ本文のノードとほかのノードで既に出現したトリプレット行を除く
+    2. 関連度スコアの高い順に並べる
+    3. 予算に達するまで詰め、最後の1件は予算に収まるよう切り詰める
+    """
+
+    token_budget: int = DEFAULT_CONTEXT_TOKEN_BUDGET
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextBudgetPostprocessor"
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        before_tokens = sum(estimate_tokens(node.node.get_content()) for node in nodes)
+        ranked = sorted(nodes, key=lambda node: node.score if node.score is not None else 0.0, reverse=True)
+
+        seen_texts = set()
+        seen_triplets = set()
+        packed = []
+        used = 0
+        for node in ranked:
+            text = node.node.get_content()
+            key = _normalize(text)
+            if key in seen_texts:
+                continue
+            seen_texts.add(key)
+
+            lines = []
+            for line in text.splitlines():
+                if TRIPLET_LINE_PATTERN.match(line.strip()):
+                    triplet = _normalize(line)
+                    if triplet in seen_triplets:
+                        continue
+                    seen_triplets.add(triplet)
+                lines.append(line)
+            text = "\n".join(lines)
+            if not text.strip():
+                continue
+
+            tokens = estimate_tokens(text)
+            remaining = self.token_budget - used
+            if tokens > remaining:
+                if remaining >= MIN_PARTIAL_TOKENS:
+                    text = _truncate_to_tokens(text, remaining)
+                    if text.strip():
+                        packed.append(self._with_text(node, text))
+                        used += estimate_tokens(text)
+                break
+            packed.append(self._with_text(node, text) if text != node.node.get_content() else node)
+            used += tokens
+
+        logging.info(f"コンテキストの整理: {len(nodes)} → {len(packed)} 件, "
+                     f"{before_tokens} → {used} トークン (削除 {before_tokens - used}, 予算 {self.token_budget})")
+        return packed
+
+    @staticmethod
+    def _with_text(node, text):
+        """元のノードを変更せずに本文だけを差し替えたコピーを返す"""
+        copied = node.node.model_copy()
+        copied.set_content(text)
+        return NodeWithScore(node=copied, score=node.score)
+
+
+def build_node_postprocessors(args):
+    """引数からクエリエンジンに渡すポストプロセッサーの一覧を作る"""
+    if args.context_token_budget <= 0:
+        return []
+    return [ContextBudgetPostprocessor(token_budget=args.context_token_budget)]
+
+
+def add_context_arguments(parser):
+    """回答生成に渡すコンテキストの予算の引数を追加する"""
+    group = parser.add_argument_group('コンテキスト')
+    group.add_argument("--context-token-budget", type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                       help="回答生成に渡す検索結果のトークン数 (見積もり値) の上限\n"
+                            f"(既定: {DEFAULT_CONTEXT_TOKEN_BUDGET}, 0 以下で無制限)")
+    return group
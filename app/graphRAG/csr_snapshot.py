@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import datetime
+import logging
+import threading
+from array import array
+from typing import Any, List
+import numpy as np
+from llama_index.core.indices.property_graph import BasePGRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from graph_backend import add_backend_arguments, graph_version
+from graph_snapshot import BASE_NODE_LABEL, BASE_ENTITY_LABEL, create_driver
+from graph_collections import _type_expression, collection_chunk_label, collection_label
+from khop_retriever import DEFAULT_SNAPSHOT_DIR, build_seed_nodes
+
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+# 行列の積を一度に計算する行数 (一時的なメモリを抑える)
+SEARCH_BLOCK_ROWS = 65536
+
+ENTITY_COUNT_QUERY = "MATCH (e:{entity}) RETURN count(e) AS entities"
+
+ENTITY_QUERY = """
+MATCH (e:{entity})
+RETURN e.id AS id, {type_expression} AS type, e.embedding AS embedding
+"""
+
+RELATION_QUERY = """
+MATCH (s:{entity})-[r]->(t:{entity})
+WHERE type(r) <> 'MENTIONS' AND ($collection IS NULL OR $collection IN coalesce(r.collections, []))
+RETURN s.id AS source, type(r) AS type, t.id AS target
+"""
+
+MENTION_QUERY = """
+MATCH (c:{chunk})-[:MENTIONS]->(e:{entity})
+RETURN c.id AS chunk, e.id AS entity
+"""
+
+CHUNK_TEXT_QUERY = """
+MATCH (c:{chunk})
+WHERE c.text IS NOT NULL AND EXISTS {{ (c)-[:MENTIONS]->(:{entity}) }}
+RETURN c.id AS chunk, c.text AS text
+"""
+
+
+def _write_strings(directory, name, values):
+    """文字列の一覧を UTF-8 の連結 (bytes) と開始位置 (offsets) の2つの配列で保存する"""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    np.save(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+    np.save(os.path.join(directory, f"{name}.bytes.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+def _build_csr(count, sources, targets, values):
+    """(sources → targets) の辺を起点ごとに並べた CSR (indptr, targets, values...) を作る"""
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(count + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=count))
+    return indptr, targets[order], [value[order] for value in values]
+
+
+class Neo4jSnapshotSource:
+    """Neo4j からスナップショットの元データを読み出す (全件をメモリに載せずに流す)"""
+
+    def __init__(self, driver, database, collection=None, fetch_size=5000):
+        self.driver = driver
+        self.database = database
+        self.fetch_size = fetch_size
+        self.collection = collection
+        # コレクション指定の場合は、そのコレクションのエンティティ・チャンク・関係だけを読み出す
+        self.entity = f"`{BASE_ENTITY_LABEL}`" + (f":`{collection_label(collection)}`" if collection else "")
+        self.chunk = f"`{BASE_NODE_LABEL}`" + (f":`{collection_chunk_label(collection)}`" if collection else "")
+
+    def _stream(self, query, fields):
+        with self.driver.session(database=self.database, fetch_size=self.fetch_size) as session:
+            statement = query.format(entity=self.entity, chunk=self.chunk, type_expression=_type_expression("e"))
+            for record in session.run(statement, collection=self.collection):
+                yield tuple(record[field] for field in fields)
+
+    def entity_count(self):
+        records, _, _ = self.driver.execute_query(ENTITY_COUNT_QUERY.format(entity=self.entity),
+                                                  database_=self.database)
+        return records[0]["entities"]
+
+    def entities(self):
+        return self._stream(ENTITY_QUERY, ("id", "type", "embedding"))
+
+    def relations(self):
+        return self._stream(RELATION_QUERY, ("source", "type", "target"))
+
+    def mentions(self):
+        return self._stream(MENTION_QUERY, ("chunk", "entity"))
+
+    def chunk_texts(self):
+        return self._stream(CHUNK_TEXT_QUERY, ("chunk", "text"))
+
+
+class SimpleSnapshotSource:
+    """組み込みストア (SimplePropertyGraphStore とベクトルストア) からスナップショットの元データを読み出す"""
+
+    def __init__(self, index):
+        from llama_index.core.graph_stores.types import ChunkNode, EntityNode
+
+        graph = index.property_graph_store.graph
+        self._entities = [node for node in graph.nodes.values() if isinstance(node, EntityNode)]
+        self._chunks = [node for node in graph.nodes.values() if isinstance(node, ChunkNode)]
+        self._relations = list(graph.relations.values())
+        self._embeddings = index.vector_store.data.embedding_dict if index.vector_store is not None else {}
+
+    def entity_count(self):
+        return len(self._entities)
+
+    def entities(self):
+        for node in self._entities:
+            yield node.id, node.label, self._embeddings.get(node.id, node.embedding)
+
+    def relations(self):
+        for relation in self._relations:
+            yield relation.source_id, relation.label, relation.target_id
+
+    def mentions(self):
+        # 組み込みストアには MENTIONS が無いため、エンティティの出典 (triplet_source_id) を使う
+        for node in self._entities:
+            if node.properties.get("triplet_source_id"):
+                yield node.properties["triplet_source_id"], node.id
+
+    def chunk_texts(self):
+        for node in self._chunks:
+            yield node.id, node.text
+
+
+def build_snapshot(source, output_dir, version=None, include_chunks=True):
+    """グラフを CSR 形式の配列ファイルに書き出す
+
+    一時ディレクトリに書き出してから置き換えるため、読み込み中のプロセスは古いファイルを使い続けられる。
+    """
+    started = time.perf_counter()
+    staging = f"{output_dir.rstrip(os.sep)}.building"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    # エンティティ: 名前を通し番号に置き換え、埋め込みは正規化して float32 の行列にする
+    expected = source.entity_count()
+    ids = {}
+    names = []
+    type_names = {}
+    types = array("h")
+    embeddings = None
+    for entity_id, entity_type, embedding in source.entities():
+        if entity_id in ids:
+            continue
+        if embedding is not None and embeddings is None:
+            embeddings = np.lib.format.open_memmap(os.path.join(staging, "embeddings.npy"), mode="w+",
+                                                   dtype=np.float32, shape=(expected, len(embedding)))
+        position = len(names)
+        if position >= expected:
+            raise ValueError("読み出し中にエンティティが増えました。投入が止まっている間に作成してください")
+        ids[entity_id] = position
+        names.append(entity_id)
+        types.append(type_names.setdefault(entity_type or "", len(type_names)))
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            embeddings[position] = vector / norm if norm else vector
+        if len(names) % 100000 == 0:
+            logging.info(f"エンティティ: {len(names)}/{expected}")
+    count = len(names)
+    dimensions = embeddings.shape[1] if embeddings is not None else 0
+    if embeddings is not None:
+        embeddings.flush()
+        del embeddings
+        if count < expected:
+            # 読み出し中に削除された分を詰める
+            matrix = np.load(os.path.join(staging, "embeddings.npy"), mmap_mode="r")[:count]
+            np.save(os.path.join(staging, "embeddings.tmp.npy"), matrix)
+            del matrix
+            os.replace(os.path.join(staging, "embeddings.tmp.npy"), os.path.join(staging, "embeddings.npy"))
+    _write_strings(staging, "entity_names", names)
+    np.save(os.path.join(staging, "entity_types.npy"), np.frombuffer(types, dtype=np.int16))
+
+    # 関係: 向きを区別して両方向の辺を持つ CSR にする (探索は向きを問わない)
+    relation_names = {}
+    sources, targets, relation_types = array("i"), array("i"), array("h")
+    skipped = 0
+    for source_id, relation_type, target_id in source.relations():
+        if source_id not in ids or target_id not in ids:
+            skipped += 1
+            continue
+        sources.append(ids[source_id])
+        targets.append(ids[target_id])
+        relation_types.append(relation_names.setdefault(relation_type, len(relation_names)))
+    sources = np.frombuffer(sources, dtype=np.int32)
+    targets = np.frombuffer(targets, dtype=np.int32)
+    relation_types = np.frombuffer(relation_types, dtype=np.int16)
+    indptr, neighbours, (edge_types, outgoing) = _build_csr(
+        count,
+        np.concatenate([sources, targets]),
+        np.concatenate([targets, sources]),
+        [np.concatenate([relation_types, relation_types]),
+         np.concatenate([np.ones(len(sources), dtype=bool), np.zeros(len(sources), dtype=bool)])])
+    np.save(os.path.join(staging, "adjacency_indptr.npy"), indptr)
+    np.save(os.path.join(staging, "adjacency_targets.npy"), neighbours)
+    np.save(os.path.join(staging, "adjacency_types.npy"), edge_types)
+    np.save(os.path.join(staging, "adjacency_outgoing.npy"), outgoing)
+
+    # チャンク: エンティティごとに参照しているチャンクの CSR と、チャンクの本文
+    chunk_count = 0
+    if include_chunks:
+        chunk_ids = {}
+        mention_entities, mention_chunks = array("i"), array("i")
+        for chunk_id, entity_id in source.mentions():
+            if entity_id not in ids:
+                continue
+            mention_entities.append(ids[entity_id])
+            mention_chunks.append(chunk_ids.setdefault(chunk_id, len(chunk_ids)))
+        texts = [""] * len(chunk_ids)
+        for chunk_id, text in source.chunk_texts():
+            if chunk_id in chunk_ids:
+                texts[chunk_ids[chunk_id]] = text or ""
+        chunk_indptr, chunk_targets, _ = _build_csr(count, np.frombuffer(mention_entities, dtype=np.int32),
+                                                    np.frombuffer(mention_chunks, dtype=np.int32), [])
+        np.save(os.path.join(staging, "chunk_indptr.npy"), chunk_indptr)
+        np.save(os.path.join(staging, "chunk_targets.npy"), chunk_targets)
+        _write_strings(staging, "chunk_ids", list(chunk_ids))
+        _write_strings(staging, "chunk_texts", texts)
+        chunk_count = len(chunk_ids)
+
+    manifest = {
+        "format": FORMAT_VERSION,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "graph_version": version,
+        "entities": count,
+        "relations": int(len(sources)),
+        "skipped_relations": skipped,
+        "chunks": chunk_count,
+        "dimensions": dimensions,
+        "entity_types": list(type_names),
+        "relation_types": list(relation_names),
+    }
+    with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    # 置き換え: 古いディレクトリは読み込み中のプロセスが開いたまま削除できる (mmap は inode を参照する)
+    previous = f"{output_dir.rstrip(os.sep)}.previous"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(output_dir):
+        os.replace(output_dir, previous)
+    os.replace(staging, output_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    manifest["seconds"] = time.perf_counter() - started
+    return manifest
+
+
+class _StringTable:
+    """連結した UTF-8 と開始位置の配列から文字列を取り出す (名前から番号への索引は必要になったときに作る)"""
+
+    def __init__(self, directory, name):
+        self.data = np.load(os.path.join(directory, f"{name}.bytes.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode="r")
+        self._positions = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return bytes(self.data[self.offsets[position]:self.offsets[position + 1]]).decode("utf-8")
+
+    def position(self, value):
+        with self._lock:
+            if self._positions is None:
+                self._positions = {self[i]: i for i in range(len(self))}
+        return self._positions.get(value)
+
+
+class CsrSnapshot:
+    """CSR 形式のスナップショットを読み取り専用で memory-map し、プロセス内で探索する
+
+    配列はすべて np.load(mmap_mode="r") で開くため、同じホストの複数のワーカープロセスは
+    OS のページキャッシュ上の同じページを共有する。
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, MANIFEST_FILE), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("format") != FORMAT_VERSION:
+            raise ValueError(f"スナップショットの形式が異なります: {self.manifest.get('format')} "
+                             f"(期待する形式: {FORMAT_VERSION})。作り直してください")
+
+        def load(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+        self.directory = directory
+        self.names = _StringTable(directory, "entity_names")
+        self.entity_types = load("entity_types")
+        self.embeddings = load("embeddings") if self.manifest["dimensions"] else None
+        self.indptr = load("adjacency_indptr")
+        self.targets = load("adjacency_targets")
+        self.edge_types = load("adjacency_types")
+        self.outgoing = load("adjacency_outgoing")
+        self.relation_types = self.manifest["relation_types"]
+        self.has_chunks = os.path.exists(os.path.join(directory, "chunk_indptr.npy"))
+        if self.has_chunks:
+            self.chunk_indptr = load("chunk_indptr")
+            self.chunk_targets = load("chunk_targets")
+            self.chunk_ids = _StringTable(directory, "chunk_ids")
+            self.chunk_texts = _StringTable(directory, "chunk_texts")
+
+    def search(self, vector, top_k):
+        """コサイン類似度の上位 top_k 件の (番号, スコア) を返す (全件との内積をブロック単位で計算する)"""
+        if self.embeddings is None or not len(self.embeddings):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape[0] != self.embeddings.shape[1]:
+            raise ValueError(f"質問の埋め込みの次元 ({query.shape[0]}) がスナップショット "
+                             f"({self.embeddings.shape[1]}) と異なります")
+        query = query / (np.linalg.norm(query) or 1.0)
+        best_positions = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start in range(0, len(self.embeddings), SEARCH_BLOCK_ROWS):
+            scores = self.embeddings[start:start + SEARCH_BLOCK_ROWS] @ query
+            keep = min(top_k, len(scores))
+            candidates = np.argpartition(-scores, keep - 1)[:keep]
+            best_positions = np.concatenate([best_positions, candidates + start])
+            best_scores = np.concatenate([best_scores, scores[candidates]])
+            if len(best_scores) > top_k:
+                top = np.argpartition(-best_scores, top_k - 1)[:top_k]
+                best_positions, best_scores = best_positions[top], best_scores[top]
+        order = np.argsort(-best_scores)
+        return [(int(best_positions[i]), float(best_scores[i])) for i in order]
+
+    def _edges(self, frontier):
+        """frontier のノードから出るすべての辺の (元, 先, 種類, 向き) を配列で返す"""
+        starts = self.indptr[frontier]
+        lengths = self.indptr[frontier + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, np.zeros(0, dtype=bool)
+        # 各ノードの辺の範囲 [start, start + length) をつなげた添字を一度に作る
+        positions = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(total)
+        return (np.repeat(frontier, lengths), np.asarray(self.targets[positions]),
+                np.asarray(self.edge_types[positions]), np.asarray(self.outgoing[positions]))
+
+    def neighbourhood(self, seed, depth, limit):
+        """seed から depth ホップまでの関係を (元の名前, 種類, 先の名前) で最大 limit 件返す (幅優先)"""
+        triplets = []
+        seen = set()
+        visited = {seed}
+        frontier = np.array([seed], dtype=np.int64)
+        for _ in range(depth):
+            sources, targets, types, outgoing = self._edges(frontier)
+            for source, target, relation, forward in zip(sources.tolist(), targets.tolist(), types.tolist(),
+                                                         outgoing.tolist()):
+                key = (source, relation, target) if forward else (target, relation, source)
+                if key in seen:
+                    continue
+                seen.add(key)
+                triplets.append((self.names[key[0]], self.relation_types[relation], self.names[key[2]]))
+                if len(triplets) >= limit:
+                    return triplets
+            following = np.setdiff1d(np.unique(targets), np.fromiter(visited, dtype=np.int64))
+            if not len(following):
+                break
+            visited.update(following.tolist())
+            frontier = following
+        return triplets
+
+    def chunks(self, entity, limit):
+        """エンティティを参照するチャンクの (id, 本文) を最大 limit 件返す"""
+        if not self.has_chunks or limit <= 0:
+            return []
+        start, end = int(self.chunk_indptr[entity]), int(self.chunk_indptr[entity + 1])
+        return [(self.chunk_ids[chunk], self.chunk_texts[chunk])
+                for chunk in self.chunk_targets[start:min(end, start + limit)].tolist()]
+
+
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = threading.Lock()
+
+
+def open_snapshot(directory):
+    """同じプロセス内ではスナップショットを1回だけ開いて共有する"""
+    with _SNAPSHOTS_LOCK:
+        if directory not in _SNAPSHOTS:
+            _SNAPSHOTS[directory] = CsrSnapshot(directory)
+        return _SNAPSHOTS[directory]
+
+
+def reload_snapshot(directory):
+    """作り直したスナップショットを開き直し、共有している古いものと置き換える"""
+    with _SNAPSHOTS_LOCK:
+        _SNAPSHOTS[directory] = CsrSnapshot(directory)
+        return _SNAPSHOTS[directory]
+
+
+class SnapshotRetriever(BasePGRetriever):
+    """CSR スナップショットをプロセス内で探索するグラフ検索 (検索中に Neo4j へ往復しない)
+
+    結果の形は k ホップ検索 (KHopRetriever) と同じで、起点ごとのトリプレットの行とチャンクの本文を返す。
+    """
+
+    def __init__(self, graph_store, embed_model, snapshot, depth=2, seeds=4, limit=30, chunks=2,
+                 include_text=True, **kwargs: Any) -> None:
+        self._embed_model = embed_model
+        self._snapshot = snapshot
+        self._depth = depth
+        self._seeds = seeds
+        self._limit = limit
+        self._chunks = chunks
+        self._with_text = include_text
+        super().__init__(graph_store=graph_store, include_text=False, **kwargs)
+
+    def retrieve_from_graph(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        embedding = query_bundle.embedding or self._embed_model.get_query_embedding(query_bundle.query_str)
+        rows = []
+        for seed, score in self._snapshot.search(embedding, self._seeds):
+            rows.append({"seed": self._snapshot.names[seed], "score": score,
+                         "triplets": self._snapshot.neighbourhood(seed, self._depth, self._limit),
+                         "texts": self._snapshot.chunks(seed, self._chunks) if self._with_text else []})
+        return build_seed_nodes(rows, self._with_text)
+
+    async def aretrieve_from_graph(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return await asyncio.to_thread(self.retrieve_from_graph, query_bundle)
+
+
+def check_snapshot_version(args, snapshot):
+    """スナップショット作成後にグラフが更新されていれば警告する"""
+    try:
+        current = graph_version(args)
+    except Exception as e:
+        logging.warning(f"グラフのバージョンを確認できませんでした: {e}")
+        return
+    if snapshot.manifest.get("graph_version") != current:
+        logging.warning(f"スナップショット ({snapshot.manifest['created_at']}) の作成後にグラフが更新されています。"
+                        "csr_snapshot.py build で作り直してください")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="知識グラフを検索用の読み取り専用スナップショット (CSR 形式の隣接配列・\n"
+                                                 "エンティティ名の表・正規化した埋め込み行列) に書き出します。\n"
+                                                 "質問時に --retrieval-mode snapshot を指定すると、memory-map して\n"
+                                                 "プロセス内で探索します (検索中に Neo4j へ往復しない)。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="スナップショットを作成する (既存のものは置き換える)",
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    build_parser.add_argument("--snapshot-dir", default=DEFAULT_SNAPSHOT_DIR,
+                              help=f"書き出し先ディレクトリ (既定: {DEFAULT_SNAPSHOT_DIR})")
+    build_parser.add_argument("--no-chunks", action="store_true", help="チャンクの本文を含めない")
+    build_parser.add_argument("--fetch-size", type=int, default=5000,
+                              help="Neo4j から1回に受け取るレコード数 (既定: 5000)")
+    add_backend_arguments(build_parser)
+    info_parser = subparsers.add_parser("info", help="スナップショットの内容を表示する")
+    info_parser.add_argument("--snapshot-dir", default=DEFAULT_SNAPSHOT_DIR,
+                             help=f"スナップショットのディレクトリ (既定: {DEFAULT_SNAPSHOT_DIR})")
+
+    args = parser.parse_args()
+
+    if args.command == "info":
+        if not os.path.exists(os.path.join(args.snapshot_dir, MANIFEST_FILE)):
+            print(f"スナップショットが見つかりません: {args.snapshot_dir}")
+            exit(1)
+        snapshot = CsrSnapshot(args.snapshot_dir)
+        print(json.dumps(snapshot.manifest, ensure_ascii=False, indent=2))
+        exit(0)
+
+    driver = None
+    try:
+        version = graph_version(args)
+        if args.graph_store == "neo4j":
+            driver = create_driver(args)
+            source = Neo4jSnapshotSource(driver, args.neo4j_database, args.collection, args.fetch_size)
+        else:
+            from llama_index.core.embeddings import MockEmbedding
+            from llama_index.core.llms import MockLLM
+            from graph_backend import load_index
+
+            # 保存済みの埋め込みを読むだけなので、LLM・埋め込みモデルは呼ばない
+            source = SimpleSnapshotSource(load_index(args, MockEmbedding(embed_dim=1), llm=MockLLM()))
+        manifest = build_snapshot(source, args.snapshot_dir, version, include_chunks=not args.no_chunks)
+    except Exception as e:
+        print(f"スナップショットの作成中にエラーが発生しました: {e}")
+        exit(1)
+    finally:
+        if driver is not None:
+            driver.close()
+    print(f"スナップショットを作成しました: {args.snapshot_dir} "
+          f"(エンティティ {manifest['entities']}, 関係 {manifest['relations']}, チャンク {manifest['chunks']}, "
+          f"次元 {manifest['dimensions']}, {manifest['seconds']:.1f} 秒)")
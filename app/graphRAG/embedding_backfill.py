@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import logging
+import tenacity
+from concurrent.futures import ThreadPoolExecutor
+from graph_backend import NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE, bump_graph_version
+from graph_snapshot import BASE_NODE_LABEL, BASE_ENTITY_LABEL, create_driver
+from ingest_estimate import estimate_tokens
+
+DEFAULT_CHECKPOINT_PATH = ".embedding_backfill.json"
+DEFAULT_EMBED_MODEL = "amazon.titan-embed-text-v2:0"
+CHUNK_LABEL = "Chunk"
+
+# 対象の種類ごとのラベル (チャンクも __Node__ を持つため、id の一意制約の索引で順に辿れる)
+TARGET_LABELS = {
+    "entity": f"`{BASE_ENTITY_LABEL}`",
+    "chunk": f"`{BASE_NODE_LABEL}`:`{CHUNK_LABEL}`",
+}
+
+# id の順に after より後ろのノードを limit 件取得する (キーセットページング)
+PAGE_QUERY = """
+MATCH (n:{label})
+WHERE n.id > $after {missing}
+RETURN n.id AS id, n.name AS name, n.text AS text, n{{.*, embedding: null, id: null, name: null, text: null}} AS properties
+ORDER BY n.id
+LIMIT $limit
+"""
+
+WRITE_QUERY = f"""
+UNWIND $rows AS row
+MATCH (n:`{BASE_NODE_LABEL}` {{id: row.id}})
+WITH n, row
+CALL db.create.setNodeVectorProperty(n, 'embedding', row.embedding)
+RETURN count(*) AS updated
+"""
+
+
+def entity_text(record, mode):
+    """エンティティの埋め込み対象のテキスト
+
+    node: 投入時と同じ (EntityNode の文字列表現 = 名前とプロパティ) / name: 名前だけ
+    """
+    if mode == "name":
+        return record["name"]
+    from llama_index.core.graph_stores.types import EntityNode
+    from llama_index.graph_stores.neo4j.neo4j_property_graph import remove_empty_values
+
+    return str(EntityNode(name=record["name"], properties=remove_empty_values(record["properties"])))
+
+
+def chunk_text(record, mode):
+    """チャンクの埋め込み対象のテキスト
+
+    embed: 投入時と同じ (埋め込み対象のメタデータを付けた本文) / text: 本文だけ
+    """
+    text = record["text"] or ""
+    if mode == "text" or "_node_content" not in record["properties"]:
+        return text
+    from llama_index.core.schema import MetadataMode
+    from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+    node = metadata_dict_to_node(record["properties"], text=text)
+    return node.get_content(metadata_mode=MetadataMode.EMBED)
+
+
+def backfill_fingerprint(args):
+    """チェックポイントを区別するキー (モデル・次元・テキストの作り方が変わったら最初からやり直す)"""
+    settings = {"model": args.model, "dimensions": args.dimensions,
+                "entity_text": args.entity_text, "chunk_text": args.chunk_text,
+                "only_missing": args.only_missing, "database": args.neo4j_database}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class Checkpoint:
+    """対象の種類ごとに書き込み済みの最後の id を保存する JSON ファイル"""
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.data = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def get(self, target):
+        return self.data.get(self.fingerprint, {}).get(target, "")
+
+    def put(self, target, last_id):
+        self.data.setdefault(self.fingerprint, {})[target] = last_id
+        if not self.path:
+            return
+        # 書き込み途中で止まってもファイルが壊れないよう、一時ファイルから置き換える
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(temporary, self.path)
+
+    def reset(self):
+        self.data.pop(self.fingerprint, None)
+
+
+def iter_pages(driver, database, target, after, page_size, only_missing):
+    """キーセットページングで対象ノードを page_size 件ずつ返す"""
+    query = PAGE_QUERY.format(label=TARGET_LABELS[target],
+                              missing="AND n.embedding IS NULL" if only_missing else "")
+    while True:
+        records, _, _ = driver.execute_query(query, after=after, limit=page_size, database_=database)
+        if not records:
+            return
+        yield [record.data() for record in records]
+        after = records[-1]["id"]
+
+
+def backfill_target(driver, database, embedding, target, text_mode, checkpoint,
+                    page_size=500, embed_batch_size=16, concurrency=8, only_missing=False):
+    """1種類の対象ノードを再埋め込みし、ページごとにまとめて書き戻す (抽出はやり直さない)"""
+    to_text = entity_text if target == "entity" else chunk_text
+
+    @tenacity.retry(stop=tenacity.stop_after_attempt(3),
+                    wait=tenacity.wait_exponential(min=2, max=30),
+                    retry=tenacity.retry_if_exception_type(Exception),
+                    before_sleep=tenacity.before_sleep_log(logging, logging.WARNING))
+    def embed_batch(texts):
+        return embedding.get_text_embedding_batch(texts)
+
+    after = checkpoint.get(target)
+    if after:
+        logging.info(f"{target}: チェックポイントから再開します (id > {after})")
+    updated = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed") as executor:
+        for page in iter_pages(driver, database, target, after, page_size, only_missing):
+            texts = [to_text(record, text_mode) for record in page]
+            batches = [texts[i:i + embed_batch_size] for i in range(0, len(texts), embed_batch_size)]
+            vectors = [vector for batch in executor.map(embed_batch, batches) for vector in batch]
+            rows = [{"id": record["id"], "embedding": vector} for record, vector in zip(page, vectors)]
+            driver.execute_query(WRITE_QUERY, rows=rows, database_=database)
+            updated += len(rows)
+            checkpoint.put(target, page[-1]["id"])
+            elapsed = time.perf_counter() - started
+            logging.info(f"{target}: {updated} 件更新 ({updated / elapsed:.1f} 件/秒, 最後の id {page[-1]['id']})")
+    return updated
+
+
+def estimate_backfill(driver, database, targets, entity_mode, chunk_mode, only_missing, page_size):
+    """Bedrock を呼ばずに対象ノード数と埋め込みの入力トークン数 (見積もり値) を数える"""
+    totals = {}
+    for target in targets:
+        to_text = entity_text if target == "entity" else chunk_text
+        mode = entity_mode if target == "entity" else chunk_mode
+        nodes = 0
+        tokens = 0
+        for page in iter_pages(driver, database, target, "", page_size, only_missing):
+            nodes += len(page)
+            tokens += sum(estimate_tokens(to_text(record, mode)) for record in page)
+        totals[target] = {"nodes": nodes, "tokens": tokens}
+    return totals
+
+
+if __name__ == "__main__":
+    import boto3
+    from bedrock_archive import create_bedrock_client
+    from botocore.config import Config
+    from llama_index.embeddings.bedrock import BedrockEmbedding
+
+    logging.basicConfig(level=logging.INFO)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="Neo4jのエンティティ・チャンクの埋め込みを作り直します (抽出はやり直しません)。\n"
+                                                 "id の順にページ単位で読み出し、並列に埋め込んでまとめて書き戻します。\n"
+                                                 "中断してもチェックポイントから再開できます。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--neo4j-url", default=NEO4J_URL, help="Neo4jの接続URL")
+    parser.add_argument("--neo4j-username", default=NEO4J_USERNAME, help="Neo4jのユーザー名")
+    parser.add_argument("--neo4j-password", default=NEO4J_PASSWORD, help="Neo4jのパスワード")
+    parser.add_argument("--neo4j-database", default=NEO4J_DATABASE, help="Neo4jのデータベース名")
+    parser.add_argument("--targets", nargs="+", choices=list(TARGET_LABELS), default=list(TARGET_LABELS),
+                        help="再埋め込みする対象 (既定: entity chunk)")
+    parser.add_argument("--model", default=DEFAULT_EMBED_MODEL,
+                        help=f"埋め込みモデルのID (既定: {DEFAULT_EMBED_MODEL})")
+    parser.add_argument("--dimensions", type=int, choices=[256, 512, 1024],
+                        help="埋め込みの次元 (titan-embed-text-v2 のみ, 省略時はモデルの既定)")
+    parser.add_argument("--entity-text", choices=["node", "name"], default="node",
+                        help="エンティティの埋め込み対象\n"
+                             "  node: 投入時と同じ (名前とプロパティ, 既定)\n"
+                             "  name: 名前だけ")
+    parser.add_argument("--chunk-text", choices=["embed", "text"], default="embed",
+                        help="チャンクの埋め込み対象\n"
+                             "  embed: 投入時と同じ (メタデータ付きの本文, 既定)\n"
+                             "  text : 本文だけ")
+    parser.add_argument("--only-missing", action="store_true",
+                        help="埋め込みが無いノードだけを対象にする")
+    parser.add_argument("--page-size", type=int, default=500,
+                        help="1回に読み出し・書き戻すノード数 (既定: 500)")
+    parser.add_argument("--embed-batch-size", type=int, default=16,
+                        help="1スレッドがまとめて埋め込むテキスト数 (既定: 16)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="埋め込みの並列数 (既定: 8)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_PATH,
+                        help=f"進捗を保存するファイル (既定: {DEFAULT_CHECKPOINT_PATH})")
+    parser.add_argument("--restart", action="store_true",
+                        help="チェックポイントを無視して最初からやり直す")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Bedrock を呼ばずに対象ノード数と入力トークン数 (見積もり値) を表示する")
+
+    args = parser.parse_args()
+
+    driver = create_driver(args)
+    try:
+        if args.dry_run:
+            totals = estimate_backfill(driver, args.neo4j_database, args.targets, args.entity_text,
+                                       args.chunk_text, args.only_missing, args.page_size)
+            for target, total in totals.items():
+                print(f"{target}: {total['nodes']} ノード, 入力 {total['tokens']} トークン (見積もり)")
+            exit(0)
+
+        session = boto3.Session(
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            region_name=os.getenv('AWS_DEFAULT_REGION')
+        )
+        # 並列数に合わせてHTTP接続プールを広げる
+        bedrock_client = create_bedrock_client(session,
+                                               config=Config(max_pool_connections=max(10, args.concurrency)))
+        embedding = BedrockEmbedding(
+            model_name=args.model,
+            client=bedrock_client,
+            additional_kwargs={"dimensions": args.dimensions} if args.dimensions else {},
+        )
+
+        checkpoint = Checkpoint(args.checkpoint, backfill_fingerprint(args))
+        if args.restart:
+            checkpoint.reset()
+        for target in args.targets:
+            mode = args.entity_text if target == "entity" else args.chunk_text
+            updated = backfill_target(driver, args.neo4j_database, embedding, target, mode, checkpoint,
+                                      page_size=args.page_size,
+                                      embed_batch_size=args.embed_batch_size,
+                                      concurrency=args.concurrency,
+                                      only_missing=args.only_missing)
+            print(f"{target}: {updated} 件の埋め込みを更新しました")
+        # ノード・リレーション数は変わらないため、変更スタンプで検索結果が変わったことを知らせる
+        bump_graph_version(driver, args.neo4j_database)
+    except Exception as e:
+        print(f"埋め込みの更新中にエラーが発生しました: {e}")
+        exit(1)
+    finally:
+        driver.close()
+
+    if args.model != DEFAULT_EMBED_MODEL or args.dimensions:
+        print("※ 質問の埋め込みにも同じモデル・次元を使う必要があります。"
+              "次元が変わった場合は graph_maintenance.py stats で混在が無いことを確認してください")
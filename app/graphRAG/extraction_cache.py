@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any, Sequence
+from pydantic import PrivateAttr
+from llama_index.core.graph_stores.types import EntityNode, Relation, KG_NODES_KEY, KG_RELATIONS_KEY
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+# 抽出結果の形式やキーの作り方を変えた場合はこの値を上げて既存キャッシュを無効にする
+EXTRACTOR_CACHE_VERSION = "1"
+
+DEFAULT_EXTRACT_CACHE_PATH = os.getenv("EXTRACT_CACHE_PATH")
+
+
+class ExtractionCache:
+    """チャンク単位のトリプレット抽出結果を保存するローカルキャッシュ
+
+    SQLite の1ファイルに、JSONを zlib 圧縮したBLOBとして保存する。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extraction_cache ("
+            " key TEXT PRIMARY KEY,"
+            " payload BLOB NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM extraction_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def put(self, key, payload):
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, payload, created_at) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM extraction_cache").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _model_id(extractor):
+    """抽出器が使用するLLMのモデルIDを返す (LLMを使わない抽出器は空文字)"""
+    llm = getattr(extractor, "llm", None)
+    if llm is None:
+        return ""
+    return getattr(llm, "model", None) or llm.metadata.model_name
+
+
+def extractor_fingerprint(extractor):
+    """抽出器の種類・プロンプト・抽出件数の設定からバージョン文字列を作る"""
+    parts = [EXTRACTOR_CACHE_VERSION, extractor.class_name()]
+    prompt = getattr(extractor, "extract_prompt", None)
+    if prompt is not None:
+        parts.append(hashlib.sha256(prompt.get_template().encode("utf-8")).hexdigest()[:16])
+    max_paths = getattr(extractor, "max_paths_per_chunk", None)
+    if max_paths is not None:
+        parts.append(str(max_paths))
+    return ":".join(parts)
+
+
+class CachedPathExtractor(TransformComponent):
+    """既存の抽出器をラップし、同一チャンクの抽出結果をキャッシュから返す
+
+    キーは「LLMに渡すチャンク本文のハッシュ・モデルID・抽出器のバージョン」から作る。
+    キャッシュに無いチャンクだけをまとめて内側の抽出器に渡す。
+    """
+
+    extractor: TransformComponent
+
+    _cache: Any = PrivateAttr()
+    _model_id: str = PrivateAttr()
+    _fingerprint: str = PrivateAttr()
+    _hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+
+    def __init__(self, extractor: TransformComponent, cache: ExtractionCache, **kwargs: Any) -> None:
+        super().__init__(extractor=extractor, **kwargs)
+        self._cache = cache
+        self._model_id = _model_id(extractor)
+        self._fingerprint = extractor_fingerprint(extractor)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedPathExtractor"
+
+    @property
+    def stats(self):
+        return {"hits": self._hits, "misses": self._misses}
+
+    def cache_key(self, node: BaseNode) -> str:
+        text = node.get_content(metadata_mode=MetadataMode.LLM)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{digest}:{self._model_id}:{self._fingerprint}"
+
+    @staticmethod
+    def _serialize(metadata, kg_nodes, kg_relations):
+        """抽出結果を保存用の辞書にする (チャンクのメタデータと同じプロパティは保存しない)"""
+        def own_properties(properties):
+            return {k: v for k, v in properties.items() if metadata.get(k) != v}
+
+        if any(not isinstance(kg_node, EntityNode) for kg_node in kg_nodes):
+            return None
+        return {
+            "nodes": [{"name": n.name, "label": n.label, "properties": own_properties(n.properties)}
+                      for n in kg_nodes],
+            "relations": [{"label": r.label, "source_id": r.source_id, "target_id": r.target_id,
+                           "properties": own_properties(r.properties)}
+                          for r in kg_relations],
+        }
+
+    @staticmethod
+    def _deserialize(metadata, payload):
+        kg_nodes = [EntityNode(name=n["name"], label=n["label"], properties={**metadata, **n["properties"]})
+                    for n in payload["nodes"]]
+        kg_relations = [Relation(label=r["label"], source_id=r["source_id"], target_id=r["target_id"],
+                                 properties={**metadata, **r["properties"]})
+                        for r in payload["relations"]]
+        return kg_nodes, kg_relations
+
+    def __call__(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> Sequence[BaseNode]:
+        return asyncio.run(self.acall(nodes, show_progress=show_progress, **kwargs))
+
+    async def acall(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> Sequence[BaseNode]:
+        misses = []
+        for node in nodes:
+            # 先行する抽出器の結果はキーと内側の抽出器の入力から外しておく
+            existing_nodes = node.metadata.pop(KG_NODES_KEY, [])
+            existing_relations = node.metadata.pop(KG_RELATIONS_KEY, [])
+            key = self.cache_key(node)
+            payload = self._cache.get(key)
+            if payload is None:
+                misses.append((node, key, existing_nodes, existing_relations))
+                continue
+            kg_nodes, kg_relations = self._deserialize(node.metadata, payload)
+            node.metadata[KG_NODES_KEY] = existing_nodes + kg_nodes
+            node.metadata[KG_RELATIONS_KEY] = existing_relations + kg_relations
+            self._hits += 1
+
+        if misses:
+            self._misses += len(misses)
+            await self.extractor.acall([node for node, _, _, _ in misses], show_progress=show_progress, **kwargs)
+            for node, key, existing_nodes, existing_relations in misses:
+                kg_nodes = node.metadata.pop(KG_NODES_KEY, [])
+                kg_relations = node.metadata.pop(KG_RELATIONS_KEY, [])
+                payload = self._serialize(node.metadata, kg_nodes, kg_relations)
+                if payload is not None:
+                    self._cache.put(key, payload)
+                node.metadata[KG_NODES_KEY] = existing_nodes + kg_nodes
+                node.metadata[KG_RELATIONS_KEY] = existing_relations + kg_relations
+
+        logging.info(f"抽出キャッシュ: ヒット {self._hits} / ミス {self._misses}")
+        return nodes
+
+
+def add_cache_arguments(parser):
+    """抽出キャッシュ用の引数を追加する"""
+    group = parser.add_argument_group('抽出キャッシュ')
+    group.add_argument("--extract-cache", default=DEFAULT_EXTRACT_CACHE_PATH,
+                       help="トリプレット抽出結果を保存するSQLiteファイルのパス\n"
+                            "(指定した場合、同じチャンク・モデル・抽出器の組み合わせではLLMを呼び出さない)")
+    return group
@@ -0,0 +1,203 @@
+import os
+import re
+import asyncio
+import logging
+import unicodedata
+from typing import Any, List, Optional, Sequence
+from llama_index.core.graph_stores.types import EntityNode, Relation, KG_NODES_KEY, KG_RELATIONS_KEY
+from llama_index.core.indices.property_graph import SimpleLLMPathExtractor, ImplicitPathExtractor
+from llama_index.core.schema import BaseNode, TransformComponent
+from extraction_cache import CachedPathExtractor, ExtractionCache
+
+# 日本の特許公報の書誌事項 (NFKC正規化後のテキストに適用する)
+NUMBER_PATTERN = re.compile(r"【(公開番号|出願番号|特許番号|公表番号)】\s*([^\s(【]+)")
+DATE_PATTERN = re.compile(r"【(出願日|公開日|優先日|登録日)】\s*([^\n(【]+)")
+TITLE_PATTERN = re.compile(r"【発明の名称】\s*([^\n【]+)")
+PARTY_PATTERN = re.compile(
+    r"【(出願人|発明者|代理人|特許権者)】"
+    r"(?:(?!【(?:出願人|発明者|代理人|特許権者)】).)*?"
+    r"【氏名(?:又は名称)?】\s*([^\n【]+)",
+    re.S,
+)
+# 各ページのヘッダー (例: "JP 2025-27833 A 2025.2.28")
+HEADER_PATTERN = re.compile(r"\bJP\s+(\d{4}-\d+)\s+([AB]\d?)\s+(\d{4}\.\d{1,2}\.\d{1,2})")
+# フロントページのINIDコード付き書誌事項 (例: "(72)発明者 里園 健")
+INID_PARTY_PATTERN = re.compile(r"\(7[1-4]\)(出願人|発明者|代理人|特許権者)[ \t]+([^\n]+)")
+F_TERM_PATTERN = re.compile(r"Fターム\(参考\)\s*(\d[A-Z]\d{3})((?:\s+[A-Z]{2}\d{2})+)")
+REFERENCE_SIGN_SECTION_PATTERN = re.compile(r"【符号の説明】(.*?)(?=\n\(\d+\) JP|【図|\Z)", re.S)
+REFERENCE_SIGN_PATTERN = re.compile(r"^[ \t]*([A-Z]?\d+)[ \t]{2,}(\S[^\n]*)$", re.M)
+CITATION_PATTERN = re.compile(r"【(特許文献|非特許文献)\d+】\s*([^\n【]+)")
+IPC_PATTERN = re.compile(r"(?<![A-Za-z0-9])([A-H]\d{2}[A-Z])\s*(\d{1,4}/\d{2,6})")
+CLAIM_PATTERN = re.compile(r"【請求項(\d+)】")
+CLAIM_REFERENCE_PATTERN = re.compile(
+    r"請求項(\d+)(?:(?:から|乃至|~|〜)(?:請求項)?(\d+))?(?:の)?(?:いずれか(?:一|1)項)?に記載"
+)
+
+PARTY_LABELS = {"出願人": "組織", "特許権者": "組織", "代理人": "人物", "発明者": "人物"}
+
+
+def _document_name(metadata):
+    """チャンクの出典からグラフ上の文献エンティティ名を決める"""
+    source = metadata.get("source") or metadata.get("title") or ""
+    return os.path.basename(str(source)) or "文献"
+
+
+class PatentRuleExtractor(TransformComponent):
+    """特許公報の書誌事項・IPC・請求項を正規表現で抽出する (LLMを使わない)"""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PatentRuleExtractor"
+
+    def extract(self, text, metadata):
+        """テキストから (主語, 関係, 目的語, 目的語のラベル) の一覧を返す"""
+        text = unicodedata.normalize("NFKC", text)
+        document = _document_name(metadata)
+        paths = []
+        for number, kind, date in HEADER_PATTERN.findall(text):
+            paths.append((document, "公報番号", f"JP {number} {kind}", "番号"))
+            paths.append((document, "発行日", date, "日付"))
+        for field, value in NUMBER_PATTERN.findall(text):
+            paths.append((document, field, value.strip(), "番号"))
+        for field, value in DATE_PATTERN.findall(text):
+            paths.append((document, field, value.strip(), "日付"))
+        for value in TITLE_PATTERN.findall(text):
+            paths.append((document, "発明の名称", value.strip(), "発明"))
+        for role, name in PARTY_PATTERN.findall(text):
+            paths.append((document, role, name.strip(), PARTY_LABELS[role]))
+        for role, name in INID_PARTY_PATTERN.findall(text):
+            paths.append((document, role, name.strip(), PARTY_LABELS[role]))
+        for theme, codes in F_TERM_PATTERN.findall(text):
+            for code in codes.split():
+                paths.append((document, "Fターム", f"{theme} {code}", "Fターム"))
+        for section in REFERENCE_SIGN_SECTION_PATTERN.findall(text):
+            for _, component in REFERENCE_SIGN_PATTERN.findall(section):
+                paths.append((document, "構成要素", component.strip(), "構成要素"))
+        for kind, value in CITATION_PATTERN.findall(text):
+            paths.append((document, kind, value.strip(), "文献"))
+        for subclass, group in IPC_PATTERN.findall(text):
+            paths.append((document, "国際特許分類", f"{subclass} {group}", "IPC"))
+
+        # 請求項の見出しごとに区切り、引用している請求項を関係として抽出する
+        claims = list(CLAIM_PATTERN.finditer(text))
+        for i, match in enumerate(claims):
+            claim = f"請求項{match.group(1)}"
+            paths.append((document, "請求項を含む", claim, "請求項"))
+            end = claims[i + 1].start() if i + 1 < len(claims) else len(text)
+            for start_ref, end_ref in CLAIM_REFERENCE_PATTERN.findall(text[match.end():end]):
+                first = int(start_ref)
+                last = int(end_ref) if end_ref else first
+                for number in range(first, min(last, first + 50) + 1):
+                    paths.append((claim, "引用する", f"請求項{number}", "請求項"))
+
+        # 同じ関係の重複を除く (順序は保持)
+        return list(dict.fromkeys(paths))
+
+    def _extract_node(self, node: BaseNode) -> BaseNode:
+        existing_nodes = node.metadata.pop(KG_NODES_KEY, [])
+        existing_relations = node.metadata.pop(KG_RELATIONS_KEY, [])
+
+        metadata = node.metadata.copy()
+        for subj, rel, obj, obj_label in self.extract(node.get_content(), metadata):
+            subj_label = "請求項" if subj.startswith("請求項") else "文献"
+            subj_node = EntityNode(name=subj, label=subj_label, properties=metadata)
+            obj_node = EntityNode(name=obj, label=obj_label, properties=metadata)
+            existing_nodes.extend([subj_node, obj_node])
+            existing_relations.append(Relation(
+                label=rel,
+                source_id=subj_node.id,
+                target_id=obj_node.id,
+                properties=metadata,
+            ))
+
+        node.metadata[KG_NODES_KEY] = existing_nodes
+        node.metadata[KG_RELATIONS_KEY] = existing_relations
+        return node
+
+    def __call__(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> Sequence[BaseNode]:
+        return [self._extract_node(node) for node in nodes]
+
+
+class TieredPathExtractor(TransformComponent):
+    """ルールベースの抽出器を先に適用し、抽出できた関係が少ないチャンクだけLLM抽出器に渡す
+
+    Args:
+        rule_extractors: LLMを使わない抽出器の一覧 (順に適用する)
+        llm_extractor: 残ったチャンクに適用する抽出器
+        min_rule_paths: この件数以上の関係がルールで取れたチャンクはLLMを呼び出さない
+    """
+
+    rule_extractors: List[TransformComponent]
+    llm_extractor: Optional[TransformComponent] = None
+    min_rule_paths: int = 3
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TieredPathExtractor"
+
+    def __call__(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> Sequence[BaseNode]:
+        return asyncio.run(self.acall(nodes, show_progress=show_progress, **kwargs))
+
+    async def acall(self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any) -> Sequence[BaseNode]:
+        for extractor in self.rule_extractors:
+            nodes = await extractor.acall(nodes, show_progress=show_progress, **kwargs)
+
+        remaining = [node for node in nodes
+                     if len(node.metadata.get(KG_RELATIONS_KEY, [])) < self.min_rule_paths]
+        logging.info(f"ルール抽出で完結したチャンク: {len(nodes) - len(remaining)}/{len(nodes)}")
+        if remaining and self.llm_extractor is not None:
+            await self.llm_extractor.acall(remaining, show_progress=show_progress, **kwargs)
+        return nodes
+
+
+def build_kg_extractors(args, llm):
+    """引数で選択された抽出器の構成を作る"""
+    llm_extractor = SimpleLLMPathExtractor(
+        llm=llm,
+        num_workers=args.num_workers,
+        max_paths_per_chunk=args.max_paths_per_chunk,
+    )
+    # 抽出キャッシュが指定された場合はLLM抽出器をキャッシュでラップする
+    if args.extract_cache:
+        llm_extractor = CachedPathExtractor(llm_extractor, ExtractionCache(args.extract_cache))
+
+    if args.extractors == "llm":
+        first = llm_extractor
+    elif args.extractors == "rule":
+        first = PatentRuleExtractor()
+    elif args.extractors == "tiered":
+        first = TieredPathExtractor(
+            rule_extractors=[PatentRuleExtractor()],
+            llm_extractor=llm_extractor,
+            min_rule_paths=args.min_rule_paths,
+        )
+    else:
+        raise ValueError(f"Unknown extractors: {args.extractors}")
+    return [first, ImplicitPathExtractor()]
+
+
+def llm_chunk_filter(args):
+    """抽出器の構成において、チャンクがLLM抽出に回るかを判定する関数を返す (見積もり・予算用)"""
+    if args.extractors == "llm":
+        return lambda chunk: True
+    if args.extractors == "rule":
+        return lambda chunk: False
+    rule_extractor = PatentRuleExtractor()
+    return lambda chunk: len(rule_extractor.extract(chunk, {})) < args.min_rule_paths
+
+
+def add_extractor_arguments(parser):
+    """抽出器の構成を選択する引数を追加する"""
+    group = parser.add_argument_group('抽出器')
+    group.add_argument("--extractors", choices=["llm", "rule", "tiered"], default="llm",
+                       help="トリプレット抽出器の構成\n"
+                            "  llm   : 全チャンクをLLMで抽出 (既定)\n"
+                            "  rule  : 特許公報の書誌事項・IPC・請求項をルールで抽出 (LLMを使わない)\n"
+                            "  tiered: ルール抽出を先に行い、関係が少ないチャンクだけLLMで抽出")
+    group.add_argument("--num-workers", type=int, default=4,
+                       help="LLM抽出の並列数 (既定: 4)")
+    group.add_argument("--max-paths-per-chunk", type=int, default=10,
+                       help="1チャンクあたりにLLMで抽出するトリプレットの上限 (既定: 10)")
+    group.add_argument("--min-rule-paths", type=int, default=3,
+                       help="tiered 構成でLLMを省略するのに必要なルール抽出の関係数 (既定: 3)")
+    return group
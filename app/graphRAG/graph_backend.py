@@ -0,0 +1,192 @@
+import os
+import re
+import argparse
+import logging
+from llama_index.core import PropertyGraphIndex, StorageContext, load_index_from_storage
+from llama_index.core.graph_stores import SimplePropertyGraphStore
+
+# Neo4jへの接続設定 (環境変数で上書き可能)
+NEO4J_URL = os.getenv("NEO4J_URL", "bolt://neo4j:7687")
+NEO4J_USERNAME = os.getenv("NEO4J_USERNAME", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "password")
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
+
+# 組み込みストアの永続化先
+DEFAULT_PERSIST_DIR = os.getenv("GRAPH_PERSIST_DIR", "./graph_storage")
+
+BACKENDS = ["neo4j", "simple"]
+
+# 既定のコレクション (未指定の場合はグラフ全体を対象にする)
+DEFAULT_COLLECTION = os.getenv("GRAPH_COLLECTION")
+
+_COLLECTION_NAME_PATTERN = re.compile(r"^\w+$")
+
+
+def validate_collection(name):
+    """コレクション名を検証する (ラベル名・索引名に使うため英数字・アンダースコア・日本語のみ)"""
+    if not _COLLECTION_NAME_PATTERN.match(name):
+        raise ValueError(f"コレクション名に使用できない文字が含まれています: {name}")
+    return name
+
+
+def _collection_argument(value):
+    try:
+        return validate_collection(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_backend_arguments(parser):
+    """投入・質問の両スクリプトで共通のグラフストア関連の引数を追加する"""
+    group = parser.add_argument_group('グラフストア')
+    group.add_argument("--graph-store", choices=BACKENDS, default="neo4j",
+                       help="グラフストアの種類\n"
+                            "  neo4j : Bolt経由でNeo4jコンテナに接続 (既定)\n"
+                            "  simple: プロセス内のプロパティグラフをローカルファイルに永続化")
+    group.add_argument("--persist-dir", default=DEFAULT_PERSIST_DIR,
+                       help=f"simple ストアの永続化ディレクトリ (既定: {DEFAULT_PERSIST_DIR})")
+    group.add_argument("--neo4j-url", default=NEO4J_URL, help="Neo4jの接続URL")
+    group.add_argument("--neo4j-username", default=NEO4J_USERNAME, help="Neo4jのユーザー名")
+    group.add_argument("--neo4j-password", default=NEO4J_PASSWORD, help="Neo4jのパスワード")
+    group.add_argument("--neo4j-database", default=NEO4J_DATABASE, help="Neo4jのデータベース名")
+    group.add_argument("--collection", type=_collection_argument, default=DEFAULT_COLLECTION,
+                       help="投入・検索の対象とするコレクション名 (省略した場合はグラフ全体)\n"
+                            "  neo4j : エンティティにコレクションのラベルを付け、専用のベクトルインデックスで検索\n"
+                            "  simple: 永続化ディレクトリの下にコレクションごとのディレクトリを作成")
+    return group
+
+
+def create_graph_store(args, **driver_kwargs):
+    """Neo4jPropertyGraphStore を作成する (コレクション指定時は検索をコレクション内に限定するストア)
+
+    driver_kwargs は neo4j ドライバーの設定 (max_connection_pool_size など) としてそのまま渡す。
+    """
+    from llama_index.graph_stores.neo4j import Neo4jPropertyGraphStore
+
+    connection = dict(
+        username=args.neo4j_username,
+        password=args.neo4j_password,
+        url=args.neo4j_url,
+        database=args.neo4j_database,
+        **driver_kwargs,
+    )
+    if args.collection:
+        from graph_collections import CollectionNeo4jPropertyGraphStore
+
+        return CollectionNeo4jPropertyGraphStore(collection=args.collection, **connection)
+    return Neo4jPropertyGraphStore(**connection)
+
+
+def _persist_dir(args):
+    """simple ストアの永続化ディレクトリ (コレクションごとに分ける)"""
+    if args.collection:
+        return os.path.join(args.persist_dir, validate_collection(args.collection))
+    return args.persist_dir
+
+
+def _has_persisted_store(persist_dir):
+    return os.path.exists(os.path.join(persist_dir, "index_store.json"))
+
+
+def load_index(args, embedding, **index_kwargs):
+    """引数で選択されたバックエンドから PropertyGraphIndex を作成する
+
+    simple ストアは永続化ディレクトリがあればそこからロードし、無ければ空のインデックスを作成する。
+    """
+    if args.graph_store == "neo4j":
+        return PropertyGraphIndex.from_existing(
+            embed_model=embedding,
+            property_graph_store=create_graph_store(args),
+            show_progress=True,
+            **index_kwargs,
+        )
+
+    persist_dir = _persist_dir(args)
+    if _has_persisted_store(persist_dir):
+        logging.info(f"組み込みグラフストアをロード中: {persist_dir}")
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        return load_index_from_storage(
+            storage_context,
+            embed_model=embedding,
+            show_progress=True,
+            **index_kwargs,
+        )
+
+    logging.info(f"組み込みグラフストアを新規作成します: {persist_dir}")
+    return PropertyGraphIndex(
+        nodes=[],
+        property_graph_store=SimplePropertyGraphStore(),
+        embed_model=embedding,
+        show_progress=True,
+        **index_kwargs,
+    )
+
+
+# 書き込みのたびに進める変更スタンプのノード (__Node__ を付けないため検索・書き出しの対象にならない)
+GRAPH_VERSION_LABEL = "__GraphVersion__"
+
+BUMP_GRAPH_VERSION_QUERY = f"""
+MERGE (v:`{GRAPH_VERSION_LABEL}` {{id: 'graph'}})
+SET v.version = coalesce(v.version, 0) + 1, v.updated_at = datetime()
+RETURN v.version AS version
+"""
+
+# 変更スタンプとノード・リレーション数 (数は Neo4j のカウントストアから定数時間で取得できる)
+GRAPH_VERSION_QUERY = f"""
+CALL () {{ MATCH (n) RETURN count(n) AS nodes }}
+CALL () {{ MATCH ()-[r]->() RETURN count(r) AS relationships }}
+OPTIONAL MATCH (v:`{GRAPH_VERSION_LABEL}` {{id: 'graph'}})
+RETURN v.version AS stamp, nodes, relationships
+"""
+
+
+def bump_graph_version(driver, database):
+    """グラフを書き換えた後に変更スタンプを進め、新しいスタンプを返す
+
+    ノード・リレーション数が変わらない書き換え (プロパティ・埋め込みの更新、同数の削除と追加) も
+    graph_version に反映させるため、Neo4j に書き込む処理は最後にこれを呼ぶ。
+    """
+    records, _, _ = driver.execute_query(BUMP_GRAPH_VERSION_QUERY, database_=database)
+    return records[0]["version"]
+
+
+def mark_graph_updated(args, index):
+    """インデックス経由で書き込んだ後に変更スタンプを進める (simple は persist_index のファイル更新で判定する)"""
+    if args.graph_store != "neo4j":
+        return
+    index.property_graph_store.structured_query(BUMP_GRAPH_VERSION_QUERY)
+
+
+def graph_version(args):
+    """グラフが更新されたかを判定するためのバージョン文字列を返す (インデックスはロードしない)
+
+    neo4j は変更スタンプとノード・リレーション数、simple は永続化ファイルの更新日時とサイズから作る。
+    """
+    if args.graph_store == "neo4j":
+        import neo4j
+
+        with neo4j.GraphDatabase.driver(args.neo4j_url, auth=(args.neo4j_username, args.neo4j_password),
+                                        notifications_min_severity="OFF") as driver:
+            records, _, _ = driver.execute_query(GRAPH_VERSION_QUERY, database_=args.neo4j_database)
+        record = records[0]
+        return f"neo4j:{record['stamp'] or 0}:{record['nodes']}:{record['relationships']}"
+
+    persist_dir = _persist_dir(args)
+    if not _has_persisted_store(persist_dir):
+        return "simple:empty"
+    stamps = []
+    for name in sorted(os.listdir(persist_dir)):
+        path = os.path.join(persist_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stamps.append(f"{name}:{stat.st_mtime_ns}:{stat.st_size}")
+    return "simple:" + ",".join(stamps)
+
+
+def persist_index(args, index):
+    """simple ストアの場合はインデックスをローカルファイルに書き出す"""
+    if args.graph_store != "simple":
+        return
+    persist_dir = _persist_dir(args)
+    index.storage_context.persist(persist_dir=persist_dir)
+    logging.info(f"組み込みグラフストアを保存しました: {persist_dir}")
@@ -0,0 +1,278 @@
+from typing import Any, List, Optional, Tuple
+from llama_index.core.graph_stores.types import ChunkNode, EntityNode, LabelledNode, Relation, Triplet
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from llama_index.graph_stores.neo4j import Neo4jPropertyGraphStore
+from llama_index.graph_stores.neo4j.neo4j_property_graph import (BASE_ENTITY_LABEL, BASE_NODE_LABEL, CHUNK_SIZE,
+                                                                 VECTOR_INDEX_NAME, convert_operator,
+                                                                 remove_empty_values)
+from graph_backend import validate_collection
+
+# コレクションはエンティティに付けるラベルで表す (Community Edition では複数データベースを使えないため)
+COLLECTION_LABEL_PREFIX = "Collection_"
+# チャンクは別のラベルにする (エンティティのラベルに張ったベクトルインデックスにチャンクを入れないため)
+COLLECTION_CHUNK_LABEL_PREFIX = "CollectionChunk_"
+# リレーションはラベルを持てないため、属するコレクション名の一覧をこのプロパティに持たせる
+COLLECTIONS_PROPERTY = "collections"
+
+
+def collection_label(name):
+    return COLLECTION_LABEL_PREFIX + validate_collection(name)
+
+
+def collection_chunk_label(name):
+    return COLLECTION_CHUNK_LABEL_PREFIX + validate_collection(name)
+
+
+def collection_index(name):
+    """コレクション専用のベクトルインデックス名"""
+    return f"{VECTOR_INDEX_NAME}_{validate_collection(name)}"
+
+
+def _type_expression(variable):
+    """ノードの種類 (内部ラベルとコレクションのラベルを除いた最初のラベル) を返す式"""
+    return (f"[l in labels({variable}) WHERE NOT l IN ['{BASE_ENTITY_LABEL}', '{BASE_NODE_LABEL}'] "
+            f"AND NOT l STARTS WITH '{COLLECTION_LABEL_PREFIX}' "
+            f"AND NOT l STARTS WITH '{COLLECTION_CHUNK_LABEL_PREFIX}' | l][0]")
+
+
+class CollectionNeo4jPropertyGraphStore(Neo4jPropertyGraphStore):
+    """エンティティをコレクションのラベルで区切り、検索をコレクション内に限定する Neo4jPropertyGraphStore
+
+    - 投入したエンティティにはコレクションのラベル、チャンクにはコレクションのチャンク用ラベルを付け、
+      リレーションには collections プロパティにコレクション名を加える (複数のコレクションに属することもある)
+    - ベクトル検索はコレクションのラベルに張った専用のベクトルインデックスを使う
+    - グラフの探索はパス上のエンティティ・リレーションがすべてコレクションに属するものに限る
+    共有されたエンティティでも、他のコレクションで投入したリレーション・チャンクは返さない。
+    """
+
+    def __init__(self, *args: Any, collection: str, **kwargs: Any) -> None:
+        self.collection = validate_collection(collection)
+        self.collection_label = collection_label(collection)
+        self.collection_index = collection_index(collection)
+        self.collection_chunk_label = collection_chunk_label(collection)
+        super().__init__(*args, **kwargs)
+        if self._supports_vector_index:
+            self.structured_query(
+                f"CREATE VECTOR INDEX `{self.collection_index}` IF NOT EXISTS "
+                f"FOR (m:`{self.collection_label}`) ON m.embedding"
+            )
+
+    def upsert_nodes(self, nodes: List[LabelledNode]) -> None:
+        super().upsert_nodes(nodes)
+        entity_ids = [node.id for node in nodes if isinstance(node, EntityNode)]
+        for index in range(0, len(entity_ids), CHUNK_SIZE):
+            self.structured_query(
+                f"""
+                UNWIND $ids AS id
+                MATCH (e:`{BASE_ENTITY_LABEL}` {{id: id}})
+                SET e:`{self.collection_label}`
+                """,
+                param_map={"ids": entity_ids[index:index + CHUNK_SIZE]},
+            )
+        # チャンク自体と、エンティティの抽出元として MENTIONS で結ばれるチャンク
+        chunk_ids = sorted({node.id for node in nodes if isinstance(node, ChunkNode)}
+                           | {node.properties["triplet_source_id"] for node in nodes
+                              if isinstance(node, EntityNode) and node.properties.get("triplet_source_id")})
+        for index in range(0, len(chunk_ids), CHUNK_SIZE):
+            self.structured_query(
+                f"""
+                UNWIND $ids AS id
+                MATCH (c:`{BASE_NODE_LABEL}` {{id: id}})
+                WHERE NOT c:`{BASE_ENTITY_LABEL}`
+                SET c:`{self.collection_chunk_label}`
+                """,
+                param_map={"ids": chunk_ids[index:index + CHUNK_SIZE]},
+            )
+
+    def upsert_relations(self, relations: List[Relation]) -> None:
+        super().upsert_relations(relations)
+        rows = [{"source_id": relation.source_id, "target_id": relation.target_id, "label": relation.label}
+                for relation in relations]
+        for index in range(0, len(rows), CHUNK_SIZE):
+            self.structured_query(
+                f"""
+                UNWIND $rows AS row
+                MATCH (s:`{BASE_NODE_LABEL}` {{id: row.source_id}})-[r]->(t:`{BASE_NODE_LABEL}` {{id: row.target_id}})
+                WHERE type(r) = row.label AND NOT $collection IN coalesce(r.{COLLECTIONS_PROPERTY}, [])
+                SET r.{COLLECTIONS_PROPERTY} = coalesce(r.{COLLECTIONS_PROPERTY}, []) + $collection
+                """,
+                param_map={"rows": rows[index:index + CHUNK_SIZE], "collection": self.collection},
+            )
+
+    def get(self, properties: Optional[dict] = None, ids: Optional[List[str]] = None) -> List[LabelledNode]:
+        # エンティティ・チャンクともにコレクション内のものだけを返す
+        cypher_statement = (f"MATCH (e:`{BASE_NODE_LABEL}`) WHERE e.id IS NOT NULL "
+                            f"AND (e:`{self.collection_label}` OR e:`{self.collection_chunk_label}`) ")
+        params = {}
+        if ids:
+            cypher_statement += "AND e.id in $ids "
+            params["ids"] = ids
+        if properties:
+            for i, prop in enumerate(properties):
+                cypher_statement += f"AND e.`{prop}` = $property_{i} "
+                params[f"property_{i}"] = properties[prop]
+        cypher_statement += f"""
+        WITH e
+        RETURN e.id AS name,
+               {_type_expression('e')} AS type,
+               e{{.* , embedding: Null, id: Null}} AS properties
+        """
+        response = self.structured_query(cypher_statement, param_map=params) or []
+
+        nodes = []
+        for record in response:
+            if "text" in record["properties"] or record["type"] is None:
+                text = record["properties"].pop("text", "")
+                nodes.append(ChunkNode(id_=record["name"], text=text,
+                                       properties=remove_empty_values(record["properties"])))
+            else:
+                nodes.append(EntityNode(name=record["name"], label=record["type"],
+                                        properties=remove_empty_values(record["properties"])))
+        return nodes
+
+    def get_triplets(
+        self,
+        entity_names: Optional[List[str]] = None,
+        relation_names: Optional[List[str]] = None,
+        properties: Optional[dict] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[Triplet]:
+        conditions = []
+        params = {"collection": self.collection}
+        if entity_names:
+            conditions.append("e.name in $entity_names")
+            params["entity_names"] = entity_names
+        if ids:
+            conditions.append("e.id in $ids")
+            params["ids"] = ids
+        if properties:
+            for i, prop in enumerate(properties):
+                conditions.append(f"e.`{prop}` = $property_{i}")
+                params[f"property_{i}"] = properties[prop]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rel_types = ":`" + "`|`".join(relation_names) + "`" if relation_names else ""
+        entity = f"`{BASE_ENTITY_LABEL}`:`{self.collection_label}`"
+
+        data = self.structured_query(
+            f"""
+            MATCH (e:{entity}) {where}
+            MATCH (e)-[r{rel_types}]-(t:{entity})
+            WHERE $collection IN coalesce(r.{COLLECTIONS_PROPERTY}, [])
+            WITH startNode(r) AS s, r, endNode(r) AS t
+            RETURN DISTINCT s.name AS source_id, {_type_expression('s')} AS source_type,
+                   s{{.* , embedding: Null, name: Null}} AS source_properties,
+                   type(r) AS type, r{{.*}} AS rel_properties,
+                   t.name AS target_id, {_type_expression('t')} AS target_type,
+                   t{{.* , embedding: Null, name: Null}} AS target_properties
+            """,
+            param_map=params,
+        ) or []
+
+        triples = []
+        for record in data:
+            source = EntityNode(name=record["source_id"], label=record["source_type"],
+                                properties=remove_empty_values(record["source_properties"]))
+            target = EntityNode(name=record["target_id"], label=record["target_type"],
+                                properties=remove_empty_values(record["target_properties"]))
+            rel = Relation(source_id=record["source_id"], target_id=record["target_id"], label=record["type"],
+                           properties=remove_empty_values(record["rel_properties"]))
+            triples.append([source, rel, target])
+        return triples
+
+    def get_rel_map(
+        self,
+        graph_nodes: List[LabelledNode],
+        depth: int = 2,
+        limit: int = 30,
+        ignore_rels: Optional[List[str]] = None,
+    ) -> List[Triplet]:
+        ids = [node.id for node in graph_nodes]
+        # パス上のノード・リレーションがすべてコレクションに属する場合だけ辿る
+        response = self.structured_query(
+            f"""
+            WITH $ids AS id_list
+            UNWIND range(0, size(id_list) - 1) AS idx
+            MATCH (e:`{BASE_ENTITY_LABEL}`:`{self.collection_label}`)
+            WHERE e.id = id_list[idx]
+            MATCH p=(e)-[r*1..{depth}]-(other:`{self.collection_label}`)
+            WHERE ALL(rel in relationships(p) WHERE type(rel) <> 'MENTIONS'
+                      AND $collection IN coalesce(rel.{COLLECTIONS_PROPERTY}, []))
+              AND ALL(n in nodes(p) WHERE n:`{self.collection_label}`)
+            UNWIND relationships(p) AS rel
+            WITH distinct rel, idx
+            WITH startNode(rel) AS source, type(rel) AS type, rel{{.*}} AS rel_properties,
+                 endNode(rel) AS endNode, idx
+            LIMIT toInteger($limit)
+            RETURN source.id AS source_id, {_type_expression('source')} AS source_type,
+                   source{{.* , embedding: Null, id: Null}} AS source_properties,
+                   type, rel_properties,
+                   endNode.id AS target_id, {_type_expression('endNode')} AS target_type,
+                   endNode{{.* , embedding: Null, id: Null}} AS target_properties,
+                   idx
+            ORDER BY idx
+            LIMIT toInteger($limit)
+            """,
+            param_map={"ids": ids, "limit": limit, "collection": self.collection},
+        ) or []
+
+        ignore_rels = ignore_rels or []
+        triples = []
+        for record in response:
+            if record["type"] in ignore_rels:
+                continue
+            source = EntityNode(name=record["source_id"], label=record["source_type"],
+                                properties=remove_empty_values(record["source_properties"]))
+            target = EntityNode(name=record["target_id"], label=record["target_type"],
+                                properties=remove_empty_values(record["target_properties"]))
+            rel = Relation(source_id=record["source_id"], target_id=record["target_id"], label=record["type"],
+                           properties=remove_empty_values(record["rel_properties"]))
+            triples.append([source, rel, target])
+        return triples
+
+    def vector_query(self, query: VectorStoreQuery, **kwargs: Any) -> Tuple[List[LabelledNode], List[float]]:
+        entity = f"`{BASE_ENTITY_LABEL}`:`{self.collection_label}`"
+        if not query.filters and self._supports_vector_index:
+            # コレクション専用のインデックスを使うため、検索コストはコレクションの大きさで決まる
+            data = self.structured_query(
+                f"""CALL db.index.vector.queryNodes('{self.collection_index}', $limit, $embedding)
+                YIELD node, score
+                RETURN node.id AS name, {_type_expression('node')} AS type,
+                node{{.* , embedding: Null, name: Null, id: Null}} AS properties,
+                score
+                """,
+                param_map={"embedding": query.query_embedding, "limit": query.similarity_top_k},
+            )
+        else:
+            conditions = []
+            filter_params = {}
+            if query.filters:
+                for index, filter in enumerate(query.filters.filters):
+                    conditions.append(
+                        f"{'NOT' if filter.operator.value in ['nin'] else ''} e.`{filter.key}` "
+                        f"{convert_operator(filter.operator.value)} $param_{index}"
+                    )
+                    filter_params[f"param_{index}"] = filter.value
+            filters = f" {query.filters.condition.value} ".join(conditions) if conditions else "1 = 1"
+            data = self.structured_query(
+                f"""MATCH (e:{entity})
+                WHERE e.embedding IS NOT NULL AND size(e.embedding) = $dimension AND ({filters})
+                WITH e, vector.similarity.cosine(e.embedding, $embedding) AS score
+                ORDER BY score DESC LIMIT toInteger($limit)
+                RETURN e.id AS name, {_type_expression('e')} AS type,
+                e{{.* , embedding: Null, name: Null, id: Null}} AS properties,
+                score""",
+                param_map={
+                    "embedding": query.query_embedding,
+                    "dimension": len(query.query_embedding),
+                    "limit": query.similarity_top_k,
+                    **filter_params,
+                },
+            )
+
+        nodes = []
+        scores = []
+        for record in data or []:
+            nodes.append(EntityNode(name=record["name"], label=record["type"],
+                                    properties=remove_empty_values(record["properties"])))
+            scores.append(record["score"])
+        return nodes, scores
@@ -0,0 +1,263 @@
+import time
+import argparse
+import logging
+from graph_backend import NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE, bump_graph_version
+from graph_snapshot import BASE_NODE_LABEL, BASE_ENTITY_LABEL, VECTOR_INDEX_NAME, create_driver, ensure_indexes
+
+logging.basicConfig(level=logging.INFO)
+
+# llama_index がチャンクに付けるラベルと、チャンク→エンティティのリレーション
+CHUNK_LABEL = "Chunk"
+MENTIONS_TYPE = "MENTIONS"
+
+# 始点ノードを id 順に batch_size 件ずつ取り、同じ (始点, 型, 終点) のリレーションを1本に減らす
+# 一意制約のインデックスで id の範囲検索になるため、処理済みの範囲は再走査しない
+DEDUPE_RELATIONS_QUERY = f"""
+MATCH (s:`{BASE_NODE_LABEL}`) WHERE s.id > $after
+WITH s ORDER BY s.id ASC LIMIT $batch_size
+WITH collect(s) AS sources
+CALL (sources) {{
+  UNWIND sources AS s
+  MATCH (s)-[r]->(t)
+  WITH s, t, type(r) AS type, collect(r) AS rels
+  WHERE size(rels) > 1
+  FOREACH (r IN CASE WHEN $apply THEN tail(rels) ELSE [] END | DELETE r)
+  RETURN sum(size(rels) - 1) AS duplicates
+}}
+RETURN size(sources) AS scanned, sources[-1].id AS last_id, duplicates
+"""
+
+# どのエンティティからも参照されないチャンク (検索で到達できない)
+ORPHAN_CHUNK_PATTERN = f"MATCH (c:`{CHUNK_LABEL}`) WHERE NOT (c)-[:`{MENTIONS_TYPE}`]-()"
+
+DELETE_ORPHAN_CHUNKS_QUERY = f"""
+{ORPHAN_CHUNK_PATTERN}
+WITH c LIMIT $batch_size
+DETACH DELETE c
+RETURN count(*) AS deleted
+"""
+
+COUNT_ORPHAN_CHUNKS_QUERY = f"{ORPHAN_CHUNK_PATTERN} RETURN count(c) AS orphans"
+
+SHOW_INDEXES_QUERY = """
+SHOW INDEXES YIELD name, type, state, populationPercent, labelsOrTypes, properties, owningConstraint
+RETURN name, type, state, populationPercent, labelsOrTypes, properties, owningConstraint
+"""
+
+# 検索に必要な索引 (ラベル, プロパティ, 種類)
+REQUIRED_INDEXES = [
+    (BASE_NODE_LABEL, "id", "RANGE"),
+    (BASE_ENTITY_LABEL, "id", "RANGE"),
+    (BASE_ENTITY_LABEL, "embedding", "VECTOR"),
+]
+
+DEGREE_SUMMARY_QUERY = f"""
+MATCH (n:`{BASE_ENTITY_LABEL}`)
+WITH COUNT {{ (n)--() }} AS degree
+RETURN count(*) AS nodes, avg(degree) AS mean, max(degree) AS max,
+       percentileDisc(degree, 0.5) AS p50, percentileDisc(degree, 0.9) AS p90,
+       percentileDisc(degree, 0.99) AS p99,
+       sum(CASE WHEN degree = 0 THEN 1 ELSE 0 END) AS isolated
+"""
+
+# 次数を 2 の累乗ごとの区間 (0, 1, 2-3, 4-7, ...) に分けて数える
+DEGREE_HISTOGRAM_QUERY = f"""
+MATCH (n:`{BASE_ENTITY_LABEL}`)
+WITH COUNT {{ (n)--() }} AS degree
+WITH CASE WHEN degree = 0 THEN 0 ELSE toInteger(floor(log(degree) / log(2))) + 1 END AS bucket
+RETURN bucket, count(*) AS nodes ORDER BY bucket
+"""
+
+TOP_HUBS_QUERY = f"""
+MATCH (n:`{BASE_ENTITY_LABEL}`)
+WITH n, COUNT {{ (n)--() }} AS degree
+ORDER BY degree DESC LIMIT $limit
+RETURN n.id AS id, degree
+"""
+
+RELATION_TYPES_QUERY = """
+CALL db.relationshipTypes() YIELD relationshipType AS type
+CALL (type) { MATCH ()-[r]->() WHERE type(r) = type RETURN count(r) AS count }
+RETURN type, count ORDER BY count DESC
+"""
+
+EMBEDDING_DIMENSIONS_QUERY = f"""
+MATCH (n:`{BASE_ENTITY_LABEL}`)
+RETURN CASE WHEN n.embedding IS NULL THEN 0 ELSE size(n.embedding) END AS dimension, count(*) AS nodes
+ORDER BY nodes DESC
+"""
+
+
+def dedupe_relations(driver, database, batch_size, pause, apply):
+    """重複したリレーションを始点ノードの id 順に少しずつ削除する"""
+    after = ""
+    scanned = 0
+    duplicates = 0
+    while True:
+        records, _, _ = driver.execute_query(DEDUPE_RELATIONS_QUERY, after=after, batch_size=batch_size,
+                                             apply=apply, database_=database)
+        record = records[0]
+        if record["last_id"] is None:
+            break
+        after = record["last_id"]
+        scanned += record["scanned"]
+        duplicates += record["duplicates"] or 0
+        logging.info(f"リレーション重複: {scanned} ノード走査済み, 重複 {duplicates} 本")
+        time.sleep(pause)
+    return {"scanned_nodes": scanned, "duplicate_relations": duplicates}
+
+
+def delete_orphan_chunks(driver, database, batch_size, pause, apply):
+    """エンティティから参照されないチャンクを batch_size 件ずつ削除する"""
+    if not apply:
+        records, _, _ = driver.execute_query(COUNT_ORPHAN_CHUNKS_QUERY, database_=database)
+        return {"orphan_chunks": records[0]["orphans"]}
+
+    deleted = 0
+    while True:
+        records, _, _ = driver.execute_query(DELETE_ORPHAN_CHUNKS_QUERY, batch_size=batch_size,
+                                             database_=database)
+        count = records[0]["deleted"]
+        if count == 0:
+            break
+        deleted += count
+        logging.info(f"孤立チャンク: {deleted} 件削除済み")
+        time.sleep(pause)
+    return {"orphan_chunks": deleted}
+
+
+def check_indexes(driver, database, rebuild, apply):
+    """必要な索引の有無と状態を確認し、apply が指定された場合は不足分を作成する
+
+    rebuild が指定された場合は FAILED 状態の索引を削除して作り直す。
+    """
+    records, _, _ = driver.execute_query(SHOW_INDEXES_QUERY, database_=database)
+    indexes = [record.data() for record in records]
+
+    problems = []
+    for label, prop, index_type in REQUIRED_INDEXES:
+        found = [i for i in indexes
+                 if i["type"] == index_type and label in (i["labelsOrTypes"] or []) and prop in (i["properties"] or [])]
+        if not found:
+            problems.append(f"索引がありません: {index_type} :{label}({prop})")
+    for index in indexes:
+        if index["state"] != "ONLINE":
+            problems.append(f"索引 {index['name']} の状態が {index['state']} です "
+                            f"({index['populationPercent']:.0f}% 作成済み)")
+
+    if not apply:
+        return {"indexes": len(indexes), "problems": problems}
+
+    if rebuild:
+        for index in indexes:
+            if index["state"] != "FAILED":
+                continue
+            # 制約に属する索引は制約ごと作り直す
+            if index["owningConstraint"]:
+                statement = f"DROP CONSTRAINT `{index['owningConstraint']}` IF EXISTS"
+            else:
+                statement = f"DROP INDEX `{index['name']}` IF EXISTS"
+            logging.warning(f"索引を作り直します: {statement}")
+            driver.execute_query(statement, database_=database)
+
+    # 不足分の作成 (既にあるものは IF NOT EXISTS で何もしない)
+    ensure_indexes(driver, database)
+    return {"indexes": len(indexes), "problems": problems}
+
+
+def degree_statistics(driver, database, top):
+    """エンティティの次数分布・リレーション型ごとの件数・埋め込みの次元を集計する"""
+    summary, _, _ = driver.execute_query(DEGREE_SUMMARY_QUERY, database_=database)
+    histogram, _, _ = driver.execute_query(DEGREE_HISTOGRAM_QUERY, database_=database)
+    hubs, _, _ = driver.execute_query(TOP_HUBS_QUERY, limit=top, database_=database)
+    relation_types, _, _ = driver.execute_query(RELATION_TYPES_QUERY, database_=database)
+    dimensions, _, _ = driver.execute_query(EMBEDDING_DIMENSIONS_QUERY, database_=database)
+    return {
+        "summary": summary[0].data(),
+        "histogram": [record.data() for record in histogram],
+        "hubs": [record.data() for record in hubs],
+        "relation_types": [record.data() for record in relation_types],
+        "embedding_dimensions": [record.data() for record in dimensions],
+    }
+
+
+def format_statistics(stats):
+    """集計結果を表示用の文字列にする"""
+    summary = stats["summary"]
+    lines = [
+        f"エンティティ数: {summary['nodes']} (孤立 {summary['isolated']})",
+        f"次数: 平均 {summary['mean'] or 0:.1f}, 中央値 {summary['p50']}, 90% {summary['p90']}, "
+        f"99% {summary['p99']}, 最大 {summary['max']}",
+        "次数の分布:",
+    ]
+    largest = max((row["nodes"] for row in stats["histogram"]), default=1)
+    for row in stats["histogram"]:
+        bucket = row["bucket"]
+        low, high = (0, 0) if bucket == 0 else (2 ** (bucket - 1), 2 ** bucket - 1)
+        label = str(low) if low == high else f"{low}-{high}"
+        bar = "#" * max(1, int(40 * row["nodes"] / largest))
+        lines.append(f"  {label:>11} | {bar} {row['nodes']}")
+    lines.append("次数の大きいエンティティ:")
+    lines.extend(f"  {row['id']}: {row['degree']}" for row in stats["hubs"])
+    lines.append("リレーション型ごとの件数:")
+    lines.extend(f"  {row['type']}: {row['count']}" for row in stats["relation_types"])
+    lines.append("埋め込みの次元 (0 は埋め込み無し):")
+    lines.extend(f"  {row['dimension']}: {row['nodes']}" for row in stats["embedding_dimensions"])
+    if len([row for row in stats["embedding_dimensions"] if row["dimension"]]) > 1:
+        lines.append(f"  ※ 次元の異なる埋め込みが混在しています (ベクトルインデックス {VECTOR_INDEX_NAME} の対象外になります)")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="知識グラフの重複・孤立ノードの整理と索引・次数分布の確認を行います。\n"
+                                                 "小さなトランザクションに分けて実行するため、質問応答の実行中でも使用できます。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--neo4j-url", default=NEO4J_URL, help="Neo4jの接続URL")
+    parser.add_argument("--neo4j-username", default=NEO4J_USERNAME, help="Neo4jのユーザー名")
+    parser.add_argument("--neo4j-password", default=NEO4J_PASSWORD, help="Neo4jのパスワード")
+    parser.add_argument("--neo4j-database", default=NEO4J_DATABASE, help="Neo4jのデータベース名")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="1トランザクションあたりのノード数 (既定: 1000)")
+    parser.add_argument("--pause", type=float, default=0.1,
+                        help="バッチ間の待ち時間 (秒, 既定: 0.1)。質問応答への影響を抑える")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="削除せずに件数だけ数える")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("dedupe", help="同じエンティティ間の同じ型のリレーションを1本にする")
+    subparsers.add_parser("orphans", help="エンティティから参照されないチャンクを削除する")
+    indexes_parser = subparsers.add_parser("indexes", help="索引の有無と状態を確認し、不足分を作成する")
+    indexes_parser.add_argument("--rebuild", action="store_true",
+                                help="FAILED 状態の索引を削除して作り直す (作り直し中は検索が遅くなる)")
+    stats_parser = subparsers.add_parser("stats", help="次数分布・リレーション型・埋め込みの次元を表示する")
+    stats_parser.add_argument("--top", type=int, default=10, help="表示する次数の大きいエンティティの件数 (既定: 10)")
+    all_parser = subparsers.add_parser("all", help="dedupe → orphans → indexes → stats の順にすべて実行する")
+    all_parser.add_argument("--rebuild", action="store_true", help="indexes の --rebuild と同じ")
+    all_parser.add_argument("--top", type=int, default=10, help="stats の --top と同じ")
+
+    args = parser.parse_args()
+    apply = not args.dry_run
+
+    driver = create_driver(args)
+    try:
+        if args.command in ("dedupe", "all"):
+            result = dedupe_relations(driver, args.neo4j_database, args.batch_size, args.pause, apply)
+            print(f"リレーションの重複{'削除' if apply else '(ドライラン)'}: {result}")
+        if args.command in ("orphans", "all"):
+            result = delete_orphan_chunks(driver, args.neo4j_database, args.batch_size, args.pause, apply)
+            print(f"孤立チャンク{'削除' if apply else '(ドライラン)'}: {result}")
+        if apply and args.command in ("dedupe", "orphans", "all"):
+            bump_graph_version(driver, args.neo4j_database)
+        if args.command in ("indexes", "all"):
+            result = check_indexes(driver, args.neo4j_database, args.rebuild, apply)
+            print(f"索引: {result['indexes']} 件")
+            for problem in result["problems"]:
+                print(f"  {problem}")
+        if args.command in ("stats", "all"):
+            print(format_statistics(degree_statistics(driver, args.neo4j_database, args.top)))
+    except Exception as e:
+        print(f"メンテナンス中にエラーが発生しました: {e}")
+        exit(1)
+    finally:
+        driver.close()
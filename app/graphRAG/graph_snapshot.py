@@ -0,0 +1,315 @@
+import os
+import json
+import argparse
+import logging
+import datetime
+import neo4j
+import pyarrow as pa
+import pyarrow.parquet as pq
+from graph_backend import NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE, bump_graph_version
+
+logging.basicConfig(level=logging.INFO)
+
+# llama_index の Neo4jPropertyGraphStore が使用するラベル
+BASE_NODE_LABEL = "__Node__"
+BASE_ENTITY_LABEL = "__Entity__"
+VECTOR_INDEX_NAME = "entity"
+
+NODES_FILE = "nodes.parquet"
+RELATIONS_FILE = "relations.parquet"
+MANIFEST_FILE = "manifest.json"
+
+# 列として保持するためプロパティJSONから除外するキー
+RESERVED_KEYS = ("id", "name", "text", "embedding")
+
+NODE_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("labels", pa.list_(pa.string())),
+    ("name", pa.string()),
+    ("text", pa.string()),
+    ("properties", pa.string()),
+    ("embedding", pa.list_(pa.float32())),
+])
+
+RELATION_SCHEMA = pa.schema([
+    ("source", pa.string()),
+    ("target", pa.string()),
+    ("type", pa.string()),
+    ("properties", pa.string()),
+])
+
+EXPORT_NODES_QUERY = f"""
+MATCH (n:`{BASE_NODE_LABEL}`)
+RETURN n.id AS id, labels(n) AS labels, n.name AS name, n.text AS text,
+       properties(n) AS properties, n.embedding AS embedding
+"""
+
+EXPORT_RELATIONS_QUERY = f"""
+MATCH (s:`{BASE_NODE_LABEL}`)-[r]->(t:`{BASE_NODE_LABEL}`)
+RETURN s.id AS source, t.id AS target, type(r) AS type, properties(r) AS properties
+"""
+
+IMPORT_NODES_QUERY = f"""
+UNWIND $rows AS row
+MERGE (n:`{BASE_NODE_LABEL}` {{id: row.id}})
+SET n += row.properties
+WITH n, row
+CALL apoc.create.addLabels(n, row.labels) YIELD node
+WITH n, row
+WHERE row.embedding IS NOT NULL
+CALL db.create.setNodeVectorProperty(n, 'embedding', row.embedding)
+RETURN count(*)
+"""
+
+IMPORT_RELATIONS_QUERY = f"""
+UNWIND $rows AS row
+MATCH (s:`{BASE_NODE_LABEL}` {{id: row.source}})
+MATCH (t:`{BASE_NODE_LABEL}` {{id: row.target}})
+CALL apoc.merge.relationship(s, row.type, {{}}, row.properties, t) YIELD rel
+RETURN count(*)
+"""
+
+
+def create_driver(args):
+    """引数の接続情報からNeo4jドライバーを作成する"""
+    return neo4j.GraphDatabase.driver(args.neo4j_url,
+                                      auth=(args.neo4j_username, args.neo4j_password),
+                                      notifications_min_severity="OFF")
+
+
+def ensure_indexes(driver, database):
+    """一括投入前に一意制約とベクトルインデックスを作成する"""
+    statements = [
+        f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:`{BASE_NODE_LABEL}`) REQUIRE n.id IS UNIQUE",
+        f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:`{BASE_ENTITY_LABEL}`) REQUIRE n.id IS UNIQUE",
+        f"CREATE VECTOR INDEX {VECTOR_INDEX_NAME} IF NOT EXISTS FOR (m:`{BASE_ENTITY_LABEL}`) ON m.embedding",
+    ]
+    for statement in statements:
+        driver.execute_query(statement, database_=database)
+
+
+def _split_properties(properties):
+    """列として持つキーを除いたプロパティをJSON文字列にする"""
+    rest = {k: v for k, v in (properties or {}).items() if k not in RESERVED_KEYS and v is not None}
+    return json.dumps(rest, ensure_ascii=False, default=str)
+
+
+def _write_stream(records, path, schema, to_row, batch_size):
+    """レコードを batch_size 件ずつ row group として書き出す (全件をメモリに載せない)"""
+    count = 0
+    rows = []
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for record in records:
+            rows.append(to_row(record))
+            if len(rows) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                count += len(rows)
+                logging.info(f"{os.path.basename(path)}: {count} 件書き出し済み")
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            count += len(rows)
+    return count
+
+
+def export_graph(driver, database, output_dir, batch_size):
+    """グラフ全体 (エンティティ・チャンク・リレーション・埋め込み) をParquetに書き出す"""
+    os.makedirs(output_dir, exist_ok=True)
+    embedding_dim = None
+
+    def node_row(record):
+        nonlocal embedding_dim
+        embedding = record["embedding"]
+        if embedding is not None and embedding_dim is None:
+            embedding_dim = len(embedding)
+        return {
+            "id": record["id"],
+            "labels": [label for label in record["labels"] if label != BASE_NODE_LABEL],
+            "name": record["name"],
+            "text": record["text"],
+            "properties": _split_properties(record["properties"]),
+            "embedding": embedding,
+        }
+
+    def relation_row(record):
+        return {
+            "source": record["source"],
+            "target": record["target"],
+            "type": record["type"],
+            "properties": _split_properties(record["properties"]),
+        }
+
+    with driver.session(database=database, fetch_size=batch_size) as session:
+        node_count = _write_stream(session.run(EXPORT_NODES_QUERY),
+                                   os.path.join(output_dir, NODES_FILE),
+                                   NODE_SCHEMA, node_row, batch_size)
+        relation_count = _write_stream(session.run(EXPORT_RELATIONS_QUERY),
+                                       os.path.join(output_dir, RELATIONS_FILE),
+                                       RELATION_SCHEMA, relation_row, batch_size)
+
+    manifest = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "nodes": node_count,
+        "relations": relation_count,
+        "embedding_dim": embedding_dim,
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def _node_params(row):
+    """Parquetの1行をAPOC投入用のパラメータに戻す"""
+    properties = json.loads(row["properties"])
+    if row["name"] is not None:
+        properties["name"] = row["name"]
+    if row["text"] is not None:
+        properties["text"] = row["text"]
+    return {
+        "id": row["id"],
+        "labels": row["labels"] or [],
+        "properties": properties,
+        "embedding": row["embedding"],
+    }
+
+
+def _relation_params(row):
+    return {
+        "source": row["source"],
+        "target": row["target"],
+        "type": row["type"],
+        "properties": json.loads(row["properties"]),
+    }
+
+
+def _import_file(driver, database, path, query, to_params, batch_size):
+    """Parquetを batch_size 件ずつ読み、1バッチ1トランザクションで投入する"""
+    count = 0
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        rows = [to_params(row) for row in batch.to_pylist()]
+        driver.execute_query(query, rows=rows, database_=database)
+        count += len(rows)
+        logging.info(f"{os.path.basename(path)}: {count}/{parquet_file.metadata.num_rows} 件投入済み")
+    return count
+
+
+def import_graph(driver, database, input_dir, batch_size):
+    """export_graph で書き出したスナップショットを batched APOC で投入する"""
+    ensure_indexes(driver, database)
+    node_count = _import_file(driver, database, os.path.join(input_dir, NODES_FILE),
+                              IMPORT_NODES_QUERY, _node_params, batch_size)
+    # リレーションはノード投入後に行う
+    relation_count = _import_file(driver, database, os.path.join(input_dir, RELATIONS_FILE),
+                                  IMPORT_RELATIONS_QUERY, _relation_params, batch_size)
+    return {"nodes": node_count, "relations": relation_count}
+
+
+def _csv_value(value):
+    """neo4j-admin import 用にCSVセルの値を文字列化する"""
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def write_admin_csv(input_dir, output_dir, batch_size):
+    """スナップショットを neo4j-admin database import 用のCSVに変換する
+
+    プロパティキーはファイル全体を1度走査して列を確定させ、埋め込みは float[] 列として出力する。
+    """
+    import csv
+
+    os.makedirs(output_dir, exist_ok=True)
+    nodes_path = os.path.join(input_dir, NODES_FILE)
+    relations_path = os.path.join(input_dir, RELATIONS_FILE)
+
+    def collect_keys(path):
+        keys = set()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=["properties"]):
+            for properties in batch.column("properties").to_pylist():
+                keys.update(json.loads(properties).keys())
+        return sorted(keys)
+
+    node_keys = collect_keys(nodes_path)
+    relation_keys = collect_keys(relations_path)
+
+    with open(os.path.join(output_dir, "nodes.csv"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id:ID", ":LABEL", "name", "text", "embedding:float[]", *node_keys])
+        for batch in pq.ParquetFile(nodes_path).iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                properties = json.loads(row["properties"])
+                writer.writerow([
+                    row["id"],
+                    ";".join([BASE_NODE_LABEL, *row["labels"]]),
+                    _csv_value(row["name"]),
+                    _csv_value(row["text"]),
+                    ";".join(str(v) for v in row["embedding"]) if row["embedding"] else "",
+                    *[_csv_value(properties.get(key)) for key in node_keys],
+                ])
+
+    with open(os.path.join(output_dir, "relations.csv"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([":START_ID", ":END_ID", ":TYPE", *relation_keys])
+        for batch in pq.ParquetFile(relations_path).iter_batches(batch_size=batch_size):
+            for row in batch.to_pylist():
+                properties = json.loads(row["properties"])
+                writer.writerow([
+                    row["source"], row["target"], row["type"],
+                    *[_csv_value(properties.get(key)) for key in relation_keys],
+                ])
+
+    return (f"neo4j-admin database import full --overwrite-destination "
+            f"--multiline-fields=true "
+            f"--nodes={os.path.join(output_dir, 'nodes.csv')} "
+            f"--relationships={os.path.join(output_dir, 'relations.csv')} neo4j")
+
+
+if __name__ == "__main__":
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="知識グラフのスナップショットを書き出し/一括投入します。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--neo4j-url", default=NEO4J_URL, help="Neo4jの接続URL")
+    parser.add_argument("--neo4j-username", default=NEO4J_USERNAME, help="Neo4jのユーザー名")
+    parser.add_argument("--neo4j-password", default=NEO4J_PASSWORD, help="Neo4jのパスワード")
+    parser.add_argument("--neo4j-database", default=NEO4J_DATABASE, help="Neo4jのデータベース名")
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="1トランザクション/1 row group あたりの件数 (既定: 5000)")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="グラフをParquet (zstd圧縮) に書き出す")
+    export_parser.add_argument("snapshot_dir", help="書き出し先ディレクトリ")
+    import_parser = subparsers.add_parser("import", help="スナップショットを batched APOC で投入する")
+    import_parser.add_argument("snapshot_dir", help="スナップショットのディレクトリ")
+    csv_parser = subparsers.add_parser("admin-csv",
+                                       help="スナップショットを neo4j-admin database import 用CSVに変換する")
+    csv_parser.add_argument("snapshot_dir", help="スナップショットのディレクトリ")
+    csv_parser.add_argument("output_dir", help="CSVの出力先ディレクトリ")
+    subparsers.add_parser("indexes", help="制約とベクトルインデックスのみ作成する (neo4j-admin import 後に実行)")
+
+    args = parser.parse_args()
+
+    if args.command == "admin-csv":
+        command = write_admin_csv(args.snapshot_dir, args.output_dir, args.batch_size)
+        print("Neo4jを停止した状態で以下を実行し、その後 indexes サブコマンドを実行してください:")
+        print(command)
+        exit(0)
+
+    driver = create_driver(args)
+    try:
+        if args.command == "export":
+            result = export_graph(driver, args.neo4j_database, args.snapshot_dir, args.batch_size)
+            print(f"書き出し完了: {result}")
+        elif args.command == "import":
+            result = import_graph(driver, args.neo4j_database, args.snapshot_dir, args.batch_size)
+            bump_graph_version(driver, args.neo4j_database)
+            print(f"投入完了: {result}")
+        elif args.command == "indexes":
+            ensure_indexes(driver, args.neo4j_database)
+            # neo4j-admin import で入れ替えたグラフを、以前のグラフのキャッシュと区別する
+            bump_graph_version(driver, args.neo4j_database)
+            print("制約とインデックスを作成しました")
+    finally:
+        driver.close()
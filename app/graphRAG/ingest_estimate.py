@@ -0,0 +1,171 @@
+import threading
+from llama_index.core.prompts.default_prompts import DEFAULT_KG_TRIPLET_EXTRACT_TMPL
+
+# トークン数の概算係数 (Claude/Titan のトークナイザーは使わず文字種から見積もる)
+# ASCII は約4文字で1トークン、日本語などの非ASCII文字は約1文字で1トークンとして扱う
+ASCII_CHARS_PER_TOKEN = 4.0
+NON_ASCII_TOKENS_PER_CHAR = 1.0
+
+# SimpleLLMPathExtractor の既定値
+DEFAULT_MAX_PATHS_PER_CHUNK = 10
+# 1トリプレットあたりの出力トークン数と、新規エンティティ数の目安
+OUTPUT_TOKENS_PER_PATH = 20
+NEW_ENTITIES_PER_PATH = 1.2
+ENTITY_NAME_TOKENS = 8
+
+# 1呼び出しあたりのレイテンシ目安 (秒)
+DEFAULT_LLM_LATENCY_SEC = 3.0
+DEFAULT_EMBED_LATENCY_SEC = 0.15
+
+# 1000トークンあたりの料金 (USD, オンデマンド)
+HAIKU_INPUT_PRICE_PER_1K = 0.00025
+HAIKU_OUTPUT_PRICE_PER_1K = 0.00125
+TITAN_EMBED_PRICE_PER_1K = 0.00002
+
+
+def estimate_tokens(text):
+    """文字種からトークン数を概算する"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    non_ascii_chars = len(text) - ascii_chars
+    return int(ascii_chars / ASCII_CHARS_PER_TOKEN + non_ascii_chars * NON_ASCII_TOKENS_PER_CHAR) + 1
+
+
+# 抽出プロンプトの固定部分のトークン数
+PROMPT_OVERHEAD_TOKENS = estimate_tokens(DEFAULT_KG_TRIPLET_EXTRACT_TMPL)
+
+
+def estimate_chunk_cost(chunk, max_paths_per_chunk=DEFAULT_MAX_PATHS_PER_CHUNK, uses_llm=True):
+    """1チャンクを index.insert した場合の呼び出し数とトークン数を見積もる
+
+    uses_llm が False の場合 (ルール抽出で完結するチャンク) はLLM呼び出しを0として扱う。
+    """
+    chunk_tokens = estimate_tokens(chunk)
+    new_entities = int(max_paths_per_chunk * NEW_ENTITIES_PER_PATH)
+    llm_input = PROMPT_OVERHEAD_TOKENS + chunk_tokens if uses_llm else 0
+    llm_output = max_paths_per_chunk * OUTPUT_TOKENS_PER_PATH if uses_llm else 0
+    return {
+        "llm_calls": 1 if uses_llm else 0,
+        "llm_input_tokens": llm_input,
+        "llm_output_tokens": llm_output,
+        # チャンク本文と抽出されたエンティティをそれぞれ1回ずつ埋め込む
+        "embed_calls": 1 + new_entities,
+        "embed_tokens": chunk_tokens + new_entities * ENTITY_NAME_TOKENS,
+        "total_tokens": llm_input + llm_output,
+    }
+
+
+def estimate_ingest(chunks, concurrency=1, max_paths_per_chunk=DEFAULT_MAX_PATHS_PER_CHUNK,
+                    llm_latency=DEFAULT_LLM_LATENCY_SEC, embed_latency=DEFAULT_EMBED_LATENCY_SEC,
+                    needs_llm=None):
+    """チャンク列全体の呼び出し数・トークン数・料金・所要時間を見積もる"""
+    totals = {
+        "chunks": 0,
+        "characters": 0,
+        "llm_calls": 0,
+        "llm_input_tokens": 0,
+        "llm_output_tokens": 0,
+        "embed_calls": 0,
+        "embed_tokens": 0,
+    }
+    for chunk in chunks:
+        cost = estimate_chunk_cost(chunk, max_paths_per_chunk,
+                                   uses_llm=needs_llm is None or needs_llm(chunk))
+        totals["chunks"] += 1
+        totals["characters"] += len(chunk)
+        for key in ("llm_calls", "llm_input_tokens", "llm_output_tokens", "embed_calls", "embed_tokens"):
+            totals[key] += cost[key]
+
+    totals["cost_usd"] = (totals["llm_input_tokens"] / 1000 * HAIKU_INPUT_PRICE_PER_1K
+                          + totals["llm_output_tokens"] / 1000 * HAIKU_OUTPUT_PRICE_PER_1K
+                          + totals["embed_tokens"] / 1000 * TITAN_EMBED_PRICE_PER_1K)
+    serial_sec = totals["llm_calls"] * llm_latency + totals["embed_calls"] * embed_latency
+    totals["concurrency"] = concurrency
+    totals["wall_time_sec"] = serial_sec / max(concurrency, 1)
+    return totals
+
+
+def format_estimate(totals):
+    """見積もり結果を表示用の文字列にする"""
+    hours, rest = divmod(int(totals["wall_time_sec"]), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return "\n".join([
+        f"チャンク数          : {totals['chunks']} ({totals['characters']} 文字)",
+        f"Haiku 呼び出し数    : {totals['llm_calls']}",
+        f"  入力トークン      : {totals['llm_input_tokens']}",
+        f"  出力トークン      : {totals['llm_output_tokens']}",
+        f"Titan 呼び出し数    : {totals['embed_calls']} ({totals['embed_tokens']} トークン)",
+        f"概算料金            : ${totals['cost_usd']:.2f}",
+        f"概算所要時間        : {hours}時間{minutes}分{seconds}秒 (並列度 {totals['concurrency']})",
+    ])
+
+
+def chunk_priority(chunk):
+    """チャンクの情報量の目安 (異なる2文字組の割合) を返す
+
+    表や繰り返しの多いチャンクほど低くなり、予算が限られる場合は後回しにされる。
+    """
+    if len(chunk) < 2:
+        return 0.0
+    bigrams = {chunk[i:i + 2] for i in range(len(chunk) - 1)}
+    return len(bigrams) / (len(chunk) - 1)
+
+
+def select_chunks_within_budget(chunks, token_budget, max_paths_per_chunk=DEFAULT_MAX_PATHS_PER_CHUNK,
+                                needs_llm=None):
+    """優先度の高いチャンクから予算内に収まるものを選び、元の順序のインデックスで返す"""
+    ranked = sorted(range(len(chunks)), key=lambda i: chunk_priority(chunks[i]), reverse=True)
+    selected = []
+    spent = 0
+    for i in ranked:
+        tokens = estimate_chunk_cost(chunks[i], max_paths_per_chunk,
+                                     uses_llm=needs_llm is None or needs_llm(chunks[i]))["total_tokens"]
+        if spent + tokens > token_budget:
+            continue
+        spent += tokens
+        selected.append(i)
+    return sorted(selected)
+
+
+class TokenBudget:
+    """投入全体で消費できるLLMトークン数 (見積もり値) の上限を管理する"""
+
+    def __init__(self, limit, max_paths_per_chunk=DEFAULT_MAX_PATHS_PER_CHUNK, needs_llm=None):
+        self.limit = limit
+        self.max_paths_per_chunk = max_paths_per_chunk
+        self.needs_llm = needs_llm
+        self.spent = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def try_charge(self, chunk):
+        """チャンク分のトークンを予約できれば True、予算超過なら False を返す"""
+        if self.limit is None:
+            return True
+        uses_llm = self.needs_llm is None or self.needs_llm(chunk)
+        tokens = estimate_chunk_cost(chunk, self.max_paths_per_chunk, uses_llm=uses_llm)["total_tokens"]
+        with self._lock:
+            if self.spent + tokens > self.limit:
+                self.skipped += 1
+                return False
+            self.spent += tokens
+            return True
+
+
+def add_estimate_arguments(parser):
+    """ドライラン・予算関連の引数を追加する"""
+    group = parser.add_argument_group('見積もり・トークン予算')
+    group.add_argument("--dry-run", action="store_true",
+                       help="入力の解析とチャンク分割のみ行い、呼び出し数・トークン数・所要時間を見積もる")
+    group.add_argument("--concurrency", type=int, default=1,
+                       help="所要時間の見積もりに使う並列度 (既定: 1)")
+    group.add_argument("--llm-latency", type=float, default=DEFAULT_LLM_LATENCY_SEC,
+                       help=f"Haiku 1呼び出しあたりの想定秒数 (既定: {DEFAULT_LLM_LATENCY_SEC})")
+    group.add_argument("--embed-latency", type=float, default=DEFAULT_EMBED_LATENCY_SEC,
+                       help=f"Titan 1呼び出しあたりの想定秒数 (既定: {DEFAULT_EMBED_LATENCY_SEC})")
+    group.add_argument("--token-budget", type=int, default=None,
+                       help="投入で消費するLLMトークン数 (見積もり値) の上限")
+    group.add_argument("--budget-policy", choices=["stop", "prioritize"], default="stop",
+                       help="予算到達時の動作\n"
+                            "  stop      : 先頭から順に投入し、予算に達したら停止 (既定)\n"
+                            "  prioritize: 情報量の多いチャンクを優先して予算内で投入")
+    return group
@@ -0,0 +1,230 @@
+import os
+import time
+import queue
+import logging
+import threading
+from llama_index.core.schema import Document
+
+# 各ステージ間のキューで終端を知らせる番兵
+_DONE = object()
+
+
+def current_rss_mb():
+    """現在のプロセスの常駐メモリ (RSS) をMB単位で返す"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # /proc が無い環境ではピーク値で代用する
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def iter_source_pages(source_type, source_path, fetcher=None):
+    """入力ソースをページ単位で逐次読み込む (doc_index, text, metadata) を返すジェネレーター
+
+    PDFは全ページを1つのドキュメントとして扱い、メタデータは最初のページのものを使用する。
+    fetcher (AsyncFetcher) が指定された場合、wiki/web は並列に取得する。
+    """
+    if fetcher is not None and source_type in ("wiki", "web"):
+        from source_fetcher import expand_sources, fetch_sources
+
+        documents = fetch_sources(source_type, expand_sources(source_path), fetcher)
+        for doc_index, (text, metadata) in enumerate(documents):
+            yield doc_index, text, metadata
+    elif source_type == "wiki":
+        from llama_index.readers.wikipedia import WikipediaReader
+
+        reader = WikipediaReader()
+        for doc_index, document in enumerate(reader.load_data(pages=[source_path], lang_prefix="ja")):
+            yield doc_index, document.text, document.metadata
+    elif source_type == "pdf":
+        from langchain_community.document_loaders import PyPDFLoader
+
+        merged_metadata = None
+        for page in PyPDFLoader(source_path).lazy_load():
+            if merged_metadata is None:
+                merged_metadata = dict(page.metadata)
+                merged_metadata["source"] = source_path
+            yield 0, page.page_content, merged_metadata
+    elif source_type == "web":
+        from langchain_community.document_loaders import WebBaseLoader
+
+        for doc_index, page in enumerate(WebBaseLoader(source_path).lazy_load()):
+            yield doc_index, page.page_content, page.metadata
+    else:
+        raise ValueError(f"Unknown source type: {source_type}")
+
+
+def iter_chunks(pages, chunk_size):
+    """ページを改行で連結しながら chunk_size 文字ずつ切り出す
+
+    保持するのは未確定の端数だけなので、ドキュメント全体の結合テキストは作らない。
+    """
+    buffer = ""
+    current_doc = None
+    metadata = None
+    for doc_index, text, page_metadata in pages:
+        if doc_index != current_doc:
+            if buffer:
+                yield buffer, metadata
+            buffer = text
+            current_doc = doc_index
+            metadata = page_metadata
+        else:
+            buffer += "\n" + text
+        while len(buffer) >= chunk_size:
+            yield buffer[:chunk_size], metadata
+            buffer = buffer[chunk_size:]
+    if buffer:
+        yield buffer, metadata
+
+
+class IngestPipeline:
+    """ロード → チャンク分割 → 抽出/書き込み を上限付きキューで接続したパイプライン
+
+    抽出と書き込みは index.insert の中で一体に行われるため、同じワーカーが担当する。
+    キューが満杯になると上流のスレッドが待機するため、処理中のチャンク数は
+    max_inflight_chunks + workers で頭打ちになる。
+    """
+
+    def __init__(self, index, chunk_size=1000, max_inflight_chunks=8, workers=1,
+                 report_interval=30, page_queue_size=4, budget=None):
+        self.index = index
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.report_interval = report_interval
+        self.page_queue = queue.Queue(maxsize=page_queue_size)
+        self.chunk_queue = queue.Queue(maxsize=max_inflight_chunks)
+        self.budget = budget
+        self.budget_exhausted = False
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.pages_loaded = 0
+        self.chunks_created = 0
+        self.chunks_inserted = 0
+        self.peak_rss_mb = 0.0
+        self._lock = threading.Lock()
+
+    def _put(self, q, item):
+        """停止要求を確認しながらキューに投入する (満杯の間は待機する)"""
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fail(self, stage, error):
+        logging.error(f"パイプラインの {stage} ステージでエラーが発生しました: {error}")
+        with self._lock:
+            self.errors.append(error)
+        self.stop_event.set()
+
+    def _load(self, pages):
+        try:
+            for page in pages:
+                if not self._put(self.page_queue, page):
+                    return
+                self.pages_loaded += 1
+        except Exception as e:
+            self._fail("load", e)
+        finally:
+            self._put(self.page_queue, _DONE)
+
+    def _iter_page_queue(self):
+        while not self.stop_event.is_set():
+            try:
+                item = self.page_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _chunk(self):
+        try:
+            for chunk, metadata in iter_chunks(self._iter_page_queue(), self.chunk_size):
+                if not self._put(self.chunk_queue, (chunk, metadata)):
+                    return
+                self.chunks_created += 1
+        except Exception as e:
+            self._fail("chunk", e)
+        finally:
+            for _ in range(self.workers):
+                self._put(self.chunk_queue, _DONE)
+
+    def _insert(self):
+        while not self.stop_event.is_set():
+            try:
+                item = self.chunk_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            chunk, metadata = item
+            if self.budget is not None and not self.budget.try_charge(chunk):
+                # 予算到達はエラーではないため、上流を止めて正常終了させる
+                logging.warning("トークン予算に達したため、パイプラインを停止します")
+                self.budget_exhausted = True
+                self.stop_event.set()
+                return
+            try:
+                logging.info(f"チャンク内容: {chunk}")
+                self.index.insert(Document(text=chunk, metadata=metadata))
+            except Exception as e:
+                self._fail("extract/write", e)
+                return
+            with self._lock:
+                self.chunks_inserted += 1
+
+    def report(self):
+        """RSSと各キューの滞留数をログに出力する"""
+        rss = current_rss_mb()
+        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+        logging.info(f"[pipeline] RSS={rss:.1f}MB (peak {self.peak_rss_mb:.1f}MB) "
+                     f"pages_queue={self.page_queue.qsize()}/{self.page_queue.maxsize} "
+                     f"chunk_queue={self.chunk_queue.qsize()}/{self.chunk_queue.maxsize} "
+                     f"pages={self.pages_loaded} chunks={self.chunks_created} "
+                     f"inserted={self.chunks_inserted}")
+
+    def run(self, pages):
+        """パイプラインを実行し、全チャンクの投入が終わるまで待機する"""
+        threads = [threading.Thread(target=self._load, args=(pages,), name="pipeline-load", daemon=True),
+                   threading.Thread(target=self._chunk, name="pipeline-chunk", daemon=True)]
+        threads += [threading.Thread(target=self._insert, name=f"pipeline-insert-{i}", daemon=True)
+                    for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        last_report = time.monotonic()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=1.0)
+            if time.monotonic() - last_report >= self.report_interval:
+                self.report()
+                last_report = time.monotonic()
+        self.report()
+
+        if self.errors:
+            raise self.errors[0]
+        return self.chunks_inserted
+
+
+def add_pipeline_arguments(parser):
+    """パイプラインモード用の引数を追加する"""
+    group = parser.add_argument_group('パイプラインモード (メモリ上限付き投入)')
+    group.add_argument("--pipeline", action="store_true",
+                       help="ロード/チャンク分割/抽出・書き込みを上限付きキューで接続して投入する")
+    group.add_argument("--max-inflight-chunks", type=int,
+                       default=int(os.getenv("MAX_INFLIGHT_CHUNKS", "8")),
+                       help="チャンクキューの上限 (既定: 8)")
+    group.add_argument("--pipeline-workers", type=int, default=1,
+                       help="抽出・書き込みを行うワーカースレッド数 (既定: 1)")
+    group.add_argument("--report-interval", type=float, default=30,
+                       help="RSSとキュー滞留数を出力する間隔 (秒, 既定: 30)")
+    return group
@@ -0,0 +1,293 @@
+import boto3
+import os
+import time
+import signal
+import socket
+import argparse
+import logging
+import threading
+import multiprocessing
+import tenacity
+from bedrock_archive import create_bedrock_client
+from model_roles import create_role_llm
+from llama_index.embeddings.bedrock import BedrockEmbedding
+from llama_index.core.settings import Settings
+from llama_index.core.schema import TextNode
+from graph_backend import add_backend_arguments, load_index, mark_graph_updated, persist_index
+from ingest_pipeline import iter_source_pages, iter_chunks
+from extraction_cache import add_cache_arguments
+from extractors import add_extractor_arguments, build_kg_extractors
+from source_fetcher import add_fetch_arguments, create_fetcher
+from work_queue import DEFAULT_QUEUE_PATH, ChunkQueue
+
+logging.basicConfig(level=logging.INFO)
+
+# boto3セッションの初期化
+session = boto3.Session(
+    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+    region_name=os.getenv('AWS_DEFAULT_REGION')
+)
+
+# BEDROCK_ARCHIVE_MODE=record/replay の場合は要求・応答を記録/再生するクライアントになる
+bedrock_client = create_bedrock_client(session)
+
+# LLMとEmbeddingの設定
+# 抽出専用のモデル・同時呼び出し数を使い、質問応答のクォータを圧迫しない (model_roles.py の環境変数で指定)
+llm = create_role_llm(session, "extraction")
+
+# タイムアウト時間を延長 (秒単位で指定、例: 60秒)
+request_timeout_sec = 60
+
+# リトライ処理を Tenacity で実装
+@tenacity.retry(stop=tenacity.stop_after_attempt(3),
+                  wait=tenacity.wait_fixed(5),
+                  retry=tenacity.retry_if_exception_type(Exception),
+                  before_sleep=tenacity.before_sleep_log(logging, logging.WARNING))
+def create_embedding_with_retry(client, model_name, request_timeout):
+    return BedrockEmbedding(
+        model_name=model_name,
+        client=client,
+        use_async=False,
+        request_timeout=request_timeout
+    )
+
+embedding = create_embedding_with_retry(
+    bedrock_client,
+    "amazon.titan-embed-text-v2:0",
+    request_timeout_sec
+)
+
+Settings.llm = llm
+Settings.embed_model = embedding
+
+# 登録時に1トランザクションにまとめるチャンク数
+ENQUEUE_BATCH_SIZE = 100
+
+
+def create_queue(args):
+    return ChunkQueue(args.queue, visibility_timeout=args.visibility_timeout, max_attempts=args.max_attempts)
+
+
+def enqueue_source(queue, source_type, source_path, chunk_size, fetcher=None):
+    """入力ソースをチャンクに分割してキューに登録し、(チャンク数, 新規登録数) を返す
+
+    同じソースを再登録しても、既に登録済みのチャンクは重複しない。
+    """
+    total = 0
+    added = 0
+    batch = []
+    pages = iter_source_pages(source_type, source_path, fetcher)
+    for chunk_index, (chunk, metadata) in enumerate(iter_chunks(pages, chunk_size)):
+        batch.append((metadata.get("source", source_path), chunk_index, chunk, metadata))
+        if len(batch) >= ENQUEUE_BATCH_SIZE:
+            added += queue.enqueue(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        added += queue.enqueue(batch)
+        total += len(batch)
+    return total, added
+
+
+class LeaseHeartbeat:
+    """処理中のジョブのリースを visibility_timeout の 1/3 ごとに延長するスレッド
+
+    ワーカーが異常終了した場合は延長が止まり、期限切れ後に他のワーカーへ再配布される。
+    """
+
+    def __init__(self, queue, owner):
+        self.queue = queue
+        self.owner = owner
+        self.job_ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def hold(self, job_ids):
+        with self._lock:
+            self.job_ids.update(job_ids)
+
+    def drop(self, job_id):
+        with self._lock:
+            self.job_ids.discard(job_id)
+
+    def _run(self):
+        interval = max(self.queue.visibility_timeout / 3, 1)
+        while not self._stop.wait(interval):
+            with self._lock:
+                job_ids = list(self.job_ids)
+            if not job_ids:
+                continue
+            try:
+                self.queue.extend(self.owner, job_ids)
+            except Exception as e:
+                logging.warning(f"リースの延長に失敗しました: {e}")
+
+
+def run_worker(args, worker_id):
+    """キューが空になるまで (--follow の場合は停止されるまで) ジョブを借りて投入する"""
+    queue = create_queue(args)
+    index = load_index(args, embedding, kg_extractors=build_kg_extractors(args, llm))
+
+    # ECS のタスク停止 (SIGTERM) では処理中のジョブを終えてから終了する
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    processed = 0
+    failed = 0
+    with LeaseHeartbeat(queue, worker_id) as heartbeat:
+        while not stop_event.is_set():
+            jobs = queue.lease(worker_id, args.lease_batch)
+            if not jobs:
+                counts = queue.counts()
+                if not args.follow and counts["pending"] == 0 and counts["leased"] == 0:
+                    break
+                # 他のワーカーが処理中のジョブは、リースが切れたら再配布される
+                stop_event.wait(args.poll_interval)
+                continue
+
+            heartbeat.hold(job["id"] for job in jobs)
+            for job in jobs:
+                if stop_event.is_set():
+                    queue.release(worker_id, job["id"])
+                    heartbeat.drop(job["id"])
+                    continue
+                try:
+                    logging.info(f"[{worker_id}] {job['source']} #{job['chunk_index']} "
+                                 f"(試行 {job['attempts']}/{args.max_attempts})")
+                    # ノードIDをジョブのキーにするため、再試行しても同じチャンクノードが重複しない
+                    index.insert_nodes([TextNode(id_=job["key"], text=job["text"], metadata=job["metadata"])])
+                except Exception as e:
+                    logging.error(f"[{worker_id}] {job['source']} #{job['chunk_index']} の投入に失敗しました: {e}")
+                    queue.nack(worker_id, job["id"], e)
+                    failed += 1
+                else:
+                    if queue.ack(worker_id, job["id"]):
+                        processed += 1
+                    else:
+                        logging.warning(f"[{worker_id}] リースの期限が切れていたため完了にできませんでした: "
+                                        f"{job['source']} #{job['chunk_index']}")
+                finally:
+                    heartbeat.drop(job["id"])
+            # --follow で動き続ける場合もあるため、借りたジョブごとに変更スタンプを進める
+            mark_graph_updated(args, index)
+
+    persist_index(args, index)
+    queue.close()
+    logging.info(f"[{worker_id}] 終了: 完了 {processed}, 失敗 {failed}")
+    return processed
+
+
+def run_workers(args):
+    """--processes 個のワーカープロセスを起動して終了を待つ"""
+    base_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    if args.processes == 1:
+        run_worker(args, base_id)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(args, f"{base_id}-{i}"), name=f"ingest-worker-{i}")
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    # 親プロセスが停止された場合は子プロセスに伝える
+    signal.signal(signal.SIGTERM, lambda signum, frame: [p.terminate() for p in processes])
+    for process in processes:
+        process.join()
+
+
+def format_status(queue, failures=20):
+    counts = queue.counts()
+    total = sum(counts.values())
+    lines = [f"キュー: {queue.path}",
+             f"  合計     : {total}",
+             f"  処理待ち : {counts['pending']}",
+             f"  処理中   : {counts['leased']}",
+             f"  完了     : {counts['done']}",
+             f"  失敗     : {counts['failed']}"]
+    for source, chunk_index, attempts, last_error in queue.failures(failures):
+        lines.append(f"  [失敗] {source} #{chunk_index} (試行 {attempts}): {last_error}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="入力ソースをチャンク単位のジョブとしてキューに登録し、\n"
+                                                 "複数のワーカー (プロセス・ECSタスク) で分担して知識グラフに投入します。\n"
+                                                 "ワーカーが異常終了しても、リースの期限切れ後に他のワーカーが処理を引き継ぎます。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--queue", default=DEFAULT_QUEUE_PATH,
+                        help=f"キューのSQLiteファイルのパス (既定: {DEFAULT_QUEUE_PATH})\n"
+                             "同じホスト上のワーカーで共有する (ネットワークファイルシステム上には置かない)")
+    parser.add_argument("--visibility-timeout", type=float, default=300,
+                        help="リースの有効期間 (秒, 既定: 300)。延長されずに期限が切れたジョブは再配布される")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="1ジョブあたりの試行回数の上限 (既定: 3)。超えたジョブは失敗として残す")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="入力ソースをチャンクに分割してキューに登録する",
+                                           formatter_class=argparse.RawTextHelpFormatter)
+    enqueue_parser.add_argument("source_type", choices=["wiki", "pdf", "web"],
+                                help="入力ソースの種類 ('wiki', 'pdf', 'web' から選択)")
+    enqueue_parser.add_argument("source_path",
+                                help="入力ソースのパス (wikiの場合はページタイトル, pdfの場合はファイル名, webの場合はURL)")
+    enqueue_parser.add_argument("--chunk-size", type=int, default=1000,
+                                help="テキストチャンクの分割サイズ (文字数, 既定: 1000)")
+    add_fetch_arguments(enqueue_parser)
+
+    work_parser = subparsers.add_parser("work", help="キューからジョブを借りて抽出・書き込みを行う",
+                                        formatter_class=argparse.RawTextHelpFormatter)
+    work_group = work_parser.add_argument_group('ワーカー')
+    work_group.add_argument("--processes", type=int, default=1,
+                            help="このホストで起動するワーカープロセス数 (既定: 1)")
+    work_group.add_argument("--worker-id", default=os.getenv("INGEST_WORKER_ID"),
+                            help="ワーカーの識別子 (既定: ホスト名-プロセスID)")
+    work_group.add_argument("--lease-batch", type=int, default=1,
+                            help="1回に借りるジョブ数 (既定: 1)")
+    work_group.add_argument("--poll-interval", type=float, default=5,
+                            help="ジョブが無いときの待ち時間 (秒, 既定: 5)")
+    work_group.add_argument("--follow", action="store_true",
+                            help="キューが空になっても終了せず、新しいジョブを待ち続ける")
+    add_backend_arguments(work_parser)
+    add_cache_arguments(work_parser)
+    add_extractor_arguments(work_parser)
+
+    status_parser = subparsers.add_parser("status", help="状態ごとのジョブ数と失敗したジョブを表示する")
+    status_parser.add_argument("--failures", type=int, default=20,
+                               help="表示する失敗ジョブの件数 (既定: 20)")
+    subparsers.add_parser("requeue", help="失敗したジョブを処理待ちに戻す")
+
+    args = parser.parse_args()
+
+    if args.command == "work" and args.processes > 1 and args.graph_store == "simple":
+        parser.error("--graph-store simple では複数のワーカープロセスを使用できません")
+
+    try:
+        if args.command == "enqueue":
+            queue = create_queue(args)
+            total, added = enqueue_source(queue, args.source_type, args.source_path, args.chunk_size,
+                                          create_fetcher(args))
+            print(f"登録したチャンク数: {added} (既に登録済み {total - added})")
+            print(format_status(queue, 0))
+        elif args.command == "work":
+            started = time.perf_counter()
+            run_workers(args)
+            print(f"ワーカーの処理時間: {time.perf_counter() - started:.1f} 秒")
+            print(format_status(create_queue(args)))
+        elif args.command == "status":
+            print(format_status(create_queue(args), args.failures))
+        elif args.command == "requeue":
+            print(f"処理待ちに戻したジョブ数: {create_queue(args).requeue_failed()}")
+    except Exception as e:
+        print(f"キューの処理中にエラーが発生しました: {e}")
+        exit(1)
@@ -0,0 +1,168 @@
+import os
+import asyncio
+import logging
+from typing import Any, List
+from llama_index.core.indices.property_graph import BasePGRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.graph_stores.neo4j.neo4j_property_graph import (BASE_ENTITY_LABEL, BASE_NODE_LABEL,
+                                                                 VECTOR_INDEX_NAME)
+
+RETRIEVAL_MODES = ["default", "khop", "snapshot"]
+KHOP_DEPTHS = [1, 2, 3]
+
+DEFAULT_KHOP_DEPTH = 2
+DEFAULT_KHOP_SEEDS = 4
+DEFAULT_KHOP_LIMIT = 30
+DEFAULT_KHOP_CHUNKS = 2
+
+# csr_snapshot.py build で作成する読み取り専用スナップショットの場所
+DEFAULT_SNAPSHOT_DIR = os.getenv("GRAPH_CSR_SNAPSHOT", "./graph_csr")
+
+# 起点のベクトル検索・k ホップの近傍・起点を参照するチャンクの本文を1回の Cypher で取得する
+# (深さは Cypher のパラメーターにできないため、検証した整数を埋め込む。それ以外はすべてパラメーター)
+KHOP_QUERY = """
+CALL db.index.vector.queryNodes($index_name, $seeds, $embedding)
+YIELD node AS seed, score
+CALL (seed) {{
+    MATCH path = (seed)-[*1..{depth}]-(:{entity})
+    WHERE ALL(r IN relationships(path) WHERE type(r) <> 'MENTIONS'
+              AND ($collection IS NULL OR $collection IN coalesce(r.collections, [])))
+      AND ALL(n IN nodes(path) WHERE n:{entity})
+    UNWIND relationships(path) AS r
+    WITH DISTINCT r
+    LIMIT $limit
+    RETURN collect([startNode(r).id, type(r), endNode(r).id]) AS triplets
+}}
+CALL (seed) {{
+    MATCH (chunk:{chunk})-[:MENTIONS]->(seed)
+    WHERE chunk.text IS NOT NULL
+    WITH chunk
+    LIMIT $chunks
+    RETURN collect([chunk.id, chunk.text]) AS texts
+}}
+RETURN seed.id AS seed, score, triplets, texts
+ORDER BY score DESC
+"""
+
+
+def build_seed_nodes(rows, include_text):
+    """起点ごとの行 {seed, score, triplets, texts} を検索結果のノードにする
+
+    起点ごとにトリプレットの行をまとめた1つのノードと、include_text の場合はチャンクの本文のノードを返す。
+    """
+    nodes = []
+    seen_chunks = set()
+    for row in rows:
+        if row["triplets"]:
+            text = "\n".join(f"{source} -> {relation} -> {target}" for source, relation, target in row["triplets"])
+            nodes.append(NodeWithScore(node=TextNode(text=text, metadata={"seed": row["seed"]}),
+                                       score=row["score"]))
+        if not include_text:
+            continue
+        for chunk_id, chunk_text in row["texts"]:
+            # 複数の起点から参照されるチャンクは最初 (スコアの高い起点) の1回だけ返す
+            if chunk_id in seen_chunks:
+                continue
+            seen_chunks.add(chunk_id)
+            nodes.append(NodeWithScore(node=TextNode(id_=chunk_id, text=chunk_text, metadata={"seed": row["seed"]}),
+                                       score=row["score"]))
+    return nodes
+
+
+class KHopRetriever(BasePGRetriever):
+    """質問ごとの Neo4j への往復を1回に抑えるグラフ検索
+
+    既定の検索は、ベクトル検索・起点ごとの近傍の展開・元テキストの取得で複数回往復する。
+    ここでは起点のエンティティ、深さ depth までの近傍のトリプレット、起点を参照するチャンクの本文を
+    1回の Cypher でまとめて取得し、起点ごとに1つのノード (トリプレットの行) と
+    include_text の場合はチャンクの本文のノードを返す。スコアは起点のベクトル検索のスコア。
+    """
+
+    def __init__(self, graph_store, embed_model, depth=DEFAULT_KHOP_DEPTH, seeds=DEFAULT_KHOP_SEEDS,
+                 limit=DEFAULT_KHOP_LIMIT, chunks=DEFAULT_KHOP_CHUNKS, include_text=True, **kwargs: Any) -> None:
+        if depth not in KHOP_DEPTHS:
+            raise ValueError(f"k ホップの深さは {KHOP_DEPTHS} のいずれかを指定してください: {depth}")
+        self._embed_model = embed_model
+        self._seeds = seeds
+        self._limit = limit
+        self._chunks = chunks
+        self._with_text = include_text
+        # コレクション指定のストアは専用のインデックスとラベルで範囲を限定する
+        # (関係は collections 属性、チャンクはコレクション用のチャンクラベルで絞り込む)
+        self._collection = getattr(graph_store, "collection", None)
+        collection = getattr(graph_store, "collection_label", None)
+        chunk_label = getattr(graph_store, "collection_chunk_label", None)
+        self._index_name = getattr(graph_store, "collection_index", VECTOR_INDEX_NAME)
+        entity = f"`{BASE_ENTITY_LABEL}`" + (f":`{collection}`" if collection else "")
+        chunk = f"`{BASE_NODE_LABEL}`" + (f":`{chunk_label}`" if chunk_label else "")
+        self._query = KHOP_QUERY.format(depth=depth, entity=entity, chunk=chunk)
+        # 元テキストは同じクエリで取得するため、追加の往復になる add_source_text は使わない
+        super().__init__(graph_store=graph_store, include_text=False, **kwargs)
+
+    def _query_graph(self, embedding: List[float]) -> List[NodeWithScore]:
+        rows = self._graph_store.structured_query(
+            self._query,
+            param_map={"index_name": self._index_name, "seeds": self._seeds, "embedding": embedding,
+                       "limit": self._limit, "chunks": self._chunks, "collection": self._collection},
+        ) or []
+        return build_seed_nodes(rows, self._with_text)
+
+    def retrieve_from_graph(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        embedding = query_bundle.embedding or self._embed_model.get_query_embedding(query_bundle.query_str)
+        return self._query_graph(embedding)
+
+    async def aretrieve_from_graph(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # 同期のドライバー・埋め込みクライアントを使うため、スレッドで実行する
+        return await asyncio.to_thread(self.retrieve_from_graph, query_bundle)
+
+
+def build_sub_retrievers(args, index, embedding, include_text=True):
+    """--retrieval-mode に応じて as_retriever / as_query_engine に渡す sub_retrievers を返す
+
+    default (または単純ストア) の場合は None を返し、LlamaIndex の既定の検索を使う。
+    include_text=False の場合はチャンクの本文を取得しない (検索結果の表示用)。
+    """
+    if args.retrieval_mode == "snapshot":
+        from csr_snapshot import SnapshotRetriever, check_snapshot_version, open_snapshot
+
+        # スナップショットは Neo4j・組み込みストアのどちらから作ったものでも使える
+        snapshot = open_snapshot(args.snapshot_dir)
+        check_snapshot_version(args, snapshot)
+        return [SnapshotRetriever(index.property_graph_store, embedding, snapshot,
+                                  depth=args.khop_depth,
+                                  seeds=args.khop_seeds,
+                                  limit=args.khop_limit,
+                                  chunks=args.khop_chunks,
+                                  include_text=include_text and args.khop_chunks > 0)]
+    if args.retrieval_mode != "khop":
+        return None
+    if args.graph_store != "neo4j":
+        logging.warning("k ホップ検索は Neo4j でのみ使用できます。既定の検索を使います")
+        return None
+    return [KHopRetriever(index.property_graph_store, embedding,
+                          depth=args.khop_depth,
+                          seeds=args.khop_seeds,
+                          limit=args.khop_limit,
+                          chunks=args.khop_chunks,
+                          include_text=include_text and args.khop_chunks > 0)]
+
+
+def add_retrieval_arguments(parser):
+    """グラフ検索の方式の引数を追加する"""
+    group = parser.add_argument_group('グラフ検索')
+    group.add_argument("--retrieval-mode", choices=RETRIEVAL_MODES, default="default",
+                       help="グラフ検索の方式\n"
+                            "  default: LlamaIndex の既定 (ベクトル検索・近傍の展開・本文の取得で複数回往復)\n"
+                            "  khop   : 起点・k ホップの近傍・チャンクの本文を1回の Cypher で取得 (Neo4j のみ)\n"
+                            "  snapshot: csr_snapshot.py で作成したスナップショットを memory-map してプロセス内で探索")
+    group.add_argument("--snapshot-dir", default=DEFAULT_SNAPSHOT_DIR,
+                       help=f"snapshot で使うスナップショットのディレクトリ (既定: {DEFAULT_SNAPSHOT_DIR})")
+    group.add_argument("--khop-depth", type=int, choices=KHOP_DEPTHS, default=DEFAULT_KHOP_DEPTH,
+                       help=f"k ホップ検索 (khop / snapshot) で辿る深さ (既定: {DEFAULT_KHOP_DEPTH})")
+    group.add_argument("--khop-seeds", type=int, default=DEFAULT_KHOP_SEEDS,
+                       help=f"ベクトル検索で選ぶ起点のエンティティ数 (既定: {DEFAULT_KHOP_SEEDS})")
+    group.add_argument("--khop-limit", type=int, default=DEFAULT_KHOP_LIMIT,
+                       help=f"起点ごとに返すトリプレット数の上限 (既定: {DEFAULT_KHOP_LIMIT})")
+    group.add_argument("--khop-chunks", type=int, default=DEFAULT_KHOP_CHUNKS,
+                       help=f"起点ごとに返すチャンクの本文の数 (既定: {DEFAULT_KHOP_CHUNKS}, 0 で本文を返さない)")
+    return group
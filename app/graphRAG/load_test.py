@@ -0,0 +1,480 @@
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+from pydantic import PrivateAttr
+from llama_index.core import PropertyGraphIndex
+from llama_index.core.llms import CustomLLM, CompletionResponse, CompletionResponseGen, LLMMetadata
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.settings import Settings
+from graph_backend import add_backend_arguments, create_graph_store, load_index
+from context_pruning import add_context_arguments, build_node_postprocessors
+from khop_retriever import add_retrieval_arguments, build_sub_retrievers
+
+DEFAULT_QUESTIONS = [
+    "ラオウとケンシロウの関係は？",
+    "北斗神拳の伝承者は誰ですか？",
+    "この特許の出願人は誰ですか？",
+    "請求項1に記載された発明の特徴は？",
+    "国際特許分類はどれですか？",
+]
+
+# Titan Embeddings V2 の既定の次元 (既存のベクトルインデックスと合わせる)
+STAND_IN_EMBED_DIM = 1024
+
+# 時間帯内の完了数が、実際の到着から見込まれる完了数のこの割合を下回ったら飽和とみなす
+SATURATION_THROUGHPUT_RATIO = 0.9
+
+
+class StandInThrottlingError(Exception):
+    """代替モデルが模擬するスロットリングエラー"""
+
+
+class LatencyModel:
+    """代替モデルの応答時間・同時実行数の上限・失敗率を模擬する
+
+    応答時間は中央値 median 秒、ばらつき sigma の対数正規分布に従う。
+    concurrency を超える呼び出しは空きが出るまで待つ (待ち時間も応答時間に含まれる)。
+    """
+
+    def __init__(self, median, sigma=0.3, concurrency=0, error_rate=0.0):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._slots = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+
+    def call(self):
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            time.sleep(self.median * math.exp(random.gauss(0, self.sigma)) if self.median > 0 else 0)
+            if random.random() < self.error_rate:
+                raise StandInThrottlingError("ThrottlingException (stand-in)")
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+def _stand_in_completion(prompt):
+    """キーワード抽出のプロンプトには質問の単語を、それ以外には固定の回答を返す"""
+    if prompt.rstrip().endswith("KEYWORDS:") and "QUERY:" in prompt:
+        query = prompt.split("QUERY:", 1)[1].split("----", 1)[0]
+        return "^".join(query.split())
+    return "代替モデルによる回答です。"
+
+
+class StandInLLM(CustomLLM):
+    """Bedrock の代わりに、設定した応答時間だけ待って固定の応答を返すLLM"""
+
+    context_window: int = 200000
+    num_output: int = 512
+    _latency: Any = PrivateAttr()
+
+    def __init__(self, latency: LatencyModel, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._latency = latency
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StandInLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=self.context_window, num_output=self.num_output, model_name="stand-in")
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        self._latency.call()
+        return CompletionResponse(text=_stand_in_completion(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        yield self.complete(prompt, formatted=formatted, **kwargs)
+
+
+class StandInEmbedding(BaseEmbedding):
+    """Bedrock の代わりに、設定した応答時間だけ待ってテキストのハッシュから決まるベクトルを返す埋め込み"""
+
+    dimension: int = STAND_IN_EMBED_DIM
+    _latency: Any = PrivateAttr()
+
+    def __init__(self, latency: LatencyModel, **kwargs: Any) -> None:
+        super().__init__(model_name="stand-in", **kwargs)
+        self._latency = latency
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StandInEmbedding"
+
+    def _vector(self, text: str) -> List[float]:
+        self._latency.call()
+        rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+        vector = [rng.gauss(0, 1) for _ in range(self.dimension)]
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._vector(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._vector(text)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._vector(query)
+
+
+class PoolSampler:
+    """neo4j ドライバーの接続プールの使用中の接続数を一定間隔で記録する
+
+    公開APIが無いため、ドライバー内部のプール (_driver._pool) を参照する。参照できない場合は記録しない。
+    """
+
+    def __init__(self, graph_store, interval=0.05):
+        self.pool = getattr(getattr(graph_store, "_driver", None), "_pool", None)
+        self.max_size = self.pool.pool_config.max_connection_pool_size if self.pool is not None else None
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _in_use(self):
+        with self.pool.lock:
+            return sum(connection.in_use for connections in self.pool.connections.values()
+                       for connection in connections)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append(self._in_use())
+
+    def start(self):
+        if self.pool is None:
+            return
+        self.samples = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pool-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if not self.samples:
+            return None
+        return {
+            "max_size": self.max_size,
+            "mean_in_use": sum(self.samples) / len(self.samples),
+            "peak_in_use": max(self.samples),
+            "saturated_ratio": sum(1 for s in self.samples if s >= self.max_size) / len(self.samples),
+        }
+
+
+def _percentile(sorted_values, ratio):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(ratio * len(sorted_values)))]
+
+
+def run_step(handler, questions, rate, duration, concurrency, max_backlog, sampler=None, seed=None):
+    """到着率 rate (件/秒) のポアソン過程で duration 秒間リクエストを発生させる (オープンループ)
+
+    到着は処理の完了を待たずに発生させ、応答時間は到着予定時刻から測る (待ち行列の時間を含む)。
+    処理待ちが max_backlog 件に達している間に到着したリクエストは拒否として数える。
+    """
+    rng = random.Random(seed)
+    records = []
+    lock = threading.Lock()
+    inflight = [0]
+    peak_backlog = [0]
+
+    def task(question, scheduled):
+        started = time.perf_counter()
+        error = None
+        try:
+            handler(question)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finished = time.perf_counter()
+        with lock:
+            inflight[0] -= 1
+            records.append({"latency": finished - scheduled, "wait": started - scheduled,
+                            "scheduled": scheduled, "finished": finished, "error": error})
+
+    rejected = 0
+    submitted = 0
+    if sampler is not None:
+        sampler.start()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load")
+    start = time.perf_counter()
+    arrival = start + rng.expovariate(rate)
+    while arrival - start < duration:
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        with lock:
+            backlog = inflight[0]
+            peak_backlog[0] = max(peak_backlog[0], backlog)
+            accepted = backlog < max_backlog
+            if accepted:
+                inflight[0] += 1
+        if accepted:
+            executor.submit(task, questions[submitted % len(questions)], arrival)
+            submitted += 1
+        else:
+            rejected += 1
+        arrival += rng.expovariate(rate)
+    executor.shutdown(wait=True)
+    pool = sampler.stop() if sampler is not None else None
+    return summarize(records, rate, duration, start, rejected, peak_backlog[0], pool)
+
+
+def _wait_growth(records, start, duration):
+    """到着した時間帯の最初と最後の 1/3 で、待ち時間の中央値がどれだけ伸びたか (秒) を返す
+
+    処理が追いついていれば待ち時間は時間帯によらずほぼ一定で、追いつかなければ処理待ちが溜まり続けて伸びる。
+    """
+    third = duration / 3
+    early = sorted(r["wait"] for r in records if r["scheduled"] - start < third)
+    late = sorted(r["wait"] for r in records if r["scheduled"] - start >= duration - third)
+    if not early or not late:
+        return 0.0
+    return _percentile(late, 0.5) - _percentile(early, 0.5)
+
+
+def summarize(records, rate, duration, start, rejected, peak_backlog, pool):
+    """1ステップの記録から応答時間の分布・スループット・エラー率を集計する
+
+    スループットは到着させた時間帯 (duration 秒) の中で正常に完了した件数を duration で割る
+    (最後の到着の後に溜まった処理を待ち切る時間を含めない)。これを、実際の到着のうち処理時間の中央値で
+    時間帯内に終わるはずだった件数と比べる (到着率をそのまま比べると、応答時間の長い処理ほど飽和と誤判定する)。
+    飽和は、拒否・完了数が見込みに届かない・時間帯の後半ほど待ち時間が伸びる (処理待ちが溜まり続ける)・
+    接続プールが上限に張り付く、のいずれかで判定する。
+    """
+    ok = sorted(r["latency"] for r in records if r["error"] is None)
+    waits = sorted(r["wait"] for r in records)
+    errors = {}
+    for record in records:
+        if record["error"] is not None:
+            errors[record["error"]] = errors.get(record["error"], 0) + 1
+    offered = len(records) + rejected
+    offered_rate = offered / duration
+    completed_in_window = sum(1 for r in records if r["error"] is None and r["finished"] - start <= duration)
+    throughput = completed_in_window / duration
+    # 処理時間 (待ち時間を除く) の中央値を、見込みの完了数と待ち時間の伸びを判定する目安にする
+    service = sorted(r["latency"] - r["wait"] for r in records if r["error"] is None)
+    service_p50 = _percentile(service, 0.5)
+    expected = sum(1 for r in records if r["scheduled"] - start + service_p50 <= duration)
+    expected_rate = expected / duration
+    wait_growth = _wait_growth(records, start, duration)
+    result = {
+        "rate": rate,
+        "offered": offered,
+        "offered_rate": offered_rate,
+        "completed": len(ok),
+        "errors": sum(errors.values()),
+        "rejected": rejected,
+        "error_rate": (sum(errors.values()) + rejected) / offered if offered else 0.0,
+        "throughput": throughput,
+        "expected_throughput": expected_rate,
+        "latency": {"p50": _percentile(ok, 0.5), "p90": _percentile(ok, 0.9), "p99": _percentile(ok, 0.99),
+                    "max": ok[-1] if ok else 0.0, "mean": sum(ok) / len(ok) if ok else 0.0},
+        "wait": {"p50": _percentile(waits, 0.5), "p99": _percentile(waits, 0.99), "growth": wait_growth},
+        "peak_backlog": peak_backlog,
+        "histogram": latency_histogram(ok),
+        "error_types": errors,
+        "pool": pool,
+    }
+    result["saturated"] = bool(rejected or throughput < expected_rate * SATURATION_THROUGHPUT_RATIO
+                               or (service and wait_growth > service_p50)
+                               or (pool and pool["saturated_ratio"] > 0.5))
+    return result
+
+
+def latency_histogram(latencies):
+    """応答時間 (秒) をミリ秒の2のべき乗の区間に分けて数える"""
+    buckets = {}
+    for latency in latencies:
+        bucket = max(0, int(latency * 1000)).bit_length()
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return [{"bucket": bucket, "count": buckets[bucket]} for bucket in sorted(buckets)]
+
+
+def format_step(result):
+    """1ステップの集計結果を表示用の文字列にする"""
+    latency = result["latency"]
+    lines = [
+        f"到着率 {result['rate']:g} 件/秒: 完了 {result['completed']}/{result['offered']} "
+        f"(エラー {result['errors']}, 拒否 {result['rejected']}, エラー率 {result['error_rate']:.1%})"
+        f"{' [飽和]' if result['saturated'] else ''}",
+        f"  スループット: {result['throughput']:.2f} 件/秒 (実際の到着 {result['offered_rate']:.2f} 件/秒, "
+        f"処理が追いつく場合の見込み {result['expected_throughput']:.2f} 件/秒)",
+        f"  応答時間 (秒): 平均 {latency['mean']:.2f}, 中央値 {latency['p50']:.2f}, 90% {latency['p90']:.2f}, "
+        f"99% {latency['p99']:.2f}, 最大 {latency['max']:.2f}",
+        f"  待ち時間 (秒): 中央値 {result['wait']['p50']:.2f}, 99% {result['wait']['p99']:.2f}, "
+        f"前半→後半の伸び {result['wait']['growth']:+.2f} (処理待ちの最大 {result['peak_backlog']} 件)",
+    ]
+    pool = result["pool"]
+    if pool:
+        lines.append(f"  Neo4j接続プール: 平均 {pool['mean_in_use']:.1f}, 最大 {pool['peak_in_use']}/{pool['max_size']} "
+                     f"(上限に達していた割合 {pool['saturated_ratio']:.0%})")
+    lines.append("  応答時間の分布:")
+    largest = max((row["count"] for row in result["histogram"]), default=1)
+    for row in result["histogram"]:
+        bucket = row["bucket"]
+        low, high = (0, 0) if bucket == 0 else (2 ** (bucket - 1), 2 ** bucket - 1)
+        label = f"{low}ms" if low == high else f"{low}-{high}ms"
+        bar = "#" * max(1, int(40 * row["count"] / largest))
+        lines.append(f"    {label:>13} | {bar} {row['count']}")
+    for error, count in sorted(result["error_types"].items(), key=lambda item: -item[1]):
+        lines.append(f"  [エラー] {error}: {count}")
+    return "\n".join(lines)
+
+
+def create_models(args):
+    """引数に応じて代替モデルまたは Bedrock の (llm, embedding) を作る"""
+    if args.bedrock == "real":
+        import boto3
+        from bedrock_archive import create_bedrock_client
+        from model_roles import create_role_llm
+        from llama_index.embeddings.bedrock import BedrockEmbedding
+
+        session = boto3.Session(
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            region_name=os.getenv('AWS_DEFAULT_REGION')
+        )
+        bedrock_client = create_bedrock_client(session)
+        llm = create_role_llm(session, "synthesis")
+        embedding = BedrockEmbedding(model_name="amazon.titan-embed-text-v2:0", client=bedrock_client)
+        return llm, embedding
+
+    llm = StandInLLM(LatencyModel(args.llm_latency, args.latency_sigma, args.bedrock_concurrency, args.error_rate))
+    embedding = StandInEmbedding(LatencyModel(args.embed_latency, args.latency_sigma, args.bedrock_concurrency,
+                                              args.error_rate))
+    return llm, embedding
+
+
+def create_handler(args, index, embedding):
+    """1件の質問を処理する関数を作る (query_neo4j.py と同じ検索・回答生成の経路)"""
+    if args.mode == "retrieve":
+        retriever = index.as_retriever(sub_retrievers=build_sub_retrievers(args, index, embedding, include_text=False),
+                                       include_text=False)
+        return retriever.retrieve
+    query_engine = index.as_query_engine(sub_retrievers=build_sub_retrievers(args, index, embedding),
+                                         node_postprocessors=build_node_postprocessors(args))
+    return query_engine.query
+
+
+def load_questions(value):
+    """「@ファイル名」の場合はファイルの各行を、それ以外は既定の質問を返す"""
+    if value is None:
+        return DEFAULT_QUESTIONS
+    if value.startswith("@"):
+        with open(value[1:], encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    return [value]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="質問応答の経路に一定の到着率でリクエストを送り、\n"
+                                                 "応答時間の分布・スループット・エラー率・Neo4j接続プールの使用状況を測定します。\n"
+                                                 "到着率を段階的に上げて、飽和する到着率を確認できます。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    load_group = parser.add_argument_group('負荷')
+    load_group.add_argument("--rates", default="1,2,4,8",
+                            help="到着率 (件/秒) のカンマ区切りの一覧。順に測定する (既定: 1,2,4,8)")
+    load_group.add_argument("--duration", type=float, default=30,
+                            help="1つの到着率あたりの測定時間 (秒, 既定: 30)")
+    load_group.add_argument("--concurrency", type=int, default=16,
+                            help="同時に処理するリクエスト数 (ECSタスクのワーカースレッド数に相当, 既定: 16)")
+    load_group.add_argument("--max-backlog", type=int, default=200,
+                            help="処理待ちの上限。超えて到着したリクエストは拒否として数える (既定: 200)")
+    load_group.add_argument("--warmup", type=int, default=3,
+                            help="測定前に実行する質問数 (既定: 3)")
+    load_group.add_argument("--mode", choices=["retrieve", "query"], default="query",
+                            help="retrieve: 検索のみ / query: 検索と回答生成 (既定: query)")
+    load_group.add_argument("--questions",
+                            help="質問文字列、または「@ファイル名」(1行1問)。省略時は組み込みの質問を使う")
+    load_group.add_argument("--seed", type=int, default=0, help="到着間隔の乱数の種 (既定: 0)")
+    load_group.add_argument("--report-json", help="集計結果をJSONで保存するファイル")
+
+    model_group = parser.add_argument_group('Bedrock の代替')
+    model_group.add_argument("--bedrock", choices=["stand-in", "real"], default="stand-in",
+                             help="stand-in: 応答時間だけを模擬する代替モデル (既定) / real: Bedrock を呼び出す")
+    model_group.add_argument("--llm-latency", type=float, default=1.5,
+                             help="代替LLMの応答時間の中央値 (秒, 既定: 1.5)")
+    model_group.add_argument("--embed-latency", type=float, default=0.1,
+                             help="代替埋め込みの応答時間の中央値 (秒, 既定: 0.1)")
+    model_group.add_argument("--latency-sigma", type=float, default=0.3,
+                             help="応答時間のばらつき (対数正規分布のσ, 既定: 0.3)")
+    model_group.add_argument("--bedrock-concurrency", type=int, default=0,
+                             help="代替モデルの同時実行数の上限 (既定: 0 = 無制限)")
+    model_group.add_argument("--error-rate", type=float, default=0.0,
+                             help="代替モデルの呼び出しが失敗する割合 (既定: 0)")
+    model_group.add_argument("--neo4j-pool-size", type=int, default=100,
+                             help="neo4j ドライバーの接続プールの上限 (既定: 100)")
+    add_backend_arguments(parser)
+    add_context_arguments(parser)
+    add_retrieval_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        rates = [float(rate) for rate in args.rates.split(",") if rate.strip()]
+    except ValueError:
+        parser.error(f"--rates の形式が正しくありません: {args.rates}")
+    if not rates or any(rate <= 0 for rate in rates):
+        parser.error("--rates には正の数を指定してください")
+
+    llm, embedding = create_models(args)
+    Settings.llm = llm
+    Settings.embed_model = embedding
+
+    try:
+        if args.graph_store == "neo4j":
+            graph_store = create_graph_store(args, max_connection_pool_size=args.neo4j_pool_size)
+            index = PropertyGraphIndex.from_existing(property_graph_store=graph_store, llm=llm,
+                                                     embed_model=embedding)
+            sampler = PoolSampler(graph_store)
+        else:
+            index = load_index(args, embedding, llm=llm)
+            sampler = None
+        handler = create_handler(args, index, embedding)
+        questions = load_questions(args.questions)
+        for question in questions[:args.warmup]:
+            handler(question)
+    except Exception as e:
+        print(f"準備中にエラーが発生しました: {e}")
+        exit(1)
+
+    print(f"負荷試験: mode={args.mode}, concurrency={args.concurrency}, bedrock={args.bedrock}, "
+          f"質問 {len(questions)} 件, 各到着率 {args.duration:g} 秒")
+    results = []
+    for rate in rates:
+        result = run_step(handler, questions, rate, args.duration, args.concurrency, args.max_backlog,
+                          sampler=sampler, seed=args.seed)
+        results.append(result)
+        print(format_step(result))
+
+    saturated = [result["rate"] for result in results if result["saturated"]]
+    if saturated:
+        print(f"飽和の目安: 到着率 {saturated[0]:g} 件/秒 で飽和しました")
+    else:
+        print(f"飽和の目安: 到着率 {rates[-1]:g} 件/秒 まで飽和しませんでした")
+
+    if args.report_json:
+        with open(args.report_json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "steps": results}, f, ensure_ascii=False, indent=2)
+        print(f"集計結果を保存しました: {args.report_json}")
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import threading
+from botocore.config import Config
+from llama_index.llms.bedrock import Bedrock
+from bedrock_archive import create_bedrock_client
+
+DEFAULT_LLM_MODEL = "anthropic.claude-3-haiku-20240307-v1:0"
+
+# 役割ごとの既定値 (LLMは引数の解析前に作成されるため環境変数で上書きする)
+#   BEDROCK_<役割>_MODEL        : モデルID (未指定の場合は BEDROCK_LLM_MODEL → 既定のモデル)
+#   BEDROCK_<役割>_CONCURRENCY  : 同時に呼び出す数の上限 (この数を超えた呼び出しは空くまで待つ)
+#   BEDROCK_<役割>_TIMEOUT      : 接続・応答の待ち時間 (秒)
+#   BEDROCK_<役割>_CONTEXT_SIZE : 入力トークン数の上限 (LlamaIndex が知らないモデルの場合のみ必要)
+#   extraction: 投入時の知識グラフ抽出・コミュニティ要約 (大量・待てる処理)
+#   synthesis : 質問への回答生成
+#   cypher    : 検索時にグラフを引くための問い合わせ生成 (キーワード・同義語の抽出)
+MODEL_ROLES = {
+    "extraction": {"concurrency": 8, "timeout": 120},
+    "synthesis": {"concurrency": 4, "timeout": 60},
+    "cypher": {"concurrency": 4, "timeout": 30},
+}
+
+
+def role_settings(role):
+    """役割のモデルID・同時呼び出し数・タイムアウトを環境変数から決める"""
+    defaults = MODEL_ROLES[role]
+    prefix = f"BEDROCK_{role.upper()}_"
+    context_size = os.getenv(prefix + "CONTEXT_SIZE")
+    return {
+        "role": role,
+        "model": os.getenv(prefix + "MODEL") or os.getenv("BEDROCK_LLM_MODEL") or DEFAULT_LLM_MODEL,
+        "concurrency": int(os.getenv(prefix + "CONCURRENCY", defaults["concurrency"])),
+        "timeout": float(os.getenv(prefix + "TIMEOUT", defaults["timeout"])),
+        "context_size": int(context_size) if context_size else None,
+    }
+
+
+def _release_after(events, semaphore):
+    """ストリームを読み終えた (または破棄された) ときに同時呼び出しの枠を返す"""
+    try:
+        yield from events
+    finally:
+        semaphore.release()
+
+
+class ConcurrencyLimitedClient:
+    """bedrock-runtime クライアントの同時呼び出し数を役割ごとに制限するラッパー
+
+    枠が空くまで待った時間を記録し、invoke_model 系以外の属性はそのまま元のクライアントに委ねる。
+    """
+
+    def __init__(self, client, role, concurrency):
+        self._client = client
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.role = role
+        self.concurrency = concurrency
+        self.stats = {"calls": 0, "waited": 0.0, "max_wait": 0.0}
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _acquire(self):
+        started = time.perf_counter()
+        self._semaphore.acquire()
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["waited"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+        if waited >= 1:
+            logging.info(f"[{self.role}] 同時呼び出し数の上限 ({self.concurrency}) のため {waited:.1f} 秒待ちました")
+
+    def invoke_model(self, **kwargs):
+        self._acquire()
+        try:
+            return self._client.invoke_model(**kwargs)
+        finally:
+            self._semaphore.release()
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        self._acquire()
+        try:
+            response = self._client.invoke_model_with_response_stream(**kwargs)
+        except Exception:
+            self._semaphore.release()
+            raise
+        response["body"] = _release_after(response["body"], self._semaphore)
+        return response
+
+
+def create_role_llm(session, role, **llm_kwargs):
+    """役割ごとに専用のクライアント (接続プール・タイムアウト・同時呼び出し数) を持つ Bedrock LLM を作成する"""
+    settings = role_settings(role)
+    config = Config(connect_timeout=settings["timeout"],
+                    read_timeout=settings["timeout"],
+                    max_pool_connections=max(10, settings["concurrency"]),
+                    retries={"mode": "adaptive", "max_attempts": 3})
+    client = ConcurrencyLimitedClient(create_bedrock_client(session, config=config), role, settings["concurrency"])
+    if settings["context_size"] is not None:
+        llm_kwargs.setdefault("context_size", settings["context_size"])
+    logging.info(f"LLM [{role}]: {settings['model']} "
+                 f"(同時呼び出し {settings['concurrency']}, タイムアウト {settings['timeout']:g} 秒)")
+    return Bedrock(model=settings["model"], client=client, timeout=settings["timeout"], **llm_kwargs)
+
+
+def create_role_llms(session, roles=tuple(MODEL_ROLES)):
+    """指定した役割の LLM を {役割: LLM} で返す"""
+    return {role: create_role_llm(session, role) for role in roles}
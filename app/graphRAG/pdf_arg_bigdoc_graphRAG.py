@@ -3,14 +3,25 @@ import os
 import argparse
 import logging
 import tenacity
-from llama_index.llms.bedrock import Bedrock
+from bedrock_archive import create_bedrock_client
+from model_roles import create_role_llms
 from llama_index.embeddings.bedrock import BedrockEmbedding
 from llama_index.core.settings import Settings
 from llama_index.readers.wikipedia import WikipediaReader
-from llama_index.graph_stores.neo4j import Neo4jPropertyGraphStore
-from llama_index.core import PropertyGraphIndex
 from langchain_community.document_loaders import PyPDFLoader, WebBaseLoader
 from llama_index.core.schema import Document
+from graph_backend import add_backend_arguments, load_index, mark_graph_updated, persist_index
+from ingest_pipeline import IngestPipeline, add_pipeline_arguments, iter_source_pages, iter_chunks
+from ingest_estimate import (TokenBudget, add_estimate_arguments, estimate_ingest, format_estimate,
+                             select_chunks_within_budget)
+from extraction_cache import add_cache_arguments
+from extractors import add_extractor_arguments, build_kg_extractors, llm_chunk_filter
+from query_profiler import add_profiler_arguments, attach_profiler, report_profiler
+from community_summary import add_global_search_arguments, answer_globally, check_global_search_arguments
+from source_fetcher import add_fetch_arguments, create_fetcher, expand_sources, fetch_sources
+from context_pruning import add_context_arguments, build_node_postprocessors
+from khop_retriever import add_retrieval_arguments, build_sub_retrievers
+from process_profiler import add_process_profile_arguments, mark_stage, start_process_profiler
 
 logging.basicConfig(level=logging.INFO)
 
@@ -21,10 +32,13 @@ session = boto3.Session(
     region_name=os.getenv('AWS_DEFAULT_REGION')
 )
 
-bedrock_client = session.client('bedrock-runtime')
+# BEDROCK_ARCHIVE_MODE=record/replay の場合は要求・応答を記録/再生するクライアントになる
+bedrock_client = create_bedrock_client(session)
 
 # LLMとEmbeddingの設定
-llm = Bedrock(model="anthropic.claude-3-haiku-20240307-v1:0", client=bedrock_client)
+# LLMは役割ごとにモデル・クライアント・同時呼び出し数・タイムアウトを分ける (model_roles.py の環境変数で指定)
+llms = create_role_llms(session)
+llm = llms["synthesis"]
 
 # タイムアウト時間を延長 (秒単位で指定、例: 60秒)
 request_timeout_sec = 60
@@ -51,23 +65,16 @@ embedding = create_embedding_with_retry(
 Settings.llm = llm
 Settings.embed_model = embedding
 
-# Neo4jへの接続設定
-graph_store = Neo4jPropertyGraphStore(
-    username="neo4j",
-    password="password",
-    url="bolt://neo4j:7687",
-)
-
-# PropertyGraphIndexの作成
-index = PropertyGraphIndex.from_existing(
-    embed_model=embedding,
-    property_graph_store=graph_store,
-    show_progress=True,
-)
 
-def load_documents(source_type, source_path):
+def load_documents(source_type, source_path, fetcher=None):
     """入力ソースの種類に応じてドキュメントをロードする"""
-    if source_type == "wiki":
+    if fetcher is not None and source_type in ("wiki", "web"):
+        # 非同期に並列取得 (接続の再利用・条件付きリクエスト・ローカルキャッシュ)
+        documents = [Document(text=text, metadata=metadata)
+                     for text, metadata in fetch_sources(source_type, expand_sources(source_path), fetcher)]
+        if not documents:
+            raise ValueError(f"取得できたドキュメントがありません: {source_path}")
+    elif source_type == "wiki":
         reader = WikipediaReader()
         documents = reader.load_data(pages=[source_path], lang_prefix="ja")
     elif source_type == "pdf":
@@ -103,38 +110,157 @@ if __name__ == "__main__":
                                  help="入力ソースの種類 ('wiki', 'pdf', 'web' から選択)")
     required_group.add_argument("source_path",
                                  help="入力ソースのパス (wikiの場合はページタイトル, pdfの場合はファイル名, webの場合はURL)")
-    required_group.add_argument("query", help="質問文字列")
+    required_group.add_argument("query", nargs="?",
+                                 help="質問文字列 (省略した場合は投入のみ行う)")
+    add_backend_arguments(parser)
+    add_pipeline_arguments(parser)
+    add_estimate_arguments(parser)
+    add_cache_arguments(parser)
+    add_extractor_arguments(parser)
+    add_profiler_arguments(parser)
+    add_global_search_arguments(parser)
+    add_context_arguments(parser)
+    add_retrieval_arguments(parser)
+    add_fetch_arguments(parser)
+    add_process_profile_arguments(parser)
 
     args = parser.parse_args()
+    check_global_search_arguments(parser, args)
+
+    if args.pipeline and args.budget_policy == "prioritize":
+        parser.error("--budget-policy prioritize はパイプラインモードでは使用できません")
+
+    # テキストチャンクの分割サイズ (文字数)
+    chunk_size = 1000
+
+    # 見積もり・予算で、ルール抽出だけで完結するチャンクをLLM呼び出し無しとして扱う
+    needs_llm = llm_chunk_filter(args)
+
+    # --async-fetch が指定された場合は wiki/web を並列に取得する
+    fetcher = create_fetcher(args)
+
+    # --profile が指定された場合はステージごとにCPU・メモリをプロファイルする
+    process_profiler = start_process_profiler(args)
+
+    if args.dry_run:
+        mark_stage(process_profiler, "estimate")
+        # ドライラン: 解析とチャンク分割のみ行い、LLM・Neo4jには接続しない
+        try:
+            pages = iter_source_pages(args.source_type, args.source_path, fetcher)
+            totals = estimate_ingest((chunk for chunk, _ in iter_chunks(pages, chunk_size)),
+                                     concurrency=args.concurrency,
+                                     llm_latency=args.llm_latency,
+                                     embed_latency=args.embed_latency,
+                                     max_paths_per_chunk=args.max_paths_per_chunk,
+                                     needs_llm=needs_llm)
+        except Exception as e:
+            print(f"ドキュメントの解析中にエラーが発生しました: {e}")
+            exit(1)
+        print(f"見積もり対象: {args.source_path}")
+        print(format_estimate(totals))
+        if args.token_budget is not None:
+            total_tokens = totals["llm_input_tokens"] + totals["llm_output_tokens"]
+            print(f"トークン予算          : {args.token_budget} (見積もり消費 {total_tokens})")
+        exit(0)
+
+    # PropertyGraphIndexの作成 (抽出器の構成は引数で選択)
+    mark_stage(process_profiler, "load_index")
+    # 抽出は extraction、検索時の問い合わせ生成は cypher の役割のLLMで行う
+    index = load_index(args, embedding, llm=llms["cypher"],
+                       kg_extractors=build_kg_extractors(args, llms["extraction"]))
+    # 指定された場合は投入・検索で実行されるCypherをプロファイルする
+    profiler = attach_profiler(args, index)
 
-    # ドキュメントのロード
-    try:
-        documents = load_documents(args.source_type, args.source_path)
-    except ValueError as e:
-        print(f"エラー: {e}")
-        parser.print_help()
-        exit(1)
-    except Exception as e:
-        print(f"ドキュメントのロード中にエラーが発生しました: {e}")
-        parser.print_help()
-        exit(1)
-
-    # ドキュメントの挿入
-    for document in documents:
-        source_info = document.metadata.get('source', '不明なソース')
-        print(f"ドキュメント挿入中: {source_info}")
-        chunk_size = 1000
+    # トークン予算 (未指定の場合は無制限)
+    budget = TokenBudget(args.token_budget, args.max_paths_per_chunk, needs_llm)
+
+    if args.pipeline:
+        # パイプラインモード: ページ単位で読み込み、処理中のチャンク数を上限付きキューで制限する
+        print(f"パイプラインモードで挿入中: {args.source_path}")
+        mark_stage(process_profiler, "pipeline")
+        pipeline = IngestPipeline(index,
+                                  chunk_size=chunk_size,
+                                  max_inflight_chunks=args.max_inflight_chunks,
+                                  workers=args.pipeline_workers,
+                                  report_interval=args.report_interval,
+                                  budget=budget)
+        try:
+            inserted = pipeline.run(iter_source_pages(args.source_type, args.source_path, fetcher))
+        except Exception as e:
+            print(f"パイプライン実行中にエラーが発生しました: {e}")
+            exit(1)
+        print(f"挿入したチャンク数: {inserted}")
+    else:
+        # ドキュメントのロード
+        mark_stage(process_profiler, "load")
+        try:
+            documents = load_documents(args.source_type, args.source_path, fetcher)
+        except ValueError as e:
+            print(f"エラー: {e}")
+            parser.print_help()
+            exit(1)
+        except Exception as e:
+            print(f"ドキュメントのロード中にエラーが発生しました: {e}")
+            parser.print_help()
+            exit(1)
+
+        # ドキュメントの挿入
+        mark_stage(process_profiler, "insert")
+        budget_exhausted = False
+        for document in documents:
+            if budget_exhausted:
+                break
+            source_info = document.metadata.get('source', '不明なソース')
+            print(f"ドキュメント挿入中: {source_info}")
         
-        # LlamaIndexのDocumentはtext属性を使用
-        text_chunks = [document.text[i:i+chunk_size] for i in range(0, len(document.text), chunk_size)]
+            # LlamaIndexのDocumentはtext属性を使用
+            text_chunks = [document.text[i:i+chunk_size] for i in range(0, len(document.text), chunk_size)]
+
+            if args.token_budget is not None and args.budget_policy == "prioritize":
+                # 情報量の多いチャンクを優先して残り予算内に収まるものだけ投入する
+                selected = select_chunks_within_budget(text_chunks, args.token_budget - budget.spent,
+                                                       args.max_paths_per_chunk, needs_llm)
+                print(f"予算内で投入するチャンク: {len(selected)}/{len(text_chunks)}")
+                text_chunks = [text_chunks[i] for i in selected]
         
-        for chunk in text_chunks:
-            logging.info(f"チャンク内容: {chunk}")
-            # LlamaIndexのDocumentを作成
-            chunk_document = Document(text=chunk, metadata=document.metadata)
-            index.insert(chunk_document)
+            for chunk in text_chunks:
+                if not budget.try_charge(chunk):
+                    print("トークン予算に達したため、以降のチャンクの投入を停止します")
+                    budget_exhausted = True
+                    break
+                logging.info(f"チャンク内容: {chunk}")
+                # LlamaIndexのDocumentを作成
+                chunk_document = Document(text=chunk, metadata=document.metadata)
+                index.insert(chunk_document)
+
+    mark_stage(process_profiler, "persist")
+    persist_index(args, index)
+    # 既存ノードの更新だけでも意味キャッシュ・スナップショットが古いと判定されるように変更スタンプを進める
+    mark_graph_updated(args, index)
 
+    if args.token_budget is not None:
+        print(f"消費トークン (見積もり): {budget.spent}/{args.token_budget}")
+
+    if args.query is None:
+        report_profiler(args, profiler)
+        exit(0)
+
+    mark_stage(process_profiler, "query")
+    if args.search_mode == "global":
+        # コミュニティ要約は community_summary.py build で作成したもの (今回の投入分は再作成後に反映される)
+        try:
+            response = answer_globally(args, llm, embedding, args.query)
+        except Exception as e:
+            print(f"グローバル検索中にエラーが発生しました: {e}")
+            exit(1)
+        print(f"質問: {args.query}")
+        print(f"回答: {response}")
+        report_profiler(args, profiler)
+        exit(0)
+
+    # --retrieval-mode khop の場合は起点・近傍・本文を1回の Cypher で取得する (None の場合は既定の検索)
     retriever = index.as_retriever(
+        sub_retrievers=build_sub_retrievers(args, index, embedding, include_text=False),
         include_text=False,
     )
 
@@ -142,8 +268,14 @@ if __name__ == "__main__":
     for record in results:
         print(record.text)
 
-    query_engine = index.as_query_engine()
+    query_engine = index.as_query_engine(
+        sub_retrievers=build_sub_retrievers(args, index, embedding),
+        # 検索結果を重複除去・スコア順に整理し、トークン予算内に収めてから回答を生成する
+        node_postprocessors=build_node_postprocessors(args),
+    )
 
     response = query_engine.query(args.query)
     print(f"質問: {args.query}")
     print(f"回答: {response}")
+
+    report_profiler(args, profiler)
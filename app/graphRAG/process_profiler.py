@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+import tracemalloc
+
+DEFAULT_PROFILE_OUTPUT = "./profile"
+
+# このディレクトリ配下のファイルを自前のコードとして集計する
+OWN_CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 確保元の集計から除くファイル
+_ALLOCATION_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProcessProfiler:
+    """投入・質問応答の処理をステージごとにプロファイルする
+
+    - CPU: 別スレッドから interval 秒ごとに全スレッドのスタックを採取する (サンプリング方式)。
+      待機中のスレッドも数えるため、サンプル数はスレッドごとの経過時間に比例する。
+      スタックの先頭にはステージ名とスレッド名を付け、flamegraph.pl / speedscope で読める
+      folded 形式で書き出す。
+    - メモリ: ステージの区切りごとに tracemalloc のスナップショットを取り、
+      ステージ中に増えた確保量の多い行を集計する。
+    """
+
+    def __init__(self, interval=0.01, frames=10, top=20):
+        self.interval = interval
+        self.frames = frames
+        self.top = top
+        self.stacks = {}
+        self.own_labels = set()
+        self.stages = []
+        self.current_stage = "startup"
+        self._stage_started = time.perf_counter()
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # スナップショットの取得中はサンプリングを止める (プロファイラー自身の処理を計上しない)
+        self._paused = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="process-profiler", daemon=True)
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self._snapshot = tracemalloc.take_snapshot().filter_traces(_ALLOCATION_FILTERS)
+        self._stage_started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if self._paused.is_set():
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stage = self.current_stage
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                labels = []
+                while frame is not None:
+                    label = _frame_label(frame.f_code)
+                    if frame.f_code.co_filename.startswith(OWN_CODE_DIR):
+                        self.own_labels.add(label)
+                    labels.append(label)
+                    frame = frame.f_back
+                labels.append(names.get(ident, str(ident)))
+                labels.append(stage)
+                key = ";".join(reversed(labels))
+                with self._lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def mark(self, stage):
+        """現在のステージを終え、stage を開始する (終えたステージのメモリの増分を記録する)"""
+        now = time.perf_counter()
+        self._paused.set()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_ALLOCATION_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        growth = snapshot.compare_to(self._snapshot, "lineno")
+        self.stages.append({
+            "stage": self.current_stage,
+            "seconds": now - self._stage_started,
+            "current_mb": current / 1024 / 1024,
+            "peak_mb": peak / 1024 / 1024,
+            "growth": [stat for stat in growth if stat.size_diff > 0][:self.top],
+        })
+        logging.info(f"[profile] {self.current_stage}: {now - self._stage_started:.2f} 秒, "
+                     f"確保中 {current / 1024 / 1024:.1f}MB (ピーク {peak / 1024 / 1024:.1f}MB)")
+        tracemalloc.reset_peak()
+        self._snapshot = snapshot
+        self.current_stage = stage
+        self._stage_started = time.perf_counter()
+        self._paused.clear()
+
+    def stop(self):
+        """最後のステージを記録してサンプリングを止める"""
+        if not self._thread.is_alive():
+            return
+        self.mark("stopped")
+        self._stop.set()
+        self._thread.join()
+        tracemalloc.stop()
+
+    def function_costs(self):
+        """関数ごとのサンプル数 (自身, 呼び出し先を含む) を集計する"""
+        self_samples = {}
+        total_samples = {}
+        for key, count in self.stacks.items():
+            labels = key.split(";")[2:]
+            if not labels:
+                continue
+            self_samples[labels[-1]] = self_samples.get(labels[-1], 0) + count
+            for label in set(labels):
+                total_samples[label] = total_samples.get(label, 0) + count
+        return self_samples, total_samples
+
+    def write_folded(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write(f"{key} {count}\n")
+
+    def format_report(self):
+        """ステージごとの時間・メモリと、CPU・メモリの上位を表示用の文字列にする"""
+        total = sum(self.stacks.values()) or 1
+        lines = ["ステージ:"]
+        for stage in self.stages:
+            samples = sum(count for key, count in self.stacks.items() if key.split(";", 1)[0] == stage["stage"])
+            lines.append(f"  {stage['stage']:<12} {stage['seconds']:8.2f} 秒  CPUサンプル {samples:6d}  "
+                         f"確保中 {stage['current_mb']:8.1f}MB  ピーク {stage['peak_mb']:8.1f}MB")
+
+        self_samples, total_samples = self.function_costs()
+        lines.append(f"CPU: 自身のサンプル数の多い関数 (全 {total} サンプル, 間隔 {self.interval * 1000:g}ms):")
+        for label, count in sorted(self_samples.items(), key=lambda item: -item[1])[:self.top]:
+            lines.append(f"  {count / total:6.1%}  {label}")
+        lines.append("CPU: 自前のコード (呼び出し先を含む):")
+        own = {label: count for label, count in total_samples.items() if label in self.own_labels}
+        for label, count in sorted(own.items(), key=lambda item: -item[1])[:self.top]:
+            lines.append(f"  {count / total:6.1%}  {label}")
+
+        for stage in self.stages:
+            if not stage["growth"]:
+                continue
+            lines.append(f"メモリ: {stage['stage']} で増えた確保元:")
+            for stat in stage["growth"]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size_diff / 1024:10.1f}KB  {stat.count_diff:+8d} 個  "
+                             f"{self._relative(frame.filename)}:{frame.lineno}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _relative(filename):
+        for prefix in [OWN_CODE_DIR] + sorted(sys.path, key=len, reverse=True):
+            if prefix and filename.startswith(prefix + os.sep):
+                return os.path.relpath(filename, prefix)
+        return filename
+
+    def write(self, output):
+        """{output}.folded (フレームグラフ) と {output}.txt (レポート) を書き出す"""
+        directory = os.path.dirname(os.path.abspath(output))
+        os.makedirs(directory, exist_ok=True)
+        self.write_folded(f"{output}.folded")
+        report = self.format_report()
+        with open(f"{output}.txt", "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+        return report
+
+
+def start_process_profiler(args):
+    """--profile が指定された場合はプロファイラーを開始し、終了時に結果を書き出すよう登録する"""
+    if not args.profile:
+        return None
+    profiler = ProcessProfiler(interval=args.profile_interval, top=args.profile_alloc_top).start()
+
+    def finish():
+        profiler.stop()
+        print(profiler.write(args.profile_output))
+        print(f"フレームグラフ (folded 形式): {args.profile_output}.folded "
+              "(flamegraph.pl または https://www.speedscope.app で表示)")
+        print(f"レポート: {args.profile_output}.txt")
+
+    # exit() で終了する経路も含めて、必ず結果を書き出す
+    atexit.register(finish)
+    return profiler
+
+
+def mark_stage(profiler, stage):
+    """プロファイラーが有効な場合はステージの区切りを記録する"""
+    if profiler is not None:
+        profiler.mark(stage)
+
+
+def add_process_profile_arguments(parser):
+    """CPU・メモリのプロファイル用の引数を追加する"""
+    group = parser.add_argument_group('CPU・メモリのプロファイル')
+    group.add_argument("--profile", action="store_true",
+                       help="CPUのサンプリングとステージごとの tracemalloc スナップショットを取り、\n"
+                            "フレームグラフ (folded 形式) と確保元の上位のレポートを書き出す")
+    group.add_argument("--profile-output", default=DEFAULT_PROFILE_OUTPUT,
+                       help=f"出力ファイルの接頭辞 (既定: {DEFAULT_PROFILE_OUTPUT} → .folded と .txt)")
+    group.add_argument("--profile-interval", type=float, default=0.01,
+                       help="CPUのサンプリング間隔 (秒, 既定: 0.01)")
+    group.add_argument("--profile-alloc-top", type=int, default=20,
+                       help="表示する関数・確保元の件数 (既定: 20)")
+    return group
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import unicodedata
+
+DEFAULT_SCHEMA_CACHE_PATH = os.getenv("GRAPH_SCHEMA_CACHE_PATH", ".graph_schema_cache.json")
+DEFAULT_CYPHER_CACHE_PATH = os.getenv("GRAPH_CYPHER_CACHE_PATH", ".graph_cypher_cache.db")
+
+# テンプレート化に使うエンティティ名の上限
+MAX_ENTITY_NAMES = 100000
+
+# ラベル・リレーション型・プロパティキーとノード数・リレーション数はカウントストア等から取得でき、
+# APOCによるスキーマ走査 (refresh_schema) に比べて十分に軽い
+SCHEMA_VERSION_QUERY = """
+CALL db.labels() YIELD label
+WITH collect(label) AS labels
+CALL db.relationshipTypes() YIELD relationshipType
+WITH labels, collect(relationshipType) AS types
+CALL db.propertyKeys() YIELD propertyKey
+WITH labels, types, collect(propertyKey) AS keys
+CALL () { MATCH (n) RETURN count(n) AS nodes }
+CALL () { MATCH ()-[r]->() RETURN count(r) AS relationships }
+RETURN labels, types, keys, nodes, relationships
+"""
+
+ENTITY_NAMES_QUERY = "MATCH (n:`__Entity__`) RETURN n.id AS name LIMIT $limit"
+
+
+def schema_version(graph):
+    """グラフのスキーマが変わったかを判定するためのバージョン文字列を返す"""
+    row = graph.query(SCHEMA_VERSION_QUERY)[0]
+    stamp = json.dumps([sorted(row["labels"]), sorted(row["types"]), sorted(row["keys"]),
+                        row["nodes"], row["relationships"]])
+    return hashlib.sha256(stamp.encode("utf-8")).hexdigest()
+
+
+def apply_schema_cache(graph, cache_path=DEFAULT_SCHEMA_CACHE_PATH):
+    """バージョンが一致すればキャッシュ済みのスキーマを graph に設定し、そうでなければ再取得して保存する
+
+    graph は refresh_schema=False で作成しておくこと。
+    戻り値はスキーマのバージョンとテンプレート化用のエンティティ名の一覧。
+    """
+    version = schema_version(graph)
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("version") == version:
+            logging.info("キャッシュ済みのグラフスキーマを使用します")
+            graph.schema = cached["schema"]
+            graph.structured_schema = cached["structured_schema"]
+            return version, cached["entity_names"]
+
+    logging.info("グラフスキーマを再取得します")
+    graph.refresh_schema()
+    entity_names = [row["name"] for row in graph.query(ENTITY_NAMES_QUERY, {"limit": MAX_ENTITY_NAMES})
+                    if row["name"]]
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": version,
+            "schema": graph.schema,
+            "structured_schema": graph.structured_schema,
+            "entity_names": entity_names,
+        }, f, ensure_ascii=False)
+    return version, entity_names
+
+
+def normalize_question(question):
+    """表記ゆれ (全角/半角・空白・末尾の記号) を吸収した質問文を返す"""
+    question = unicodedata.normalize("NFKC", question)
+    question = re.sub(r"\s+", " ", question).strip()
+    return question.rstrip("?？。.!！ ")
+
+
+def templatize(question, entity_names):
+    """質問中の既知のエンティティ名をパラメーター ({p0}, {p1}, ...) に置き換える
+
+    長い名前から順に、重ならない出現位置だけを置き換える。
+    """
+    spans = []
+    for name in sorted({n for n in entity_names if n and n in question}, key=len, reverse=True):
+        start = question.find(name)
+        while start != -1:
+            end = start + len(name)
+            if all(end <= s or start >= e for s, e, _ in spans):
+                spans.append((start, end, name))
+            start = question.find(name, end)
+
+    template = question
+    params = {}
+    for i, (start, end, name) in enumerate(sorted(spans)):
+        params[f"p{i}"] = name
+    for i, (start, end, name) in reversed(list(enumerate(sorted(spans)))):
+        template = template[:start] + "{" + f"p{i}" + "}" + template[end:]
+    return template, params
+
+
+def parameterize_cypher(cypher, params):
+    """生成されたCypher中の文字列リテラルをパラメーター ($p0, ...) に置き換える
+
+    すべてのパラメーターを置き換えられなかった場合は None を返す。
+    """
+    for key, value in params.items():
+        replaced = re.sub(r"(['\"])" + re.escape(value) + r"\1", f"${key}", cypher)
+        if replaced == cypher:
+            return None
+        cypher = replaced
+    return cypher
+
+
+class CypherCache:
+    """スキーマのバージョンと質問 (またはテンプレート) をキーに、生成されたCypherを保存する"""
+
+    def __init__(self, path=DEFAULT_CYPHER_CACHE_PATH):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cypher_cache ("
+            " schema_version TEXT NOT NULL,"
+            " question TEXT NOT NULL,"
+            " cypher TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " PRIMARY KEY (schema_version, question))"
+        )
+        self._conn.commit()
+
+    def get(self, version, question):
+        row = self._conn.execute(
+            "SELECT cypher FROM cypher_cache WHERE schema_version = ? AND question = ?",
+            (version, question),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, version, question, cypher):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cypher_cache (schema_version, question, cypher, created_at) VALUES (?, ?, ?, ?)",
+            (version, question, cypher, time.time()),
+        )
+        self._conn.commit()
+
+
+class CachedGraphCypherQA:
+    """GraphCypherQAChain の前段でCypherをキャッシュし、ヒットした場合はCypher生成のLLM呼び出しを省略する
+
+    chain は return_intermediate_steps=True で作成しておくこと (生成されたCypherを取得するため)。
+    """
+
+    def __init__(self, chain, graph, schema_version, entity_names, cache=None):
+        self.chain = chain
+        self.graph = graph
+        self.schema_version = schema_version
+        self.entity_names = entity_names
+        self.cache = cache or CypherCache()
+
+    def _answer(self, question, context):
+        if self.chain.return_direct:
+            return context
+        result = self.chain.qa_chain.invoke({"question": question, "context": context})
+        if isinstance(result, dict):
+            return result[self.chain.qa_chain.output_key]
+        return result
+
+    def invoke(self, inputs):
+        question = inputs[self.chain.input_key]
+        normalized = normalize_question(question)
+        template, params = templatize(normalized, self.entity_names)
+
+        cypher = self.cache.get(self.schema_version, normalized)
+        query_params = {}
+        if cypher is None and params:
+            cypher = self.cache.get(self.schema_version, template)
+            query_params = params
+        if cypher is not None:
+            logging.info(f"キャッシュ済みのCypherを使用します: {cypher}")
+            context = self.graph.query(cypher, query_params)[: self.chain.top_k]
+            return {
+                self.chain.input_key: question,
+                self.chain.output_key: self._answer(question, context),
+                "cypher": cypher,
+            }
+
+        result = self.chain.invoke(inputs)
+        generated = result["intermediate_steps"][0]["query"]
+        if generated:
+            self.cache.put(self.schema_version, normalized, generated)
+            parameterized = parameterize_cypher(generated, params) if params else None
+            if parameterized is not None:
+                self.cache.put(self.schema_version, template, parameterized)
+        result["cypher"] = generated
+        return result
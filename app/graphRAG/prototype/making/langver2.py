@@ -4,7 +4,8 @@ from langchain_aws import BedrockEmbeddings
 from langchain_neo4j import Neo4jGraph
 from langchain_community.document_loaders import WikipediaLoader
 from langchain.chains import GraphCypherQAChain
-from langchain.prompts import PromptTemplate
+from structured_graph import StructuredGraphExtractor, validate_graph, write_graph
+from cypher_cache import CachedGraphCypherQA, apply_schema_cache
 import boto3
 
 # boto3セッションの初期化
@@ -28,7 +29,8 @@ documents = loader.load()
 url = "bolt://neo4j:7687"
 username = "neo4j"
 password = "password"
-graph = Neo4jGraph(url=url, username=username, password=password)
+# スキーマは質問応答の直前にキャッシュから設定するため、接続時には取得しない
+graph = Neo4jGraph(url=url, username=username, password=password, refresh_schema=False)
 
 #  知識グラフの構築 (Langchainでは知識グラフの自動構築は直接的にはサポートされていません。
 #  以下は、シンプルな例として、ドキュメントからエンティティと関係を抽出するプロンプトの例です。
@@ -43,28 +45,29 @@ graph = Neo4jGraph(url=url, username=username, password=password)
 #  のようなパイプラインを構築する必要があります。
 
 def build_graph_from_documents(documents, graph, llm):
+    # LLMには構造化出力 (ノードとリレーションシップ) で抽出させ、生のCypherは実行しない
+    # 抽出結果はドキュメントのハッシュでキャッシュされるため、同じドキュメントではLLMを呼び出さない
+    extractor = StructuredGraphExtractor(llm)
+    nodes = []
+    relationships = []
     for document in documents:
         content = document.page_content
-        prompt = PromptTemplate.from_template("""
-            与えられたテキストからエンティティと関係を抽出し、Neo4jのCypherクエリに変換してください。
-            エンティティはノードとして、関係はリレーションシップとして表現してください。
-            テキスト: {text}
-            """)
-        cypher_generation_chain = prompt | llm
-        cypher_query = cypher_generation_chain.invoke({"text": content})
-
-        #  **重要**: 生成されたCypherクエリは例示であり、実際のテキスト内容に合わせて調整が必要です。
-        #  また、この例では簡易的なプロンプトを使用しているため、複雑なテキストに対しては適切なクエリが生成されない可能性があります。
-        #  より高度な知識グラフ構築には、NERと関係抽出モデルの導入と、それらをLangchainで連携させる必要があります。
-
         try:
-            graph.query(cypher_query.content) #  Bedrock LLMのResponseContentは.contentでアクセス
-            print("Cypherクエリ実行成功")
-            print(cypher_query.content)
-
+            extracted = extractor.extract(content)
         except Exception as e:
-            print(f"Cypherクエリ実行失敗: {e}")
-            print(cypher_query.content)
+            print(f"エンティティ抽出失敗: {e}")
+            continue
+        document_nodes, document_relationships = validate_graph(extracted)
+        print(f"抽出結果: ノード {len(document_nodes)} 件, リレーションシップ {len(document_relationships)} 件")
+        nodes.extend(document_nodes)
+        relationships.extend(document_relationships)
+
+    # パラメーター化したUNWINDでまとめて投入 (失敗したバッチは1件ずつ再投入して失敗行だけを除外)
+    result = write_graph(graph, nodes, relationships)
+    print(f"投入成功: ノード {result['nodes']} 件, リレーションシップ {result['relationships']} 件")
+    if result["failed_nodes"] or result["failed_relationships"]:
+        print(f"投入失敗: ノード {len(result['failed_nodes'])} 件, "
+              f"リレーションシップ {len(result['failed_relationships'])} 件")
 
 
 # ドキュメントからグラフを構築 (簡易的な例)
@@ -80,16 +83,23 @@ build_graph_from_documents(documents, graph, llm)
 #  **より高度な知識グラフ活用例 (GraphCypherQAChain)**
 #  以下は、構築したグラフに対して質問応答を行う例です。
 
+# グラフが変わっていなければ前回取得したスキーマを使う (APOCによるスキーマ走査を省略)
+schema_version, entity_names = apply_schema_cache(graph)
+
 graph_cypher_qa_chain = GraphCypherQAChain.from_llm(
     llm,
     graph=graph,
     verbose=True,
     allow_dangerous_requests=True,
+    return_intermediate_steps=True,
 )
+# 同じ質問 (またはエンティティ名だけが異なる質問) では生成済みのCypherを再利用する
+graph_cypher_qa_chain = CachedGraphCypherQA(graph_cypher_qa_chain, graph, schema_version, entity_names)
 
 #  Neo4j にデータを投入後、質問応答を実行
 query = "ラオウは誰ですか？" #  日本語で質問
 # DeprecationWarning: Chain.run is deprecated, use .invoke() instead
 result = graph_cypher_qa_chain.invoke({"query": query})
 print(f"質問: {query}")
-print(f"回答: {result}")
+print(f"Cypher: {result['cypher']}")
+print(f"回答: {result['result']}")
@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import logging
+from typing import List
+from pydantic import BaseModel, Field
+from langchain.prompts import PromptTemplate
+
+# 抽出プロンプトやスキーマを変更した場合はこの値を上げてキャッシュを無効にする
+EXTRACT_PROMPT_VERSION = "1"
+
+DEFAULT_CACHE_DIR = os.getenv("GRAPH_EXTRACT_CACHE_DIR", ".graph_extract_cache")
+
+# langchain の add_graph_documents と同じ共通ラベル (id に一意制約を張る)
+BASE_ENTITY_LABEL = "__Entity__"
+
+EXTRACT_PROMPT = PromptTemplate.from_template("""
+与えられたテキストからエンティティと関係を抽出してください。
+エンティティはノードとして、関係はリレーションシップとして表現してください。
+- ノードの id はエンティティの名前、type は種類 (例: 人物, 組織, 場所) とします。
+- リレーションシップの source と target はノードの id を使い、type は関係の名前とします。
+テキスト: {text}
+""")
+
+
+class GraphNode(BaseModel):
+    """抽出されたノード"""
+    id: str = Field(description="エンティティの名前")
+    type: str = Field(description="エンティティの種類")
+    properties: dict = Field(default_factory=dict, description="エンティティの属性 (文字列または数値)")
+
+
+class GraphRelationship(BaseModel):
+    """抽出されたリレーションシップ"""
+    source: str = Field(description="始点ノードの id")
+    target: str = Field(description="終点ノードの id")
+    type: str = Field(description="関係の名前")
+    properties: dict = Field(default_factory=dict, description="関係の属性 (文字列または数値)")
+
+
+class ExtractedGraph(BaseModel):
+    """テキストから抽出したノードとリレーションシップ"""
+    nodes: List[GraphNode] = Field(default_factory=list)
+    relationships: List[GraphRelationship] = Field(default_factory=list)
+
+
+MERGE_NODES_QUERY = f"""
+UNWIND $rows AS row
+CALL apoc.merge.node(['{BASE_ENTITY_LABEL}'], {{id: row.id}}, row.properties, row.properties) YIELD node
+CALL apoc.create.addLabels(node, [row.type]) YIELD node AS labelled
+RETURN count(*) AS count
+"""
+
+MERGE_RELATIONSHIPS_QUERY = f"""
+UNWIND $rows AS row
+MATCH (s:`{BASE_ENTITY_LABEL}` {{id: row.source}})
+MATCH (t:`{BASE_ENTITY_LABEL}` {{id: row.target}})
+CALL apoc.merge.relationship(s, row.type, {{}}, row.properties, t, row.properties) YIELD rel
+RETURN count(*) AS count
+"""
+
+
+def _clean_properties(properties):
+    """Neo4jに保存できるスカラー値 (と、そのリスト) だけを残す"""
+    cleaned = {}
+    for key, value in (properties or {}).items():
+        if key in ("id", "type") or value is None:
+            continue
+        if isinstance(value, (str, int, float, bool)):
+            cleaned[key] = value
+        elif isinstance(value, list) and all(isinstance(v, (str, int, float, bool)) for v in value):
+            cleaned[key] = value
+        else:
+            cleaned[key] = json.dumps(value, ensure_ascii=False)
+    return cleaned
+
+
+def validate_graph(extracted):
+    """抽出結果を検証し、投入用の行 (nodes, relationships) に変換する
+
+    空の id/type は除外し、存在しないノードを参照するリレーションシップは捨てる。
+    """
+    nodes = {}
+    for node in extracted.nodes:
+        node_id = node.id.strip()
+        node_type = node.type.strip()
+        if not node_id or not node_type:
+            logging.warning(f"不正なノードを除外しました: {node}")
+            continue
+        nodes[node_id] = {"id": node_id, "type": node_type, "properties": _clean_properties(node.properties)}
+
+    relationships = []
+    for rel in extracted.relationships:
+        source, target, rel_type = rel.source.strip(), rel.target.strip(), rel.type.strip()
+        if source not in nodes or target not in nodes or not rel_type:
+            logging.warning(f"不正なリレーションシップを除外しました: {rel}")
+            continue
+        relationships.append({"source": source, "target": target, "type": rel_type,
+                              "properties": _clean_properties(rel.properties)})
+    return list(nodes.values()), relationships
+
+
+class StructuredGraphExtractor:
+    """LLMに構造化出力 (ExtractedGraph) で抽出させ、結果をドキュメントのハッシュでキャッシュする"""
+
+    def __init__(self, llm, cache_dir=DEFAULT_CACHE_DIR):
+        self.chain = EXTRACT_PROMPT | llm.with_structured_output(ExtractedGraph)
+        self.model_id = getattr(llm, "model_id", "") or ""
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, text):
+        key = f"{EXTRACT_PROMPT_VERSION}:{self.model_id}:{text}"
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def extract(self, text):
+        path = self._cache_path(text)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return ExtractedGraph.model_validate_json(f.read())
+
+        extracted = self.chain.invoke({"text": text})
+        if extracted is None:
+            extracted = ExtractedGraph()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(extracted.model_dump_json())
+        return extracted
+
+
+def _write_rows(graph, query, rows, batch_size, kind):
+    """rows を batch_size 件ずつ1トランザクションで投入する
+
+    バッチが失敗した場合は1件ずつ再投入し、失敗した行だけを返す。
+    """
+    failed = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        try:
+            graph.query(query, {"rows": batch})
+        except Exception as e:
+            logging.warning(f"{kind} のバッチ投入に失敗したため1件ずつ再投入します: {e}")
+            for row in batch:
+                try:
+                    graph.query(query, {"rows": [row]})
+                except Exception as row_error:
+                    logging.error(f"{kind} の投入に失敗しました: {row} ({row_error})")
+                    failed.append(row)
+    return failed
+
+
+def ensure_constraints(graph):
+    graph.query(f"CREATE CONSTRAINT IF NOT EXISTS FOR (n:`{BASE_ENTITY_LABEL}`) REQUIRE n.id IS UNIQUE")
+
+
+def write_graph(graph, nodes, relationships, batch_size=500):
+    """ノード → リレーションシップの順にパラメーター化したUNWINDで投入する"""
+    ensure_constraints(graph)
+    failed_nodes = _write_rows(graph, MERGE_NODES_QUERY, nodes, batch_size, "ノード")
+    failed_relationships = _write_rows(graph, MERGE_RELATIONSHIPS_QUERY, relationships, batch_size, "リレーションシップ")
+    return {
+        "nodes": len(nodes) - len(failed_nodes),
+        "relationships": len(relationships) - len(failed_relationships),
+        "failed_nodes": failed_nodes,
+        "failed_relationships": failed_relationships,
+    }
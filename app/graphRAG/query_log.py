@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from semantic_cache import cache_scope, normalize_question
+
+DEFAULT_QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH")
+
+# 集計を残す日数 (これより古い日の行は記録時に削除する)
+DEFAULT_RETENTION_DAYS = 30
+
+SECONDS_PER_DAY = 86400
+
+
+class QueryLog:
+    """質問の頻度を日ごとに集計するローカルログ
+
+    質問1件ごとの行は作らず、(スコープ, 日, 正規化した質問) ごとに件数と最終時刻だけを保存する。
+    同じ質問が何度来ても1日1行にしかならないため、常時記録してもファイルは小さいままになる。
+    """
+
+    def __init__(self, path, retention_days=DEFAULT_RETENTION_DAYS):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_log ("
+            " scope TEXT NOT NULL,"
+            " day INTEGER NOT NULL,"
+            " question TEXT NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " last_seen REAL NOT NULL,"
+            " PRIMARY KEY (scope, day, question))"
+        )
+        self._conn.commit()
+
+    def record(self, scope, question, now=None):
+        """質問を1件記録し、保存期間を過ぎた日の集計を削除する"""
+        now = time.time() if now is None else now
+        day = int(now // SECONDS_PER_DAY)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO query_log (scope, day, question, count, last_seen) VALUES (?, ?, ?, 1, ?)"
+                " ON CONFLICT (scope, day, question) DO UPDATE SET count = count + 1, last_seen = excluded.last_seen",
+                (scope, day, normalize_question(question), now))
+            self._conn.execute("DELETE FROM query_log WHERE day < ?", (day - self.retention_days,))
+            self._conn.commit()
+
+    def top_questions(self, scope, limit, days, now=None):
+        """直近 days 日の質問を件数の多い順 (同数は新しい順) に [(質問, 件数)] で返す"""
+        now = time.time() if now is None else now
+        since = int(now // SECONDS_PER_DAY) - days + 1
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question, SUM(count) AS total FROM query_log WHERE scope = ? AND day >= ?"
+                " GROUP BY question ORDER BY total DESC, MAX(last_seen) DESC LIMIT ?",
+                (scope, since, limit)).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_query_log(args):
+    """--query-log が指定された場合は QueryLog を作成する (無い場合は None)"""
+    if not args.query_log:
+        return None
+    return QueryLog(args.query_log, retention_days=args.query_log_retention)
+
+
+def log_question(args, question):
+    """--query-log が指定された場合は質問を記録する
+
+    ファイルを開けない・ロックされている場合も含め、記録に失敗しても質問応答は続ける。
+    """
+    if not args.query_log:
+        return
+    try:
+        query_log = create_query_log(args)
+        try:
+            query_log.record(cache_scope(args), question)
+        finally:
+            query_log.close()
+    except Exception as e:
+        logging.warning(f"質問ログに記録できませんでした: {e}")
+
+
+def add_query_log_arguments(parser):
+    """質問ログ用の引数を追加する"""
+    group = parser.add_argument_group('質問ログ')
+    group.add_argument("--query-log", default=DEFAULT_QUERY_LOG_PATH,
+                       help="質問の頻度を日ごとに集計するSQLiteファイルのパス\n"
+                            "(query_warmup.py が起動時に頻度の高い質問を再生してキャッシュを温める)")
+    group.add_argument("--query-log-retention", type=int, default=DEFAULT_RETENTION_DAYS,
+                       help=f"集計を残す日数 (既定: {DEFAULT_RETENTION_DAYS})")
+    return group
@@ -3,11 +3,18 @@ import os
 import argparse
 import logging
 import tenacity
-from llama_index.llms.bedrock import Bedrock
+from bedrock_archive import create_bedrock_client
+from model_roles import create_role_llms
 from llama_index.embeddings.bedrock import BedrockEmbedding
 from llama_index.core.settings import Settings
-from llama_index.graph_stores.neo4j import Neo4jPropertyGraphStore
-from llama_index.core import PropertyGraphIndex
+from graph_backend import add_backend_arguments, load_index
+from query_profiler import add_profiler_arguments, attach_profiler, report_profiler
+from community_summary import add_global_search_arguments, answer_globally, check_global_search_arguments
+from context_pruning import add_context_arguments, build_node_postprocessors
+from khop_retriever import add_retrieval_arguments, build_sub_retrievers
+from process_profiler import add_process_profile_arguments, mark_stage, start_process_profiler
+from semantic_cache import add_semantic_cache_arguments, create_semantic_cache, lookup_answer, remember_answer
+from query_log import add_query_log_arguments, log_question
 
 # ログレベルを INFO に設定 (必要に応じて変更可能)
 logging.basicConfig(level=logging.INFO)
@@ -19,10 +26,13 @@ session = boto3.Session(
     region_name=os.getenv('AWS_DEFAULT_REGION')
 )
 
-bedrock_client = session.client('bedrock-runtime')
+# BEDROCK_ARCHIVE_MODE=record/replay の場合は要求・応答を記録/再生するクライアントになる
+bedrock_client = create_bedrock_client(session)
 
 # LLMとEmbeddingの設定
-llm = Bedrock(model="anthropic.claude-3-haiku-20240307-v1:0", client=bedrock_client)
+# LLMは役割ごとにモデル・クライアント・同時呼び出し数・タイムアウトを分ける (model_roles.py の環境変数で指定)
+llms = create_role_llms(session, ["synthesis", "cypher"])
+llm = llms["synthesis"]
 
 # タイムアウト時間を延長 (秒単位で指定、例: 60秒)
 request_timeout_sec = 60
@@ -49,20 +59,6 @@ embedding = create_embedding_with_retry(
 Settings.llm = llm
 Settings.embed_model = embedding
 
-# Neo4jへの接続設定
-graph_store = Neo4jPropertyGraphStore(
-    username="neo4j",
-    password="password",
-    url="bolt://neo4j:7687",
-)
-
-# PropertyGraphIndexの作成 (既存のインデックスからロード)
-index = PropertyGraphIndex.from_existing(
-    embed_model=embedding,
-    property_graph_store=graph_store,
-    show_progress=True,
-)
-
 
 if __name__ == "__main__":
     # 引数パーサーの作成 (質問文字列のみ)
@@ -72,23 +68,85 @@ if __name__ == "__main__":
     # 必須引数 (質問文字列)
     required_group = parser.add_argument_group('必須引数')
     required_group.add_argument("query", help="質問文字列")
+    add_backend_arguments(parser)
+    add_profiler_arguments(parser)
+    add_global_search_arguments(parser)
+    add_context_arguments(parser)
+    add_retrieval_arguments(parser)
+    add_process_profile_arguments(parser)
+    add_semantic_cache_arguments(parser)
+    add_query_log_arguments(parser)
 
     args = parser.parse_args()
-
+    check_global_search_arguments(parser, args)
+
+    # --profile が指定された場合はステージごとにCPU・メモリをプロファイルする
+    process_profiler = start_process_profiler(args)
+
+    # 質問の頻度を記録する (query_warmup.py が起動時に頻度の高い質問を再生してキャッシュを温める)
+    log_question(args, args.query)
+
+    # 意味キャッシュ: 言い回しの違う同じ質問には、グラフが更新されていなければ保存済みの回答を返す
+    semantic_cache = create_semantic_cache(args)
+    cache_context = None
+    if semantic_cache is not None:
+        mark_stage(process_profiler, "semantic_cache")
+        try:
+            cached, cache_context = lookup_answer(args, semantic_cache, embedding, args.query)
+        except Exception as e:
+            logging.warning(f"意味キャッシュを参照できませんでした: {e}")
+            cached = None
+        if cached is not None:
+            print(f"質問: {args.query}")
+            print(f"回答: {cached['answer']}")
+            print(f"(保存済みの回答: 類似度 {cached['score']:.3f}, 元の質問 「{cached['question']}」)")
+            exit(0)
+
+    if args.search_mode == "global":
+        mark_stage(process_profiler, "global_search")
+        # 事前に作成したコミュニティ要約から回答する (トリプレットは辿らない)
+        try:
+            response = answer_globally(args, llm, embedding, args.query)
+        except Exception as e:
+            print(f"グローバル検索中にエラーが発生しました: {e}")
+            exit(1)
+        print(f"質問: {args.query}")
+        print(f"回答: {response}")
+        remember_answer(semantic_cache, cache_context, args.query, str(response))
+        exit(0)
+
+    # PropertyGraphIndexの作成 (既存のインデックスからロード)
+    mark_stage(process_profiler, "load_index")
+    # 検索時の問い合わせ生成 (キーワード・同義語の抽出) は cypher の役割のLLMで行う
+    index = load_index(args, embedding, llm=llms["cypher"])
+    # 指定された場合は検索で実行されるCypherをプロファイルする
+    profiler = attach_profiler(args, index)
+
+    # --retrieval-mode khop の場合は起点・近傍・本文を1回の Cypher で取得する (None の場合は既定の検索)
     retriever = index.as_retriever(
+        sub_retrievers=build_sub_retrievers(args, index, embedding, include_text=False),
         include_text=False,
     )
 
+    mark_stage(process_profiler, "retrieve")
     results = retriever.retrieve(args.query)
     for record in results:
         print(record.text)
 
     # クエリエンジンの作成
-    query_engine = index.as_query_engine()
+    query_engine = index.as_query_engine(
+        sub_retrievers=build_sub_retrievers(args, index, embedding),
+        # 検索結果を重複除去・スコア順に整理し、トークン予算内に収めてから回答を生成する
+        node_postprocessors=build_node_postprocessors(args),
+    )
 
     # 質問応答を実行
+    mark_stage(process_profiler, "query")
     response = query_engine.query(args.query)
 
     # 質問と回答を標準出力に表示
     print(f"質問: {args.query}")
     print(f"回答: {response}")
+    remember_answer(semantic_cache, cache_context, args.query, str(response))
+
+    report_profiler(args, profiler)
@@ -0,0 +1,223 @@
+import re
+import json
+import time
+import logging
+import threading
+from collections import defaultdict
+
+# 呼び出し元として記録する Neo4jPropertyGraphStore のメソッド (投入系と検索系)
+PROFILED_METHODS = ["upsert_nodes", "upsert_relations", "get", "get_triplets", "get_rel_map",
+                    "vector_query", "delete"]
+
+# インデックスを使ったことを示すオペレーター (名前の部分一致)
+INDEX_OPERATORS = ["IndexSeek", "IndexScan", "IndexContainsScan", "IndexEndsWithScan"]
+# 全件・ラベル全体を走査するオペレーター
+SCAN_OPERATORS = ["AllNodesScan", "NodeByLabelScan", "RelationshipTypeScan", "AllRelationshipsScan"]
+
+_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+
+
+def statement_shape(query):
+    """空白とリテラルを正規化し、同じ形のCypherを同一視するためのキーを返す"""
+    return _LITERAL_PATTERN.sub("?", " ".join(query.split()))
+
+
+def params_shape(params):
+    """パラメーターの値ではなく型と件数だけを表す文字列を返す (埋め込みベクトルを出力しないため)"""
+    def shape(value):
+        if isinstance(value, list):
+            inner = shape(value[0]) if value else ""
+            return f"list[{len(value)}]{('<' + inner + '>') if inner else ''}"
+        if isinstance(value, dict):
+            return "{" + ", ".join(f"{k}: {shape(v)}" for k, v in sorted(value.items())) + "}"
+        return type(value).__name__
+    return ", ".join(f"{key}: {shape(value)}" for key, value in sorted((params or {}).items()))
+
+
+def _walk_plan(plan):
+    """PROFILE の実行計画を辿り、db hits の合計と使われたオペレーターを集める"""
+    db_hits = 0
+    operators = []
+    stack = [plan]
+    while stack:
+        operator = stack.pop()
+        db_hits += operator.get("dbHits", 0)
+        operator_type = operator.get("operatorType", "")
+        # 例: "NodeIndexSeek@neo4j" → "NodeIndexSeek"
+        operator_type = operator_type.split("@")[0]
+        # ベクトルインデックス・全文インデックスはプロシージャ呼び出しとして現れる
+        if operator_type == "ProcedureCall" and "db.index." in str(operator.get("args", {}).get("Details", "")):
+            operator_type = "ProcedureIndexScan"
+        operators.append(operator_type)
+        stack.extend(operator.get("children", []))
+    return db_hits, operators
+
+
+class CypherProfiler:
+    """グラフストアが実行するCypherを PROFILE 付きで実行し、文の形ごとに集計する
+
+    元の文の代わりに PROFILE 付きの文を1回だけ実行するため、書き込み文が二重に実行されることはない。
+    PROFILE を付けられない文 (CALL ... IN TRANSACTIONS など) は時間だけを記録する。
+    """
+
+    def __init__(self, graph_store):
+        self.graph_store = graph_store
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._original_query = graph_store.structured_query
+        self._originals = {}
+
+    def attach(self):
+        """グラフストアの structured_query と呼び出し元のメソッドを差し替える"""
+        self.graph_store.structured_query = self._profiled_query
+        for name in PROFILED_METHODS:
+            method = getattr(self.graph_store, name, None)
+            if method is None:
+                continue
+            self._originals[name] = method
+            setattr(self.graph_store, name, self._track_caller(name, method))
+        return self
+
+    def detach(self):
+        self.graph_store.structured_query = self._original_query
+        for name, method in self._originals.items():
+            setattr(self.graph_store, name, method)
+        self._originals = {}
+
+    def _track_caller(self, name, method):
+        def wrapper(*args, **kwargs):
+            previous = getattr(self._local, "caller", None)
+            self._local.caller = name
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.caller = previous
+        return wrapper
+
+    def _run_profile(self, query, params):
+        """PROFILE 付きで実行し、(結果, 実行計画) を返す"""
+        from neo4j import Query
+        from llama_index.graph_stores.neo4j.neo4j_property_graph import value_sanitize
+
+        store = self.graph_store
+        with store.client.session(database=store._database) as session:
+            result = session.run(Query(text="PROFILE " + query, timeout=store._timeout), params)
+            data = [record.data() for record in result]
+            summary = result.consume()
+        if store.sanitize_query_output:
+            data = [value_sanitize(row) for row in data]
+        return data, summary.profile
+
+    def _profiled_query(self, query, param_map=None):
+        params = param_map or {}
+        start = time.perf_counter()
+        plan = None
+        try:
+            data, plan = self._run_profile(query, params)
+        except Exception as e:
+            logging.debug(f"PROFILE を付けずに実行します: {e}")
+            start = time.perf_counter()
+            data = self._original_query(query, param_map)
+        elapsed = time.perf_counter() - start
+
+        record = {
+            "caller": getattr(self._local, "caller", None) or "structured_query",
+            "shape": statement_shape(query),
+            "params": params_shape(params),
+            "elapsed_sec": elapsed,
+            "rows": len(data) if isinstance(data, list) else 0,
+            "db_hits": None,
+            "operators": [],
+        }
+        if plan:
+            record["db_hits"], record["operators"] = _walk_plan(plan)
+        with self._lock:
+            self.records.append(record)
+        return data
+
+    def aggregate(self):
+        """文の形ごとに回数・時間・db hits・インデックス使用の有無を集計し、合計時間の降順で返す"""
+        groups = defaultdict(list)
+        for record in self.records:
+            groups[(record["caller"], record["shape"])].append(record)
+
+        report = []
+        for (caller, shape), records in groups.items():
+            operators = {op for r in records for op in r["operators"]}
+            profiled = [r for r in records if r["db_hits"] is not None]
+            elapsed = [r["elapsed_sec"] for r in records]
+            report.append({
+                "caller": caller,
+                "shape": shape,
+                "params": records[0]["params"],
+                "count": len(records),
+                "total_sec": sum(elapsed),
+                "mean_sec": sum(elapsed) / len(elapsed),
+                "max_sec": max(elapsed),
+                "rows": sum(r["rows"] for r in records),
+                "db_hits": sum(r["db_hits"] for r in profiled) if profiled else None,
+                "index_operators": sorted(op for op in operators if any(i in op for i in INDEX_OPERATORS)),
+                "scan_operators": sorted(op for op in operators if op in SCAN_OPERATORS),
+                "profiled": bool(profiled),
+            })
+        return sorted(report, key=lambda r: r["total_sec"], reverse=True)
+
+    def format_report(self, top=10):
+        """遅い文の形の上位を表示用の文字列にする"""
+        report = self.aggregate()
+        lines = [f"Cypherプロファイル: {len(self.records)} 文 / {len(report)} 種類 (合計時間の上位 {top} 件)"]
+        for i, entry in enumerate(report[:top], 1):
+            if not entry["profiled"]:
+                plan = "PROFILE なし"
+            elif entry["index_operators"]:
+                plan = "インデックス使用: " + ", ".join(entry["index_operators"])
+            else:
+                plan = "インデックス未使用"
+            if entry["scan_operators"]:
+                plan += " / 走査: " + ", ".join(entry["scan_operators"])
+            lines.append(
+                f"{i:2d}. [{entry['caller']}] {entry['count']} 回, 合計 {entry['total_sec']:.3f}s, "
+                f"平均 {entry['mean_sec'] * 1000:.1f}ms, 最大 {entry['max_sec'] * 1000:.1f}ms, "
+                f"行数 {entry['rows']}, db hits {entry['db_hits'] if entry['db_hits'] is not None else '-'}"
+            )
+            lines.append(f"    {plan}")
+            lines.append(f"    パラメーター: {entry['params'] or '-'}")
+            lines.append(f"    {entry['shape'][:300]}")
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.aggregate(), f, ensure_ascii=False, indent=2)
+
+
+def attach_profiler(args, index):
+    """--profile-cypher が指定され、Neo4jストアを使っている場合はプロファイラーを取り付ける"""
+    if not args.profile_cypher:
+        return None
+    if args.graph_store != "neo4j":
+        logging.warning("--profile-cypher は neo4j ストアでのみ有効です")
+        return None
+    return CypherProfiler(index.property_graph_store).attach()
+
+
+def report_profiler(args, profiler):
+    """集計結果を表示し、指定があればJSONに書き出す"""
+    if profiler is None:
+        return
+    print(profiler.format_report(args.profile_top))
+    if args.profile_report:
+        profiler.write_report(args.profile_report)
+        print(f"プロファイル結果を保存しました: {args.profile_report}")
+
+
+def add_profiler_arguments(parser):
+    """Cypherプロファイル用の引数を追加する"""
+    group = parser.add_argument_group('Cypherプロファイル')
+    group.add_argument("--profile-cypher", action="store_true",
+                       help="グラフストアが実行するCypherを PROFILE 付きで実行し、遅い文の形を集計する")
+    group.add_argument("--profile-top", type=int, default=10,
+                       help="表示する文の形の件数 (既定: 10)")
+    group.add_argument("--profile-report",
+                       help="集計結果を保存するJSONファイルのパス")
+    return group
@@ -0,0 +1,214 @@
+import boto3
+import os
+import json
+import time
+import argparse
+import logging
+import tenacity
+from bedrock_archive import create_bedrock_client
+from model_roles import create_role_llms
+from llama_index.embeddings.bedrock import BedrockEmbedding
+from llama_index.core.settings import Settings
+from llama_index.core.schema import QueryBundle
+from graph_backend import add_backend_arguments, load_index
+from community_summary import add_global_search_arguments, answer_globally, check_global_search_arguments
+from context_pruning import add_context_arguments, build_node_postprocessors
+from khop_retriever import add_retrieval_arguments, build_sub_retrievers
+from semantic_cache import add_semantic_cache_arguments, cache_scope, create_semantic_cache, lookup_answer, remember_answer
+from query_log import add_query_log_arguments, create_query_log
+
+logging.basicConfig(level=logging.INFO)
+
+# boto3セッションの初期化
+session = boto3.Session(
+    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+    region_name=os.getenv('AWS_DEFAULT_REGION')
+)
+
+# BEDROCK_ARCHIVE_MODE=record/replay の場合は要求・応答を記録/再生するクライアントになる
+bedrock_client = create_bedrock_client(session)
+
+# 質問応答 (query_neo4j.py) と同じ役割・モデルのLLMを使う
+llms = create_role_llms(session, ["synthesis", "cypher"])
+llm = llms["synthesis"]
+
+# タイムアウト時間を延長 (秒単位で指定、例: 60秒)
+request_timeout_sec = 60
+
+# リトライ処理を Tenacity で実装
+@tenacity.retry(stop=tenacity.stop_after_attempt(3),
+                  wait=tenacity.wait_fixed(5),
+                  retry=tenacity.retry_if_exception_type(Exception),
+                  before_sleep=tenacity.before_sleep_log(logging, logging.WARNING))
+def create_embedding_with_retry(client, model_name, request_timeout):
+    return BedrockEmbedding(
+        model_name=model_name,
+        client=client,
+        use_async=False,
+        request_timeout=request_timeout
+    )
+
+embedding = create_embedding_with_retry(
+    bedrock_client,
+    "amazon.titan-embed-text-v2:0",
+    request_timeout_sec
+)
+
+Settings.llm = llm
+Settings.embed_model = embedding
+
+DEFAULT_WARMUP_TOP = 20
+DEFAULT_WARMUP_DAYS = 7
+DEFAULT_WARMUP_BUDGET = 300
+DEFAULT_READY_FILE = os.getenv("QUERY_READY_FILE", "./query_ready.json")
+
+
+def warm_question(args, question, semantic_cache, retriever, query_engine):
+    """1つの質問を再生し、温めた内容を {"embedded", "retrieved", "answered", "cached"} で返す
+
+    - 埋め込み: 質問を埋め込む (Bedrock への接続を確立し、意味キャッシュの照合に使う)
+    - 近傍: 質問応答と同じ検索を実行し、起点のエンティティと近傍を Neo4j のページキャッシュに載せる
+    - 回答: 意味キャッシュに現在のグラフバージョンの回答が無ければ生成して保存する
+    """
+    result = {"embedded": False, "retrieved": False, "answered": False, "cached": False}
+    cached, cache_context = None, None
+    if semantic_cache is not None:
+        cached, cache_context = lookup_answer(args, semantic_cache, embedding, question)
+        result["cached"] = cached is not None
+    vector = cache_context["vector"] if cache_context is not None else None
+    if vector is None:
+        vector = embedding.get_query_embedding(question)
+    result["embedded"] = True
+
+    if retriever is not None:
+        # 埋め込み済みの QueryBundle を渡し、同じ質問を二重に埋め込まない
+        retriever.retrieve(QueryBundle(query_str=question, embedding=vector))
+        result["retrieved"] = True
+
+    if semantic_cache is None or cached is not None:
+        return result
+    if cache_context["vector"] is None:
+        cache_context["vector"] = vector
+    if args.search_mode == "global":
+        response = answer_globally(args, llm, embedding, question)
+    else:
+        response = query_engine.query(question)
+    remember_answer(semantic_cache, cache_context, question, str(response))
+    result["answered"] = True
+    return result
+
+
+def write_ready_file(path, summary):
+    """ウォームアップの完了を示すファイルを書き出す (一時ファイルから置き換えるため途中の状態は見えない)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    os.replace(temporary, path)
+
+
+if __name__ == "__main__":
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="デプロイ直後の起動時に、質問ログ (--query-log) の直近で頻度の高い質問を再生して\n"
+                                                 "埋め込み・Neo4j のページキャッシュ・意味キャッシュの回答を温めてから、\n"
+                                                 "準備完了のファイル (--ready-file) を書き出します。\n"
+                                                 "ECS のヘルスチェックでこのファイルの有無を確認すると、温め終わるまでタスクに\n"
+                                                 "質問が振り分けられません。質問応答と同じ引数 (ストア・検索方式・意味キャッシュ) を指定してください。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    warmup_group = parser.add_argument_group('ウォームアップ')
+    warmup_group.add_argument("--warmup-top", type=int, default=DEFAULT_WARMUP_TOP,
+                              help=f"再生する質問数 (頻度の高い順, 既定: {DEFAULT_WARMUP_TOP})")
+    warmup_group.add_argument("--warmup-days", type=int, default=DEFAULT_WARMUP_DAYS,
+                              help=f"頻度を集計する直近の日数 (既定: {DEFAULT_WARMUP_DAYS})")
+    warmup_group.add_argument("--warmup-budget", type=float, default=DEFAULT_WARMUP_BUDGET,
+                              help="ウォームアップに使う時間の上限 (秒, 既定: "
+                                   f"{DEFAULT_WARMUP_BUDGET})\n"
+                                   "超えた場合は残りの質問を再生せずに準備完了にする")
+    warmup_group.add_argument("--ready-file", default=DEFAULT_READY_FILE,
+                              help=f"ウォームアップの完了後に書き出すファイル (既定: {DEFAULT_READY_FILE})\n"
+                                   "開始時に削除し、完了後に再生した結果の要約を書き出す")
+    add_backend_arguments(parser)
+    add_global_search_arguments(parser)
+    add_context_arguments(parser)
+    add_retrieval_arguments(parser)
+    add_semantic_cache_arguments(parser)
+    add_query_log_arguments(parser)
+
+    args = parser.parse_args()
+    check_global_search_arguments(parser, args)
+
+    if not args.query_log:
+        parser.error("--query-log (または環境変数 QUERY_LOG_PATH) を指定してください")
+
+    # 前回の起動の完了ファイルが残っていると、温める前に準備完了と判定されてしまう
+    if os.path.exists(args.ready_file):
+        os.remove(args.ready_file)
+
+    started = time.perf_counter()
+    try:
+        query_log = create_query_log(args)
+        try:
+            questions = query_log.top_questions(cache_scope(args), args.warmup_top, args.warmup_days)
+        finally:
+            query_log.close()
+    except Exception as e:
+        # 質問ログが読めなくても、温めずに準備完了にしてタスクの起動は止めない
+        logging.warning(f"質問ログを読み込めませんでした: {e}")
+        questions = []
+    print(f"直近 {args.warmup_days} 日で頻度の高い質問: {len(questions)} 件")
+
+    semantic_cache = create_semantic_cache(args)
+    if semantic_cache is None:
+        logging.info("意味キャッシュが指定されていないため、回答の事前生成は行いません (埋め込み・近傍のみ温めます)")
+
+    retriever = None
+    query_engine = None
+    if questions and args.search_mode != "global":
+        try:
+            # 検索時の問い合わせ生成 (キーワード・同義語の抽出) は cypher の役割のLLMで行う
+            index = load_index(args, embedding, llm=llms["cypher"])
+        except Exception as e:
+            print(f"インデックスのロード中にエラーが発生しました: {e}")
+            exit(1)
+        # 質問応答 (query_neo4j.py) と同じ検索・回答の設定にする
+        retriever = index.as_retriever(
+            sub_retrievers=build_sub_retrievers(args, index, embedding, include_text=False),
+            include_text=False,
+        )
+        query_engine = index.as_query_engine(
+            sub_retrievers=build_sub_retrievers(args, index, embedding),
+            node_postprocessors=build_node_postprocessors(args),
+        )
+
+    totals = {"questions": 0, "embedded": 0, "retrieved": 0, "answered": 0, "cached": 0, "failed": 0, "skipped": 0}
+    for position, (question, count) in enumerate(questions):
+        if time.perf_counter() - started > args.warmup_budget:
+            totals["skipped"] = len(questions) - position
+            logging.warning(f"ウォームアップの上限 {args.warmup_budget:g} 秒を超えたため、"
+                            f"残り {totals['skipped']} 件の質問は再生しません")
+            break
+        question_started = time.perf_counter()
+        try:
+            result = warm_question(args, question, semantic_cache, retriever, query_engine)
+        except Exception as e:
+            # 1件の失敗で準備完了にならないと、タスクが起動し続けられないため次の質問へ進む
+            logging.warning(f"質問の再生に失敗しました ({question}): {e}")
+            totals["failed"] += 1
+            continue
+        totals["questions"] += 1
+        for key in ("embedded", "retrieved", "answered", "cached"):
+            totals[key] += int(result[key])
+        state = "保存済み" if result["cached"] else ("回答を生成" if result["answered"] else "検索のみ")
+        print(f"[{position + 1}/{len(questions)}] {count} 回: {question} "
+              f"({state}, {time.perf_counter() - question_started:.1f} 秒)")
+
+    if semantic_cache is not None:
+        semantic_cache.close()
+
+    seconds = time.perf_counter() - started
+    print(f"ウォームアップ完了: 再生 {totals['questions']} 件 (回答を生成 {totals['answered']} 件, "
+          f"保存済み {totals['cached']} 件, 失敗 {totals['failed']} 件, 未実行 {totals['skipped']} 件), {seconds:.1f} 秒")
+    write_ready_file(args.ready_file, {"ready_at": time.time(), "seconds": seconds, "scope": cache_scope(args), **totals})
+    print(f"準備完了のファイルを書き出しました: {args.ready_file}")
@@ -0,0 +1,236 @@
+import json
+import math
+import time
+import random
+import argparse
+import logging
+from llama_index.core import PropertyGraphIndex
+from llama_index.core.settings import Settings
+from graph_backend import add_backend_arguments, create_graph_store, graph_version
+from khop_retriever import add_retrieval_arguments, build_sub_retrievers
+from load_test import LatencyModel, StandInLLM, _percentile
+from synthetic_graph import (SyntheticEmbedding, add_synthetic_arguments, create_synthetic_graph, create_writer,
+                             generate_graph, resume_graph)
+
+DEFAULT_PLOT_PATH = "./retrieval_scaling.svg"
+
+# グラフの線の色 (p50, p90, p99)
+PLOT_SERIES = [("p50", "#1f77b4"), ("p90", "#ff7f0e"), ("p99", "#d62728")]
+
+
+class RoundTripCounter:
+    """グラフストアの structured_query の呼び出し回数 (Neo4j への往復回数) を数える"""
+
+    def __init__(self, graph_store):
+        self.calls = 0
+        self._original = graph_store.structured_query
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return self._original(*args, **kwargs)
+
+        graph_store.structured_query = counted
+
+
+def measure_retrieval(retriever, questions, warmup):
+    """質問を1件ずつ検索し、応答時間 (秒) と検索結果の件数を返す (warmup 件は測定しない)"""
+    for question in questions[:warmup]:
+        retriever.retrieve(question)
+    latencies = []
+    results = []
+    for question in questions[warmup:]:
+        started = time.perf_counter()
+        nodes = retriever.retrieve(question)
+        latencies.append(time.perf_counter() - started)
+        results.append(len(nodes))
+    return latencies, results
+
+
+def build_retriever(args, index, embedding):
+    """質問応答と同じ as_retriever の検索を作る"""
+    return index.as_retriever(
+        sub_retrievers=build_sub_retrievers(args, index, embedding, include_text=args.include_text),
+        include_text=args.include_text,
+    )
+
+
+def rebuild_snapshot(args, index, writer):
+    """現在の合成グラフからスナップショットを作り直し、プロセス内で共有している古いものと置き換える"""
+    from csr_snapshot import Neo4jSnapshotSource, SimpleSnapshotSource, build_snapshot, reload_snapshot
+
+    if args.graph_store == "neo4j":
+        source = Neo4jSnapshotSource(writer.driver, args.neo4j_database)
+    else:
+        source = SimpleSnapshotSource(index)
+    manifest = build_snapshot(source, args.snapshot_dir, graph_version(args))
+    reload_snapshot(args.snapshot_dir)
+    return manifest
+
+
+def summarize_step(size, latencies, results, round_trips, generated):
+    ordered = sorted(latencies)
+    return {
+        "entities": size,
+        "queries": len(latencies),
+        "latency_ms": {name: _percentile(ordered, ratio) * 1000
+                       for name, ratio in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))},
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "mean_results": sum(results) / len(results) if results else 0.0,
+        "round_trips": round_trips,
+        "generated": generated,
+    }
+
+
+def format_step(step):
+    latency = step["latency_ms"]
+    round_trips = f", 往復 {step['round_trips']:.1f} 回/件" if step["round_trips"] is not None else ""
+    return (f"{step['entities']:>10,} エンティティ: 中央値 {latency['p50']:8.1f}ms, 90% {latency['p90']:8.1f}ms, "
+            f"99% {latency['p99']:8.1f}ms (結果 {step['mean_results']:.1f} 件/件{round_trips})")
+
+
+def write_plot(steps, path, title):
+    """エンティティ数 (対数軸) に対する応答時間の曲線を SVG で書き出す (追加の依存ライブラリを使わない)"""
+    width, height, margin = 720, 420, 60
+    sizes = [step["entities"] for step in steps]
+    values = [step["latency_ms"][name] for step in steps for name, _ in PLOT_SERIES]
+    x_min, x_max = math.log10(min(sizes)), math.log10(max(sizes))
+    y_max = max(values) * 1.1 or 1.0
+
+    def x(size):
+        ratio = (math.log10(size) - x_min) / (x_max - x_min) if x_max > x_min else 0.5
+        return margin + ratio * (width - 2 * margin)
+
+    def y(value):
+        return height - margin - value / y_max * (height - 2 * margin)
+
+    elements = [f'<rect width="{width}" height="{height}" fill="white"/>',
+                f'<text x="{width / 2}" y="24" text-anchor="middle" font-size="16">{title}</text>',
+                f'<line x1="{margin}" y1="{height - margin}" x2="{width - margin}" y2="{height - margin}" stroke="black"/>',
+                f'<line x1="{margin}" y1="{margin}" x2="{margin}" y2="{height - margin}" stroke="black"/>',
+                f'<text x="{width / 2}" y="{height - 15}" text-anchor="middle" font-size="12">エンティティ数 (対数軸)</text>',
+                f'<text x="15" y="{height / 2}" text-anchor="middle" font-size="12" '
+                f'transform="rotate(-90 15 {height / 2})">応答時間 (ms)</text>']
+    for size in sizes:
+        elements.append(f'<text x="{x(size):.1f}" y="{height - margin + 16}" text-anchor="middle" '
+                        f'font-size="11">{size:,}</text>')
+    for i in range(5):
+        value = y_max * i / 4
+        elements.append(f'<line x1="{margin}" y1="{y(value):.1f}" x2="{width - margin}" y2="{y(value):.1f}" '
+                        f'stroke="#ddd"/>')
+        elements.append(f'<text x="{margin - 6}" y="{y(value) + 4:.1f}" text-anchor="end" '
+                        f'font-size="11">{value:.0f}</text>')
+    for offset, (name, color) in enumerate(PLOT_SERIES):
+        points = " ".join(f"{x(step['entities']):.1f},{y(step['latency_ms'][name]):.1f}" for step in steps)
+        elements.append(f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="2"/>')
+        for step in steps:
+            elements.append(f'<circle cx="{x(step["entities"]):.1f}" cy="{y(step["latency_ms"][name]):.1f}" '
+                            f'r="3" fill="{color}"/>')
+        elements.append(f'<text x="{width - margin + 8}" y="{margin + 16 * offset}" font-size="12" '
+                        f'fill="{color}">{name}</text>')
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">\n')
+        f.write("\n".join(elements))
+        f.write("\n</svg>\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="合成グラフを段階的に大きくしながら、質問応答と同じ as_retriever の検索の\n"
+                                                 "応答時間を測定し、エンティティ数に対する応答時間の曲線を描きます。\n"
+                                                 "LLM・埋め込みは Bedrock を呼ばない代替モデルを使い、グラフ検索の時間だけを測ります。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    bench_group = parser.add_argument_group('測定')
+    bench_group.add_argument("--sizes", default="1000,10000,100000",
+                             help="測定するエンティティ数のカンマ区切りの一覧 (小さい順に拡張しながら測定, 既定: 1000,10000,100000)")
+    bench_group.add_argument("--queries", type=int, default=50,
+                             help="1つの大きさあたりの測定する質問数 (既定: 50)")
+    bench_group.add_argument("--warmup", type=int, default=5,
+                             help="測定前に実行する質問数 (既定: 5)")
+    bench_group.add_argument("--include-text", action="store_true",
+                             help="検索結果にチャンクの本文を含める (既定: トリプレットのみ)")
+    bench_group.add_argument("--llm-latency", type=float, default=0.0,
+                             help="代替LLM (キーワード抽出) の応答時間の中央値 (秒, 既定: 0 = グラフ検索のみを測る)")
+    bench_group.add_argument("--plot", default=DEFAULT_PLOT_PATH,
+                             help=f"応答時間の曲線を書き出す SVG ファイル (既定: {DEFAULT_PLOT_PATH})")
+    bench_group.add_argument("--report-json", help="測定結果をJSONで保存するファイル")
+    add_synthetic_arguments(parser)
+    add_backend_arguments(parser)
+    add_retrieval_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        sizes = sorted(int(size) for size in args.sizes.split(",") if size.strip())
+    except ValueError:
+        parser.error(f"--sizes の形式が正しくありません: {args.sizes}")
+    if not sizes or sizes[0] <= 0:
+        parser.error("--sizes には正の整数を指定してください")
+    if args.collection:
+        parser.error("合成グラフはコレクションに対応していません (--collection を外してください)")
+
+    graph = create_synthetic_graph(args)
+    embedding = SyntheticEmbedding(graph)
+    llm = StandInLLM(LatencyModel(args.llm_latency))
+    Settings.llm = llm
+    Settings.embed_model = embedding
+
+    steps = []
+    try:
+        writer, index = create_writer(args, embedding)
+        if args.graph_store == "neo4j":
+            graph_store = create_graph_store(args)
+            index = PropertyGraphIndex.from_existing(property_graph_store=graph_store, llm=llm, embed_model=embedding)
+        else:
+            graph_store = None
+        counter = RoundTripCounter(graph_store) if graph_store is not None else None
+        # スナップショットはグラフを拡張するたびに作り直すため、検索も測定の直前に作る
+        retriever = build_retriever(args, index, embedding) if args.retrieval_mode != "snapshot" else None
+
+        # 中断した生成が残っていれば、関係まで書き終えてから測る
+        current = resume_graph(graph, writer)
+        if current > sizes[0]:
+            print(f"※ 既に {current:,} エンティティ生成済みです。それより小さい大きさは測定できないため、"
+                  f"synthetic_graph.py clear で削除してから実行してください")
+            sizes = [size for size in sizes if size >= current]
+        rng = random.Random(args.seed)
+        for size in sizes:
+            generated = None
+            if current < size:
+                generated = generate_graph(graph, writer, current, size)
+                print(f"生成: {current:,} → {size:,} エンティティ, 関係 {generated['relations']:,} 本 "
+                      f"({generated['seconds']:.1f} 秒)")
+                current = size
+            if args.retrieval_mode == "snapshot" and (retriever is None or generated is not None):
+                manifest = rebuild_snapshot(args, index, writer)
+                print(f"スナップショット: エンティティ {manifest['entities']:,}, 関係 {manifest['relations']:,} 本 "
+                      f"({manifest['seconds']:.1f} 秒)")
+                retriever = build_retriever(args, index, embedding)
+            # 質問は生成済みのエンティティ名 (その近くに埋め込まれる) を含む文にする
+            questions = [f"{graph.entity_name(rng.randrange(size))} について教えてください"
+                         for _ in range(args.warmup + args.queries)]
+            before = counter.calls if counter is not None else 0
+            latencies, results = measure_retrieval(retriever, questions, args.warmup)
+            # 往復回数は warmup を含めた質問1件あたりの平均
+            round_trips = (counter.calls - before) / len(questions) if counter is not None else None
+            step = summarize_step(size, latencies, results, round_trips, generated)
+            steps.append(step)
+            print(format_step(step))
+    except Exception as e:
+        print(f"測定中にエラーが発生しました: {e}")
+        exit(1)
+
+    if not steps:
+        exit(0)
+    if len(steps) > 1:
+        first, last = steps[0], steps[-1]
+        growth = last["latency_ms"]["p50"] / first["latency_ms"]["p50"] if first["latency_ms"]["p50"] else 0.0
+        print(f"エンティティ数 {last['entities'] / first['entities']:.0f} 倍で中央値の応答時間は {growth:.1f} 倍")
+    mode = args.retrieval_mode if args.graph_store == "neo4j" or args.retrieval_mode == "snapshot" else "default"
+    write_plot(steps, args.plot, f"as_retriever の応答時間 ({args.graph_store}, {mode})")
+    print(f"応答時間の曲線: {args.plot}")
+    if args.report_json:
+        with open(args.report_json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "steps": steps}, f, ensure_ascii=False, indent=2)
+        print(f"測定結果を保存しました: {args.report_json}")
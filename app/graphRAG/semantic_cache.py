@@ -0,0 +1,175 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import numpy as np
+from graph_backend import graph_version
+
+DEFAULT_SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH")
+DEFAULT_SEMANTIC_THRESHOLD = 0.9
+
+# 1つのスコープ・グラフバージョンあたりに保存する質問数の上限 (古いものから削除する)
+MAX_ENTRIES_PER_SCOPE = 5000
+
+
+def normalize_question(question):
+    return " ".join(question.split())
+
+
+class SemanticCache:
+    """質問の埋め込みが近い過去の回答を返すローカルキャッシュ
+
+    回答は SQLite に保存し、検索時はスコープとグラフバージョンが一致する質問の埋め込みを
+    正規化した行列としてメモリに載せ、内積 (コサイン類似度) で最も近いものを探す。
+    グラフが更新されてバージョンが変わると、古い回答は使われずに削除される。
+    """
+
+    def __init__(self, path, threshold=DEFAULT_SEMANTIC_THRESHOLD, max_entries=MAX_ENTRIES_PER_SCOPE):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " scope TEXT NOT NULL,"
+            " graph_version TEXT NOT NULL,"
+            " question TEXT NOT NULL,"
+            " embedding BLOB NOT NULL,"
+            " answer TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS semantic_cache_scope ON semantic_cache (scope, graph_version)")
+        self._conn.commit()
+
+    def _load(self, scope, version):
+        """スコープ・バージョンごとの検索用の行列 (ids, 質問, 正規化した埋め込み) を返す"""
+        key = (scope, version)
+        if key not in self._index:
+            rows = self._conn.execute(
+                "SELECT id, question, embedding FROM semantic_cache WHERE scope = ? AND graph_version = ? ORDER BY id",
+                (scope, version)).fetchall()
+            ids = [row[0] for row in rows]
+            questions = [row[1] for row in rows]
+            matrix = (np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+                      if rows else np.zeros((0, 0), dtype=np.float32))
+            self._index[key] = (ids, questions, matrix)
+        return self._index[key]
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup_exact(self, scope, version, question):
+        """空白の違いを除いて同じ質問の回答を返す (埋め込みを作らずに済む)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, question, answer FROM semantic_cache WHERE scope = ? AND graph_version = ? "
+                "AND question = ? ORDER BY id DESC LIMIT 1",
+                (scope, version, normalize_question(question))).fetchone()
+            if row is None:
+                return None
+            self._hit(row[0])
+        return {"question": row[1], "answer": row[2], "score": 1.0}
+
+    def lookup(self, scope, version, vector):
+        """類似度が閾値以上で最も近い質問の回答を返す (無ければ None)"""
+        with self._lock:
+            ids, questions, matrix = self._load(scope, version)
+            if not ids:
+                return None
+            query = self._normalize(vector)
+            if matrix.shape[1] != query.shape[0]:
+                # 埋め込みモデルの次元が変わった場合は使わない
+                return None
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            if score < self.threshold:
+                logging.info(f"意味キャッシュ: 最も近い質問の類似度 {score:.3f} が閾値 {self.threshold} 未満です")
+                return None
+            row = self._conn.execute("SELECT answer FROM semantic_cache WHERE id = ?", (ids[best],)).fetchone()
+            if row is None:
+                return None
+            self._hit(ids[best])
+        return {"question": questions[best], "answer": row[0], "score": score}
+
+    def _hit(self, entry_id):
+        self._conn.execute("UPDATE semantic_cache SET hits = hits + 1 WHERE id = ?", (entry_id,))
+        self._conn.commit()
+
+    def store(self, scope, version, question, vector, answer):
+        """回答を保存し、同じスコープの古いバージョンの回答と上限を超えた分を削除する"""
+        embedding = self._normalize(vector)
+        with self._lock:
+            self._conn.execute("DELETE FROM semantic_cache WHERE scope = ? AND graph_version <> ?", (scope, version))
+            self._conn.execute(
+                "INSERT INTO semantic_cache (scope, graph_version, question, embedding, answer, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (scope, version, normalize_question(question), embedding.tobytes(), answer, time.time()))
+            self._conn.execute(
+                "DELETE FROM semantic_cache WHERE scope = ? AND id NOT IN ("
+                " SELECT id FROM semantic_cache WHERE scope = ? ORDER BY id DESC LIMIT ?)",
+                (scope, scope, self.max_entries))
+            self._conn.commit()
+            self._index = {key: value for key, value in self._index.items() if key[0] != scope}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def cache_scope(args):
+    """回答が同じになる範囲 (ストア・コレクション・検索モード・グラフ検索の方式) を表すキー"""
+    return f"{args.graph_store}:{args.collection or ''}:{args.search_mode}:{args.retrieval_mode}"
+
+
+def create_semantic_cache(args):
+    """--semantic-cache が指定された場合は SemanticCache を作成する (無い場合は None)"""
+    if not args.semantic_cache:
+        return None
+    return SemanticCache(args.semantic_cache, threshold=args.semantic_threshold)
+
+
+def lookup_answer(args, cache, embedding, question):
+    """キャッシュから回答を探し、(見つかった回答または None, 保存用の情報) を返す
+
+    完全一致の質問があれば埋め込みも作らない。見つからなかった場合は、保存用の情報に
+    グラフバージョンと質問の埋め込みを入れて返す (回答後に remember_answer へ渡す)。
+    """
+    scope = cache_scope(args)
+    version = graph_version(args)
+    context = {"scope": scope, "version": version, "vector": None}
+    cached = cache.lookup_exact(scope, version, question)
+    if cached is not None:
+        return cached, context
+    context["vector"] = embedding.get_query_embedding(question)
+    return cache.lookup(scope, version, context["vector"]), context
+
+
+def remember_answer(cache, context, question, answer):
+    """回答を生成した時点のグラフバージョンで回答を保存する"""
+    if cache is None or context is None or context["vector"] is None:
+        return
+    cache.store(context["scope"], context["version"], question, context["vector"], answer)
+
+
+def add_semantic_cache_arguments(parser):
+    """意味キャッシュ用の引数を追加する"""
+    group = parser.add_argument_group('意味キャッシュ')
+    group.add_argument("--semantic-cache", default=DEFAULT_SEMANTIC_CACHE_PATH,
+                       help="回答を保存するSQLiteファイルのパス\n"
+                            "(指定した場合、言い回しの違う同じ質問には検索・LLM呼び出し無しで保存済みの回答を返す)")
+    group.add_argument("--semantic-threshold", type=float, default=DEFAULT_SEMANTIC_THRESHOLD,
+                       help="保存済みの回答を使う質問の類似度 (コサイン) の下限 "
+                            f"(既定: {DEFAULT_SEMANTIC_THRESHOLD})")
+    return group
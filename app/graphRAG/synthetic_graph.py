@@ -0,0 +1,549 @@
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import logging
+from functools import lru_cache
+from typing import Any, List
+import numpy as np
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.graph_stores.types import EntityNode, Relation
+from llama_index.core.llms import MockLLM
+from llama_index.core.schema import TextNode
+from pydantic import PrivateAttr
+from graph_backend import add_backend_arguments, bump_graph_version, load_index, persist_index
+from graph_snapshot import BASE_NODE_LABEL, BASE_ENTITY_LABEL, create_driver, ensure_indexes
+
+# エンティティの種類 (コミュニティごとに1つ) と関係の種類 (先頭ほど多く使う)
+ENTITY_TYPES = ["PERSON", "ORGANIZATION", "PRODUCT", "LOCATION", "EVENT", "CONCEPT", "DOCUMENT", "TECHNOLOGY"]
+RELATION_TYPES = ["RELATED_TO", "PART_OF", "WORKS_FOR", "LOCATED_IN", "USES", "PRODUCES", "MENTIONS_TOPIC",
+                  "DEPENDS_ON", "COMPETES_WITH", "FOUNDED", "ACQUIRED", "SUCCEEDED_BY"]
+
+# 乱数はブロック単位で種を決めるため、途中まで生成したグラフを同じ内容のまま拡張できる
+BLOCK_SIZE = 1000
+DEFAULT_DIMENSIONS = 1024
+CHUNK_LABEL = "Chunk"
+
+_ENTITY_INDEX_PATTERN = re.compile(r"\b[A-Z]+-(\d+)\b", re.IGNORECASE)
+
+ENTITY_QUERY = """
+UNWIND $rows AS row
+MERGE (e:`{node}` {{id: row.id}})
+SET e:`{entity}`:`{label}`, e.name = row.id, e.synthetic = true, e.triplet_source_id = row.source
+WITH e, row
+CALL db.create.setNodeVectorProperty(e, 'embedding', row.embedding)
+RETURN count(*) AS written
+"""
+
+CHUNK_QUERY = f"""
+UNWIND $rows AS row
+MERGE (c:`{BASE_NODE_LABEL}` {{id: row.id}})
+SET c:`{CHUNK_LABEL}`, c.text = row.text, c.synthetic = true
+WITH c, row
+UNWIND row.mentions AS entity_id
+MATCH (e:`{BASE_ENTITY_LABEL}` {{id: entity_id}})
+MERGE (c)-[:MENTIONS]->(e)
+RETURN count(*) AS written
+"""
+
+RELATION_QUERY = """
+UNWIND $rows AS row
+MATCH (s:`{entity}` {{id: row.source}})
+MATCH (t:`{entity}` {{id: row.target}})
+MERGE (s)-[r:`{type}`]->(t)
+SET r.triplet_source_id = row.chunk
+RETURN count(*) AS written
+"""
+
+COUNT_QUERY = f"MATCH (e:`{BASE_ENTITY_LABEL}`) WHERE e.synthetic = true RETURN count(e) AS entities"
+
+# 生成の進捗 (__Node__ を付けないため検索・書き出しの対象にならない)
+#   completed : 関係・チャンクまで書き終えたエンティティ数
+#   target    : 生成中の範囲の終わり (生成中でなければ null)
+#   next_block: 生成中の範囲で次に関係を書くブロック (エンティティを書き終える前は null)
+PROGRESS_LABEL = "__SyntheticProgress__"
+
+LOAD_PROGRESS_QUERY = f"""
+MATCH (p:`{PROGRESS_LABEL}` {{id: 'synthetic'}})
+RETURN p.completed AS completed, p.target AS target, p.next_block AS next_block
+"""
+
+SAVE_PROGRESS_QUERY = f"""
+MERGE (p:`{PROGRESS_LABEL}` {{id: 'synthetic'}})
+SET p.completed = $completed, p.target = $target, p.next_block = $next_block
+"""
+
+CLEAR_PROGRESS_QUERY = f"MATCH (p:`{PROGRESS_LABEL}`) DELETE p"
+
+# 組み込みストアの進捗はグラフと同じ永続化ディレクトリに、グラフと一緒に書き出す
+SIMPLE_PROGRESS_FILE = "synthetic_progress.json"
+
+CLEAR_QUERY = f"""
+MATCH (n:`{BASE_NODE_LABEL}`) WHERE n.synthetic = true
+WITH n LIMIT $limit
+DETACH DELETE n
+RETURN count(*) AS deleted
+"""
+
+
+class SyntheticGraph:
+    """現実に近い次数分布と埋め込みを持つ合成プロパティグラフの生成規則
+
+    - エンティティ i はコミュニティ i % communities に属し、埋め込みはコミュニティの中心に
+      ばらつき spread のノイズを加えたもの (同じコミュニティほど似る)。
+    - 各エンティティは平均 avg_degree / 2 本の関係を張る。相手は活性度 (パレート分布, 形状 alpha)
+      に比例して選ぶため、一部のエンティティに関係が集中する裾の重い次数分布になる (Chung-Lu 型)。
+      locality の割合は同じコミュニティの中から選ぶ。
+    - 関係 edges_per_chunk 本ごとに、その関係を文章にしたチャンクを作り、両端のエンティティを参照させる。
+    """
+
+    def __init__(self, seed=0, dimensions=DEFAULT_DIMENSIONS, communities=200, avg_degree=8.0, alpha=2.1,
+                 locality=0.8, spread=1.0, edges_per_chunk=5):
+        self.seed = seed
+        self.dimensions = dimensions
+        self.communities = communities
+        self.avg_degree = avg_degree
+        self.alpha = alpha
+        self.locality = locality
+        self.spread = spread
+        self.edges_per_chunk = edges_per_chunk
+        self._fitness = np.zeros(0)
+        self._centroids = None
+
+    def _rng(self, stream, block):
+        return np.random.default_rng([self.seed, stream, block])
+
+    def entity_name(self, index):
+        community = index % self.communities
+        return f"{ENTITY_TYPES[community % len(ENTITY_TYPES)].title()}-{index}"
+
+    def entity_label(self, index):
+        return ENTITY_TYPES[(index % self.communities) % len(ENTITY_TYPES)]
+
+    def centroids(self):
+        if self._centroids is None:
+            centroids = self._rng(1, 0).standard_normal((self.communities, self.dimensions))
+            self._centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+        return self._centroids
+
+    @lru_cache(maxsize=8)
+    def block_embeddings(self, block):
+        """ブロック内のエンティティの正規化した埋め込み (float32)"""
+        start = block * BLOCK_SIZE
+        indices = np.arange(start, start + BLOCK_SIZE)
+        noise = self._rng(2, block).standard_normal((BLOCK_SIZE, self.dimensions)) / np.sqrt(self.dimensions)
+        vectors = self.centroids()[indices % self.communities] + self.spread * noise
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+    def entity_embedding(self, index):
+        return self.block_embeddings(index // BLOCK_SIZE)[index % BLOCK_SIZE]
+
+    def fitness(self, stop):
+        """エンティティ 0..stop-1 の活性度 (ブロックごとに同じ値になる)"""
+        blocks = -(-stop // BLOCK_SIZE)
+        known = len(self._fitness) // BLOCK_SIZE
+        if blocks > known:
+            extra = [self._rng(3, block).pareto(self.alpha, BLOCK_SIZE) + 1 for block in range(known, blocks)]
+            self._fitness = np.concatenate([self._fitness] + extra)
+        return self._fitness[:stop]
+
+    @lru_cache(maxsize=2)
+    def _cumulative_fitness(self, pool):
+        """関係の相手を選ぶための活性度の累積和 (全体, コミュニティごと)"""
+        fitness = self.fitness(pool)
+        rows = -(-pool // self.communities)
+        padded = np.zeros(rows * self.communities)
+        padded[:pool] = fitness
+        # コミュニティごとの列を行として持つ (末尾の 0 の詰め物は searchsorted で選ばれない)
+        community_cumulative = np.ascontiguousarray(np.cumsum(padded.reshape(rows, self.communities), axis=0).T)
+        return np.cumsum(fitness), community_cumulative
+
+    def out_degrees(self, block):
+        return self._rng(4, block).poisson(self.avg_degree / 2, BLOCK_SIZE)
+
+    def block_entities(self, block, start, stop):
+        """ブロック内の start..stop-1 のエンティティを {id, label, embedding, source} の一覧で返す"""
+        first = block * BLOCK_SIZE
+        degrees = self.out_degrees(block)
+        # エンティティの出典 (triplet_source_id) は、そのエンティティが張る最初の関係のチャンク
+        offsets = np.concatenate([[0], np.cumsum(degrees)[:-1]])
+        embeddings = self.block_embeddings(block)
+        rows = []
+        for index in range(max(start, first), min(stop, first + BLOCK_SIZE)):
+            position = index - first
+            source = (self.chunk_id(block, int(offsets[position]) // self.edges_per_chunk)
+                      if degrees[position] else None)
+            rows.append({"id": self.entity_name(index), "label": self.entity_label(index),
+                         "embedding": embeddings[position], "source": source})
+        return rows
+
+    def chunk_id(self, block, number):
+        return f"synthetic-chunk-{self.seed}-{block}-{number}"
+
+    def block_edges(self, block, start, stop, pool):
+        """ブロック内の start..stop-1 のエンティティが張る関係と、関係を文章にしたチャンクを返す
+
+        関係の相手は 0..pool-1 のエンティティから選ぶ。
+        """
+        first = block * BLOCK_SIZE
+        rng = self._rng(5, block)
+        degrees = self.out_degrees(block)
+        sources = np.repeat(np.arange(first, first + BLOCK_SIZE), degrees)
+        numbers = np.arange(len(sources)) // self.edges_per_chunk
+        keep = (sources >= start) & (sources < stop)
+        # 乱数の消費量を範囲によらず一定にするため、ブロック全体分を引いてから絞り込む
+        uniforms = rng.random(len(sources))
+        local = rng.random(len(sources)) < self.locality
+        weights = np.arange(len(RELATION_TYPES), 0, -1, dtype=float)
+        types = rng.choice(len(RELATION_TYPES), size=len(sources), p=weights / weights.sum())
+        sources, numbers, uniforms, local, types = (array[keep] for array in (sources, numbers, uniforms, local, types))
+
+        cumulative, community_cumulative = self._cumulative_fitness(pool)
+        targets = np.searchsorted(cumulative, uniforms * cumulative[-1], side="right")
+        # 同じコミュニティの中から活性度に比例して選ぶ (コミュニティ c のエンティティは c, c+C, c+2C, ...)
+        communities = sources % self.communities
+        for community in np.unique(communities[local]):
+            column = community_cumulative[community]
+            if not column[-1]:
+                continue
+            selected = local & (communities == community)
+            rows = np.searchsorted(column, uniforms[selected] * column[-1], side="right")
+            targets[selected] = rows * self.communities + community
+        targets = np.minimum(targets, pool - 1)
+
+        edges = []
+        chunks = {}
+        for source, target, relation, number in zip(sources, targets, types, numbers):
+            if source == target:
+                continue
+            chunk = self.chunk_id(block, int(number))
+            source_name, target_name = self.entity_name(int(source)), self.entity_name(int(target))
+            edges.append({"source": source_name, "type": RELATION_TYPES[relation], "target": target_name,
+                          "chunk": chunk})
+            entry = chunks.setdefault(chunk, {"id": chunk, "lines": [], "mentions": []})
+            entry["lines"].append(f"{source_name} {RELATION_TYPES[relation].lower().replace('_', ' ')} "
+                                  f"{target_name}.")
+            for name in (source_name, target_name):
+                if name not in entry["mentions"]:
+                    entry["mentions"].append(name)
+        chunk_rows = [{"id": chunk["id"], "text": " ".join(chunk["lines"]), "mentions": chunk["mentions"]}
+                      for chunk in chunks.values()]
+        return edges, chunk_rows
+
+
+class SyntheticEmbedding(BaseEmbedding):
+    """合成グラフ用の埋め込み (Bedrock を呼ばない)
+
+    テキストにエンティティ名 (例: Person-42) が含まれる場合は、そのエンティティの埋め込みに
+    小さなノイズを加えたベクトルを返す (質問がそのエンティティの近くに来る)。
+    それ以外はテキストのハッシュから決まるベクトルを返す。
+    """
+
+    _graph: Any = PrivateAttr()
+
+    def __init__(self, graph: SyntheticGraph, **kwargs: Any) -> None:
+        super().__init__(model_name="synthetic", **kwargs)
+        self._graph = graph
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SyntheticEmbedding"
+
+    def _vector(self, text: str) -> List[float]:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+        noise = rng.standard_normal(self._graph.dimensions) / np.sqrt(self._graph.dimensions)
+        match = _ENTITY_INDEX_PATTERN.search(text)
+        if match:
+            vector = self._graph.entity_embedding(int(match.group(1))) + 0.2 * noise
+        else:
+            vector = noise
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._vector(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._vector(text)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._vector(query)
+
+
+class Neo4jGraphWriter:
+    """合成グラフを UNWIND でまとめて Neo4j に書き込む"""
+
+    def __init__(self, driver, database, batch_size=1000):
+        self.driver = driver
+        self.database = database
+        self.batch_size = batch_size
+        ensure_indexes(driver, database)
+
+    def _write(self, query, rows):
+        for i in range(0, len(rows), self.batch_size):
+            self.driver.execute_query(query, rows=rows[i:i + self.batch_size], database_=self.database)
+
+    def count(self):
+        records, _, _ = self.driver.execute_query(COUNT_QUERY, database_=self.database)
+        return records[0]["entities"]
+
+    def load_progress(self):
+        records, _, _ = self.driver.execute_query(LOAD_PROGRESS_QUERY, database_=self.database)
+        return dict(records[0]) if records else None
+
+    def save_progress(self, progress):
+        # 書き込みは1件ずつ確定するため、進捗も書き終えた時点ですぐに保存する
+        self.driver.execute_query(SAVE_PROGRESS_QUERY, **progress, database_=self.database)
+
+    def persist(self, args):
+        pass
+
+    def write_entities(self, rows):
+        # ラベル・関係の種類はパラメーターにできないため、種類ごとに文を分ける
+        for label in sorted({row["label"] for row in rows}):
+            self._write(ENTITY_QUERY.format(node=BASE_NODE_LABEL, entity=BASE_ENTITY_LABEL, label=label),
+                        [{"id": row["id"], "source": row["source"], "embedding": row["embedding"].tolist()}
+                         for row in rows if row["label"] == label])
+
+    def write_edges(self, edges, chunks):
+        self._write(CHUNK_QUERY, chunks)
+        for relation in sorted({edge["type"] for edge in edges}):
+            self._write(RELATION_QUERY.format(entity=BASE_ENTITY_LABEL, type=relation),
+                        [edge for edge in edges if edge["type"] == relation])
+
+    def finish(self):
+        # ベクトルインデックスへの反映は非同期のため、測定の前に反映を待つ
+        self.driver.execute_query("CALL db.awaitIndexes(600)", database_=self.database)
+        bump_graph_version(self.driver, self.database)
+
+    def clear(self, batch_size=10000):
+        deleted = 0
+        while True:
+            records, _, _ = self.driver.execute_query(CLEAR_QUERY, limit=batch_size, database_=self.database)
+            if not records[0]["deleted"]:
+                self.driver.execute_query(CLEAR_PROGRESS_QUERY, database_=self.database)
+                bump_graph_version(self.driver, self.database)
+                return deleted
+            deleted += records[0]["deleted"]
+
+
+class SimpleGraphWriter:
+    """合成グラフを組み込みストア (SimplePropertyGraphStore とベクトルストア) に書き込む"""
+
+    def __init__(self, index, persist_dir):
+        self.index = index
+        self.store = index.property_graph_store
+        self.progress_path = os.path.join(persist_dir, SIMPLE_PROGRESS_FILE)
+        self.progress = None
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, encoding="utf-8") as f:
+                self.progress = json.load(f)
+
+    def count(self):
+        return len(self.store.get(properties={"synthetic": True}))
+
+    def load_progress(self):
+        return self.progress
+
+    def save_progress(self, progress):
+        # 組み込みストアはグラフ全体をまとめて書き出すため、進捗もメモリに置いて persist で一緒に書き出す
+        self.progress = dict(progress)
+
+    def persist(self, args):
+        persist_index(args, self.index)
+        if self.progress is None:
+            if os.path.exists(self.progress_path):
+                os.remove(self.progress_path)
+            return
+        with open(self.progress_path, "w", encoding="utf-8") as f:
+            json.dump(self.progress, f)
+
+    def write_entities(self, rows):
+        nodes = [EntityNode(name=row["id"], label=row["label"],
+                            properties={"synthetic": True, **({"triplet_source_id": row["source"]}
+                                                               if row["source"] else {})},
+                            embedding=row["embedding"].tolist())
+                 for row in rows]
+        # 組み込みストアはベクトル検索に対応しないため、LlamaIndex と同じくベクトルストアに埋め込みを入れる
+        self.index._insert_nodes_to_vector_index(nodes)
+        self.store.upsert_nodes(nodes)
+
+    def write_edges(self, edges, chunks):
+        self.store.upsert_llama_nodes([TextNode(id_=chunk["id"], text=chunk["text"]) for chunk in chunks])
+        self.store.upsert_relations([Relation(label=edge["type"], source_id=edge["source"],
+                                              target_id=edge["target"],
+                                              properties={"triplet_source_id": edge["chunk"]})
+                                     for edge in edges])
+
+    def finish(self):
+        pass
+
+    def clear(self, batch_size=10000):
+        nodes = self.store.get(properties={"synthetic": True})
+        self.store.delete(ids=[node.id for node in nodes])
+        self.progress = None
+        return len(nodes)
+
+
+def create_writer(args, embedding):
+    """引数のグラフストアに応じて書き込み先と (simple の場合は) インデックスを作る"""
+    if args.graph_store == "neo4j":
+        return Neo4jGraphWriter(create_driver(args), args.neo4j_database, args.write_batch_size), None
+    # 抽出は行わないため LLM は呼ばない (既定の OpenAI を解決させないために MockLLM を渡す)
+    index = load_index(args, embedding, llm=MockLLM())
+    return SimpleGraphWriter(index, args.persist_dir), index
+
+
+def generate_graph(graph, writer, start, stop, next_block=None):
+    """エンティティ start..stop-1 を追加する (先にすべてのエンティティを書き、次に関係とチャンクを書く)
+
+    関係の相手は範囲全体から選ぶため、エンティティ数だけでは関係まで書き終えたかが分からない。
+    そのため進捗 (書き終えたブロック) を保存しながら書き、next_block を指定した場合は
+    エンティティを書き終えた範囲の関係をそのブロックから書き直す (中断した生成の再開)。
+    """
+    started = time.perf_counter()
+    first_block, last_block = start // BLOCK_SIZE, -(-stop // BLOCK_SIZE)
+    if next_block is None:
+        writer.save_progress({"completed": start, "target": stop, "next_block": None})
+        for block in range(first_block, last_block):
+            writer.write_entities(graph.block_entities(block, start, stop))
+            logging.info(f"エンティティ: {min(stop, (block + 1) * BLOCK_SIZE)}/{stop} "
+                         f"({time.perf_counter() - started:.1f} 秒)")
+        next_block = first_block
+        writer.save_progress({"completed": start, "target": stop, "next_block": next_block})
+    edges_total = 0
+    for block in range(next_block, last_block):
+        edges, chunks = graph.block_edges(block, start, stop, stop)
+        writer.write_edges(edges, chunks)
+        writer.save_progress({"completed": start, "target": stop, "next_block": block + 1})
+        edges_total += len(edges)
+        logging.info(f"関係: {edges_total} 本 (エンティティ {min(stop, (block + 1) * BLOCK_SIZE)}/{stop} まで, "
+                     f"{time.perf_counter() - started:.1f} 秒)")
+    writer.finish()
+    writer.save_progress({"completed": stop, "target": None, "next_block": None})
+    return {"entities": stop - start, "relations": edges_total, "seconds": time.perf_counter() - started}
+
+
+def resume_graph(graph, writer):
+    """中断した生成があれば続きから書き終え、関係まで書き終えたエンティティ数を返す
+
+    進捗が無いのに合成エンティティがある場合 (進捗を記録する前に作ったグラフ) は、関係が欠けていないか
+    分からず、どの範囲で作ったかも分からないため書き直せない。エラーにして clear からやり直させる。
+    """
+    progress = writer.load_progress()
+    if progress is None:
+        count = writer.count()
+        if count:
+            raise ValueError(f"生成の進捗が記録されていない合成グラフ ({count} エンティティ) があります。"
+                             f"関係が欠けている可能性があるため、clear で削除してから生成し直してください")
+        return 0
+    if progress["target"] is not None:
+        logging.warning(f"中断した生成 ({progress['completed']} → {progress['target']} エンティティ) を再開します")
+        generate_graph(graph, writer, progress["completed"], progress["target"], progress["next_block"])
+        return progress["target"]
+    return progress["completed"]
+
+
+def degree_summary(graph, stop):
+    """生成したグラフの次数分布の要約 (書き込み前の確認用)"""
+    degrees = np.zeros(stop, dtype=np.int64)
+    for block in range(-(-stop // BLOCK_SIZE)):
+        edges, _ = graph.block_edges(block, 0, stop, stop)
+        for edge in edges:
+            degrees[int(edge["source"].rsplit("-", 1)[1])] += 1
+            degrees[int(edge["target"].rsplit("-", 1)[1])] += 1
+    ordered = np.sort(degrees)
+    return {"mean": float(degrees.mean()), "p50": int(ordered[stop // 2]), "p99": int(ordered[int(stop * 0.99)]),
+            "max": int(ordered[-1]), "top1_share": float(ordered[-max(1, stop // 100):].sum() / max(1, degrees.sum()))}
+
+
+def create_synthetic_graph(args):
+    return SyntheticGraph(seed=args.seed, dimensions=args.dimensions, communities=args.communities,
+                          avg_degree=args.avg_degree, alpha=args.alpha, locality=args.locality,
+                          spread=args.spread, edges_per_chunk=args.edges_per_chunk)
+
+
+def add_synthetic_arguments(parser):
+    """合成グラフの生成規則の引数を追加する"""
+    group = parser.add_argument_group('合成グラフ')
+    group.add_argument("--seed", type=int, default=0, help="乱数の種 (既定: 0)")
+    group.add_argument("--dimensions", type=int, default=DEFAULT_DIMENSIONS,
+                       help=f"埋め込みの次元 (既定: {DEFAULT_DIMENSIONS}, titan-embed-text-v2 と同じ)")
+    group.add_argument("--communities", type=int, default=200,
+                       help="コミュニティ数 (既定: 200)。同じコミュニティのエンティティは埋め込みが近く、関係も多い")
+    group.add_argument("--avg-degree", type=float, default=8.0,
+                       help="エンティティあたりの平均次数 (既定: 8)")
+    group.add_argument("--alpha", type=float, default=2.1,
+                       help="活性度のパレート分布の形状 (既定: 2.1)。小さいほど次数が一部に集中する")
+    group.add_argument("--locality", type=float, default=0.8,
+                       help="同じコミュニティの中で張る関係の割合 (既定: 0.8)")
+    group.add_argument("--spread", type=float, default=1.0,
+                       help="コミュニティ内の埋め込みのばらつき (既定: 1.0)")
+    group.add_argument("--edges-per-chunk", type=int, default=5,
+                       help="1チャンクにまとめる関係の数 (既定: 5)")
+    group.add_argument("--write-batch-size", type=int, default=1000,
+                       help="Neo4j に1回で書き込む行数 (既定: 1000)")
+    return group
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # 引数パーサーの作成
+    parser = argparse.ArgumentParser(description="検索の性能測定用に、裾の重い次数分布とコミュニティ構造を持つ\n"
+                                                 "合成の知識グラフ (エンティティ・関係・チャンク・埋め込み) を作成します。\n"
+                                                 "合成データには synthetic = true を付けるため、clear でまとめて削除できます。",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="合成グラフをエンティティ数 --entities まで拡張する",
+                                            formatter_class=argparse.RawTextHelpFormatter)
+    generate_parser.add_argument("--entities", type=int, required=True,
+                                 help="生成後のエンティティ数。既に生成済みの分は書き直さずに続きから追加する")
+    add_synthetic_arguments(generate_parser)
+    add_backend_arguments(generate_parser)
+
+    stats_parser = subparsers.add_parser("stats", help="書き込まずに次数分布の要約を表示する",
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    stats_parser.add_argument("--entities", type=int, required=True, help="エンティティ数")
+    add_synthetic_arguments(stats_parser)
+
+    clear_parser = subparsers.add_parser("clear", help="合成データ (synthetic = true) を削除する",
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    add_synthetic_arguments(clear_parser)
+    add_backend_arguments(clear_parser)
+
+    args = parser.parse_args()
+
+    graph = create_synthetic_graph(args)
+    if args.command == "stats":
+        summary = degree_summary(graph, args.entities)
+        print(f"次数: 平均 {summary['mean']:.1f}, 中央値 {summary['p50']}, 99% {summary['p99']}, "
+              f"最大 {summary['max']} (上位1%のエンティティが関係の端点の {summary['top1_share']:.0%} を占める)")
+        exit(0)
+
+    if args.collection:
+        parser.error("合成グラフはコレクションに対応していません (--collection を外してください)")
+
+    try:
+        writer, index = create_writer(args, SyntheticEmbedding(graph))
+        if args.command == "clear":
+            print(f"削除した合成ノード数: {writer.clear()}")
+            writer.persist(args)
+        else:
+            try:
+                start = resume_graph(graph, writer)
+                if start >= args.entities:
+                    print(f"既に {start} エンティティ (関係・チャンクを含めて) 生成済みです")
+                else:
+                    result = generate_graph(graph, writer, start, args.entities)
+                    print(f"エンティティ {start} → {args.entities}: 関係 {result['relations']} 本 "
+                          f"({result['seconds']:.1f} 秒)")
+            finally:
+                # 途中で失敗しても、書き終えた分と進捗を残して次回はその続きから再開する
+                writer.persist(args)
+    except Exception as e:
+        print(f"合成グラフの処理中にエラーが発生しました: {e}")
+        exit(1)
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+DEFAULT_QUEUE_PATH = os.getenv("INGEST_QUEUE_PATH", "./ingest_queue.db")
+
+# ジョブの状態
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def job_key(source, chunk_index, text):
+    """同じチャンクを二重に登録しないためのキー (ノードIDにも使い、再実行しても同じノードに MERGE される)"""
+    return hashlib.sha256(f"{source}\n{chunk_index}\n{text}".encode("utf-8")).hexdigest()
+
+
+class ChunkQueue:
+    """SQLite上の永続的なチャンクジョブのキュー
+
+    ワーカーは lease でジョブを借り、処理後に ack する。visibility_timeout 秒以内に ack または
+    extend されなかったジョブは他のワーカーに再配布され、max_attempts 回失敗したものは failed になる。
+    複数プロセスから同じファイルを開いて使う (WAL のため同一ホスト上のプロセスに限る)。
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH, visibility_timeout=300, max_attempts=3):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # 書き込みの競合はSQLiteのロック待ちで解決する
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT NOT NULL UNIQUE,"
+            " source TEXT NOT NULL,"
+            " chunk_index INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT,"
+            " lease_expires REAL,"
+            " last_error TEXT,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+
+    def _write(self, statements):
+        """BEGIN IMMEDIATE で書き込みロックを取ってから statements(cursor) を実行する"""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+                cursor.execute("COMMIT")
+                return result
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, jobs):
+        """(source, chunk_index, text, metadata) の一覧を登録し、新規に登録した件数を返す"""
+        now = time.time()
+        rows = [(job_key(source, index, text), source, index, text, json.dumps(metadata, ensure_ascii=False),
+                 PENDING, now) for source, index, text, metadata in jobs]
+
+        def insert(cursor):
+            cursor.executemany(
+                "INSERT OR IGNORE INTO jobs (key, source, chunk_index, text, metadata, status, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            return cursor.rowcount
+        return self._write(insert)
+
+    def lease(self, owner, limit=1):
+        """処理待ち、またはリースの期限が切れたジョブを最大 limit 件借りる"""
+        now = time.time()
+
+        def take(cursor):
+            # 試行回数を使い切ったまま期限切れになったジョブは failed にする
+            cursor.execute(
+                "UPDATE jobs SET status = ?, lease_owner = NULL, updated_at = ?"
+                " WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts))
+            rows = cursor.execute(
+                "SELECT id, key, source, chunk_index, text, metadata, attempts FROM jobs"
+                " WHERE (status = ? OR (status = ? AND lease_expires < ?)) AND attempts < ?"
+                " ORDER BY id LIMIT ?",
+                (PENDING, LEASED, now, self.max_attempts, limit)).fetchall()
+            cursor.executemany(
+                "UPDATE jobs SET status = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1,"
+                " updated_at = ? WHERE id = ?",
+                [(LEASED, owner, now + self.visibility_timeout, now, row[0]) for row in rows])
+            return rows
+        rows = self._write(take)
+        return [{"id": row[0], "key": row[1], "source": row[2], "chunk_index": row[3], "text": row[4],
+                 "metadata": json.loads(row[5]), "attempts": row[6] + 1} for row in rows]
+
+    def extend(self, owner, job_ids):
+        """処理中のジョブのリースを延長する (処理が visibility_timeout より長くかかる場合)"""
+        expires = time.time() + self.visibility_timeout
+
+        def update(cursor):
+            cursor.executemany(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+                [(expires, job_id, owner, LEASED) for job_id in job_ids])
+        self._write(update)
+
+    def ack(self, owner, job_id):
+        """ジョブを完了にする (リースを他のワーカーに奪われていた場合は False)"""
+        def update(cursor):
+            cursor.execute(
+                "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires = NULL, last_error = NULL,"
+                " updated_at = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+                (DONE, time.time(), job_id, owner, LEASED))
+            return cursor.rowcount == 1
+        return self._write(update)
+
+    def nack(self, owner, job_id, error):
+        """ジョブを失敗として戻す (試行回数が残っていれば再配布、無ければ failed)"""
+        def update(cursor):
+            cursor.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,"
+                " lease_owner = NULL, lease_expires = NULL, last_error = ?, updated_at = ?"
+                " WHERE id = ? AND lease_owner = ? AND status = ?",
+                (self.max_attempts, FAILED, PENDING, str(error)[:2000], time.time(), job_id, owner, LEASED))
+        self._write(update)
+
+    def release(self, owner, job_id):
+        """処理を始めずに手放すジョブを試行回数を戻して処理待ちに戻す (停止時など)"""
+        def update(cursor):
+            cursor.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, lease_owner = NULL, lease_expires = NULL,"
+                " updated_at = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+                (PENDING, time.time(), job_id, owner, LEASED))
+        self._write(update)
+
+    def requeue_failed(self):
+        """failed のジョブを試行回数を戻して再登録する"""
+        def update(cursor):
+            cursor.execute("UPDATE jobs SET status = ?, attempts = 0, updated_at = ? WHERE status = ?",
+                           (PENDING, time.time(), FAILED))
+            return cursor.rowcount
+        return self._write(update)
+
+    def counts(self):
+        """状態ごとのジョブ数を返す"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall()
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def failures(self, limit=20):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT source, chunk_index, attempts, last_error FROM jobs WHERE status = ? ORDER BY id LIMIT ?",
+                (FAILED, limit)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()